@@ -1,9 +1,17 @@
 import requests
-import re
 import json
+import time
 from openai import OpenAI
 import base64, pathlib
+import httpx
 import os
+import cache
+import threading
+import http_client
+import mp3
+import lyrics
+import lyrics_cache
+from difflib import SequenceMatcher
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,8 +24,14 @@ def find_between( s, first, last ):
     except ValueError:
         return ''
 
+# Upstream endpoints, overridable to point the bot at local stand-ins (loadtest.py).
+# OpenAI's SDK reads OPENAI_BASE_URL itself.
+RAPIDAPI_URL = os.getenv("RAPIDAPI_URL", "https://spotify-music-mp3-downloader-api.p.rapidapi.com/download")
+SCRAPE_DO_URL = os.getenv("SCRAPE_DO_URL", "http://api.scrape.do/")
+LRCLIB_SEARCH_URL = os.getenv("LRCLIB_SEARCH_URL", "https://lrclib.net/api/search")
+
 def get_download_link(spotify_url):
-    url = "https://spotify-music-mp3-downloader-api.p.rapidapi.com/download"
+    url = RAPIDAPI_URL
 
     querystring = {"link": spotify_url}
 
@@ -26,7 +40,7 @@ def get_download_link(spotify_url):
         "x-rapidapi-host": "spotify-music-mp3-downloader-api.p.rapidapi.com"
     }
 
-    response = requests.get(url, headers=headers, params=querystring)
+    response = http_client.get(http_client.RAPIDAPI, url, headers=headers, params=querystring)
 
     json_res = response.json()
     print(json_res)
@@ -47,133 +61,408 @@ def get_download_link_temp(spotify_url):
         'playWithBrowser': '[{"Action":"Fill","Selector":"#trackUrl","Value":"'+spotify_url+'"},{"Action":"Click","Selector":"#btnSubmit"},{"Action":"WaitSelector","WaitSelector":"#trackData","Timeout":10000},{"Action":"Click","Selector":"button.btn-success"},{"Action":"WaitSelector","WaitSelector":"a[data-url]","Timeout":5000},{"Action":"Wait","Timeout":5000}]',
     }
 
-    response = requests.get('http://api.scrape.do/', params=params)
-    json_res = response.json()
-
-    track_name = ""
-    download_link = ""
-
-    networkRequests = json_res['networkRequests']
-    for request in networkRequests:
-        request_url = request.get('url', None)
-        if not request_url:
-            continue
-        
-        if request_url == "https://spotmate.online/convert":
-            response_body = request['response_body']
-            download_data = json.loads(response_body)
-            download_link = download_data['url']
-        
-        if request_url == "https://spotmate.online/getTrackData":
-            response_body = request['response_body']
-            track_data = json.loads(response_body)
-            track_name = track_data['name']
-
-    return download_link, track_name
-
-def download_mp3(url, vid_id):
-    save_path = f"temp/audio_{vid_id}.mp3"
+    def scrape():
+        response = http_client.check_response(
+            http_client.SESSION.get(SCRAPE_DO_URL, params=params, timeout=http_client.SCRAPE_DO.timeout)
+        )
+        json_res = response.json()
+
+        track_name = ""
+        download_link = ""
+
+        networkRequests = json_res.get('networkRequests') or []
+        for request in networkRequests:
+            request_url = request.get('url', None)
+            if not request_url:
+                continue
+            
+            if request_url == "https://spotmate.online/convert":
+                response_body = request['response_body']
+                download_data = json.loads(response_body)
+                download_link = download_data['url']
+            
+            if request_url == "https://spotmate.online/getTrackData":
+                response_body = request['response_body']
+                track_data = json.loads(response_body)
+                track_name = track_data['name']
+
+        # The scripted browser run sometimes ends before spotmate answers, that's worth another try
+        if download_link == "":
+            raise http_client.TransientError(f"scrape.do returned no download link for {spotify_url}")
+        return download_link, track_name
+
+    return http_client.call(http_client.SCRAPE_DO, scrape)
+
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+RANGED_DOWNLOADS = os.getenv("AUDIO_RANGED", "1") == "1" # Download only the clip window when the host supports it
+RANGE_HEAD_BYTES = 64 * 1024 # Enough for the first frames and any Xing/VBRI header
+RANGE_MARGIN_SECONDS = 3.0 # Extra audio on both sides of the window
+RANGE_VBR_MARGIN = 0.02 # Extra share of the file after a VBR seek table estimate (the TOC has 1% steps)
+
+def download_to(url, save_path, offset=0, first=None, last=None):
+    # Stream url (or its bytes first-last) into save_path from file position offset.
+    # Returns (HTTP status, total size from Content-Range or None). A retry rewrites from offset,
+    # so a failed attempt never leaves duplicated bytes behind.
+    headers = {}
+    if first is not None:
+        headers["Range"] = f"bytes={first}-{'' if last is None else last}"
+
+    def download():
+        with http_client.check_response(
+            http_client.SESSION.get(url, headers=headers, stream=True, timeout=http_client.AUDIO_HOST.timeout)
+        ) as response:
+            with open(save_path, "r+b" if os.path.exists(save_path) else "wb") as f:
+                # A server that ignores Range sends the whole file, which belongs at the start
+                f.seek(offset if response.status_code == 206 else 0)
+                f.truncate()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    if chunk:
+                        f.write(chunk)
+            total = None
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code == 206 and "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                total = int(content_range.rsplit("/", 1)[1])
+            return response.status_code, total
+
+    return http_client.call(http_client.AUDIO_HOST, download)
+
+def download_mp3(url, vid_id, workdir="temp"):
+    save_path = os.path.join(workdir, f"audio_{vid_id}.mp3")
 
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise error for bad status
-
-        with open(save_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-
+        download_to(url, save_path)
         print(f"Downloaded successfully as '{save_path}'")
         return save_path
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, http_client.TransientError, http_client.CircuitOpen) as e:
         print(f"Download failed: {e}")
 
-def lyrics_to_json(lyrics_str):
-    pattern = r"\[(\d{2}:\d{2}\.\d{2})\] ?(.*)"
-    matches = re.findall(pattern, lyrics_str)
-
-    result = []
-    for time, lyric in matches:
-        result.append({
-            "time": time,
-            "lyric": lyric.strip()
-        })
-
-    return json.dumps(result, ensure_ascii=False, indent=2)
-
-def get_full_lyrics(keyword, vid_id):
-    save_path = f"temp/lyrics_{vid_id}.json"
-
-    headers = {
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Connection': 'keep-alive',
-        'Referer': 'https://lrclib.net',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
-        'accept': 'application/json',
-        'lrclib-client': 'LRCLIB Web Client (https://github.com/tranxuanthang/lrclib)',
-        'x-user-agent': 'LRCLIB Web Client (https://github.com/tranxuanthang/lrclib)',
-    }
+def download_mp3_window(url, save_path, start_time, end_time):
+    # Download only the part of the MP3 covering start_time-end_time (plus a margin), using the
+    # frame header and Xing/VBRI seek table to find byte offsets. Returns (offset, complete):
+    # the track time save_path starts at and whether it holds the whole track.
+    # CBR files are cut on both sides. For VBR the start of a cut can't be timed exactly, so the
+    # file is downloaded from the beginning up to the window end. Whatever can't be parsed, or a
+    # host without Range support, gets a full download.
+    status, total = download_to(url, save_path, first=0, last=RANGE_HEAD_BYTES - 1)
+    if status != 206 or total is None:
+        print("Audio host ignores Range requests, downloaded the full track")
+        return 0.0, True
+    if total <= RANGE_HEAD_BYTES:
+        return 0.0, True # That was the whole file
+
+    def full_download():
+        download_to(url, save_path, offset=RANGE_HEAD_BYTES, first=RANGE_HEAD_BYTES)
+        return 0.0, True
+
+    with open(save_path, "rb") as f:
+        head = f.read()
+    tag_size = mp3.id3v2_size(head)
+    head_start = 0
+    if tag_size + 16 * 1024 > len(head):
+        # Large ID3 tag (cover art): look at the frames right after it
+        head_path = save_path + ".head"
+        try:
+            download_to(url, head_path, first=tag_size, last=tag_size + RANGE_HEAD_BYTES - 1)
+            with open(head_path, "rb") as f:
+                head = f.read()
+        finally:
+            if os.path.exists(head_path):
+                os.remove(head_path)
+        head_start = tag_size
+
+    info = mp3.parse_stream_info(head, file_size=total, base_offset=head_start)
+    if info is None:
+        return full_download()
+
+    end_offset = info.byte_offset(end_time + RANGE_MARGIN_SECONDS)
+    if end_offset is None:
+        return full_download()
+    if info.vbr:
+        end_offset += int(RANGE_VBR_MARGIN * (info.audio_bytes or total))
+    last = min(total - 1, end_offset)
+
+    first = 0 if info.vbr else info.byte_offset(start_time - RANGE_MARGIN_SECONDS)
+    if first <= info.audio_start:
+        # Keep the file's own start (tags, Xing header) and append up to the window end
+        if last >= RANGE_HEAD_BYTES:
+            download_to(url, save_path, offset=RANGE_HEAD_BYTES, first=RANGE_HEAD_BYTES, last=last)
+        else:
+            with open(save_path, "r+b") as f:
+                f.truncate(last + 1)
+        print(f"Downloaded {last + 1} of {total} bytes (track start to window end)")
+        return 0.0, last >= total - 1
+
+    status, _ = download_to(url, save_path, first=first, last=last)
+    if status != 206:
+        return 0.0, True
+
+    # Drop the bytes before the first whole frame, that frame is where the file's time 0 is
+    with open(save_path, "rb") as f:
+        data = f.read()
+    skip = mp3.find_frame(data)
+    if skip is None:
+        download_to(url, save_path)
+        return 0.0, True
+    if skip:
+        with open(save_path, "wb") as f:
+            f.write(data[skip:])
+    header = info.header
+    frame_bytes = header.samples / header.sample_rate * header.bitrate * 1000 / 8 # Average, padding included
+    frame_index = round((first + skip - info.audio_start) / frame_bytes)
+    # The cut has no LAME tag, so decoders keep the encoder/decoder delay the full track has trimmed
+    offset = frame_index * header.duration - info.start_skip
+    print(f"Downloaded {last - first + 1} of {total} bytes (from {offset:.3f}s)")
+    return offset, False
+
+def fetch_track_audio(spotify_url, vid_id, resolve_link=None, workdir="temp", window=None):
+    # Audio for a Spotify track, served from the on-disk audio cache when we already have it:
+    # the full track, or a cached window that contains the requested one (audio_clip_stage
+    # cuts the clip out of either with mp3.cut). resolve_link(spotify_url) -> (download_link,
+    # title) is only called when the link cache has nothing fresh, and concurrent requests for
+    # the same track share one download.
+    # window=(start_time, end_time) allows a ranged download of just that part of the track; a
+    # track that is asked for again with a window no cached one contains is downloaded whole.
+    # Returns (path, title, offset): offset is the track time the file starts at.
+    resolve_link = resolve_link or get_download_link_temp
+    track_id = cache.spotify_track_id(spotify_url)
+
+    def resolve(fresh=False):
+        meta = None if fresh else cache.LINK_CACHE.get(track_id)
+        if meta is not None and meta["expires"] > time.time():
+            return meta["download_link"], meta["title"]
+        download_link, title = resolve_link(spotify_url)
+        if not download_link:
+            raise ValueError(f"Could not resolve a download link for {spotify_url}")
+        cache.LINK_CACHE.remove(track_id)
+        cache.LINK_CACHE.put(track_id, lambda entry_dir: {"download_link": download_link, "title": title, "expires": time.time() + cache.LINK_TTL})
+        return download_link, title
+
+    def with_link(download):
+        # download(link) with the cached link, and once more with a fresh one if that fails
+        # (the link may have expired early)
+        download_link, title = resolve()
+        try:
+            return download(download_link), title
+        except (requests.exceptions.RequestException, http_client.TransientError, ValueError) as e:
+            print(f"Cached download link failed ({e}), resolving it again")
+            download_link, title = resolve(fresh=True)
+            return download(download_link), title
+
+    def create(entry_dir):
+        def download(download_link):
+            mp3_path = download_mp3(download_link, "track", workdir=entry_dir)
+            if mp3_path is None:
+                raise ValueError(f"Could not download audio for {spotify_url}")
+            return mp3_path
+
+        mp3_path, title = with_link(download)
+        os.rename(mp3_path, os.path.join(entry_dir, "audio.mp3"))
+        return {
+            "track_id": track_id,
+            "spotify_url": spotify_url,
+            "title": title,
+            "sha256": cache.file_sha256(os.path.join(entry_dir, "audio.mp3")),
+            "offset": 0.0,
+            "complete": True,
+        }
+
+    def create_window(entry_dir):
+        mp3_path = os.path.join(entry_dir, "audio.mp3")
+        try:
+            (offset, complete), title = with_link(lambda download_link: download_mp3_window(download_link, mp3_path, *window))
+        except (requests.exceptions.RequestException, http_client.TransientError, http_client.CircuitOpen) as e:
+            raise ValueError(f"Could not download audio for {spotify_url}: {e}")
+        return {
+            "track_id": track_id,
+            "spotify_url": spotify_url,
+            "title": title,
+            "sha256": cache.file_sha256(mp3_path),
+            "offset": offset,
+            "complete": complete,
+            "window": list(window),
+        }
+
+    meta, hit = cache.AUDIO_CACHE.get(track_id, count=False), True
+    windows = cached_windows(track_id) if meta is None and window is not None else []
+    if meta is None:
+        meta = next((w for w in windows if w["complete"] or w["window"][0] <= window[0] and window[1] <= w["window"][1]), None)
+    if meta is None and window is not None and RANGED_DOWNLOADS and not windows:
+        # Clips are cached per window next to full tracks
+        window_key = f"{track_id}_{int(window[0] * 1000)}_{int(window[1] * 1000)}"
+        meta, hit = cache.AUDIO_CACHE.get_or_create(window_key, create_window, count=False)
+    elif meta is None:
+        meta, hit = cache.AUDIO_CACHE.get_or_create(track_id, create, count=False)
+        for cached in windows:
+            cache.AUDIO_CACHE.remove(cached["key"]) # The full track covers them
+    cache.CACHE_REQUESTS.inc(cache="audio", result="hit" if hit else "miss") # One lookup, whichever key answered
+    print(f"Audio cache {'hit' if hit else 'miss'} for track {track_id}")
+
+    # The job gets its own link/copy so cache eviction can't pull the file from under it
+    save_path = os.path.join(workdir, f"audio_{vid_id}.mp3")
+    cache.link_or_copy(os.path.join(meta["dir"], "audio.mp3"), save_path)
+    return save_path, meta["title"], meta.get("offset", 0.0)
+
+def cached_windows(track_id):
+    # Metas of the ranged entries cached for a track (keys "<track_id>_<start ms>_<end ms>")
+    windows = []
+    try:
+        names = os.listdir(cache.AUDIO_CACHE.root)
+    except OSError:
+        return windows
+    for name in names:
+        if name.startswith(f"{track_id}_"):
+            meta = cache.AUDIO_CACHE.get(name, count=False)
+            if meta is not None and meta.get("window"):
+                windows.append(meta)
+    return windows
 
+def lyrics_to_json(lyrics_str):
+    return json.dumps(lyrics.Lyrics.from_lrc(lyrics_str).to_records(), ensure_ascii=False, indent=2)
+
+LRCLIB_HEADERS = {
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Connection': 'keep-alive',
+    'Referer': 'https://lrclib.net',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
+    'accept': 'application/json',
+    'lrclib-client': 'LRCLIB Web Client (https://github.com/tranxuanthang/lrclib)',
+    'x-user-agent': 'LRCLIB Web Client (https://github.com/tranxuanthang/lrclib)',
+}
+
+def search_lrclib(keyword):
+    # Best synced result for the keyword: (syncedLyrics or None, source info)
     params = {
         'q': keyword,
     }
 
-    response = requests.get('https://lrclib.net/api/search', params=params, headers=headers)
+    response = http_client.get(http_client.LRCLIB, LRCLIB_SEARCH_URL, params=params, headers=LRCLIB_HEADERS)
     json_res = response.json()
-    syncedLyrics = json_res[0]['syncedLyrics']
 
-    jsonLyrics = lyrics_to_json(syncedLyrics)
-    with open(save_path, 'w', encoding='utf-8') as file:
-        file.write(jsonLyrics)
+    wanted = lyrics_cache.phonetic_key(keyword)
+    best, best_score = None, -1
+    for result in json_res:
+        if not result.get('syncedLyrics'):
+            continue
+        names = [result.get('trackName') or '', f"{result.get('artistName') or ''} {result.get('trackName') or ''}"]
+        score = max(SequenceMatcher(None, wanted, lyrics_cache.phonetic_key(name)).ratio() for name in names)
+        if score > best_score:
+            best, best_score = result, score
+
+    if best is None:
+        return None, None
+    return best['syncedLyrics'], {"lrclib_id": best.get('id'), "track_name": best.get('trackName'), "artist_name": best.get('artistName')}
+
+def get_lyrics(keyword, track_id=None, custom_title=False):
+    # Local store first (exact title / track ID, then fuzzy), lrclib only when nothing matches.
+    # custom_title: keyword was typed by the user and wins over the track's cached lyrics
+    syncedLyrics = lyrics_cache.LYRICS_STORE.lookup(keyword, search_lrclib, track_id=track_id, custom_title=custom_title)
+    return lyrics.Lyrics.from_lrc(syncedLyrics)
+
+def get_full_lyrics(keyword, vid_id, workdir="temp", track_id=None):
+    save_path = os.path.join(workdir, f"lyrics_{vid_id}.json")
+    return lyrics.save(get_lyrics(keyword, track_id=track_id), save_path)
+
+_openai_client = None
+_openai_lock = threading.Lock()
+
+def get_openai_client():
+    # One client for the whole process, so its connection pool is shared.
+    # Retries are done by http_client.call (with the OpenAI circuit breaker), not by the SDK.
+    global _openai_client
+    with _openai_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=httpx.Timeout(http_client.OPENAI.read_timeout, connect=http_client.OPENAI.connect_timeout),
+                max_retries=0,
+            )
+        return _openai_client
 
-    return save_path
+PROMPT_MODEL = "gpt-4.1"
+IMAGE_MODEL = "gpt-image-1"
+IMAGE_SIZE = "1024x1536"
+
+#GENERATED PROMPTS AND IMAGES ARE CACHED BY THEIR INPUTS, SO IDENTICAL REQUESTS NEVER HIT OPENAI TWICE
+PROMPT_CACHE = cache.DiskLRUCache("prompts", int(os.getenv("PROMPT_CACHE_MB", "16")) * cache.MB)
+IMAGE_CACHE = cache.DiskLRUCache("images", int(os.getenv("IMAGE_CACHE_MB", "1024")) * cache.MB)
 
 def generate_prompt_for_image(lyrics_str):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))  
-
-    response = client.responses.create(
-        model="gpt-4.1",
-        input=[
-            {
-            "role": "system",
-            "content": [
+    system_text = "You are an prompt generation expert for image generation. "
+    user_text = f"I'm going to make a lyric video for a song. For this i need a background image and I'm going to generate an image using an AI model. So I'll give you the lyrics of this songs and you need to make the perfect image generation prompt for this background image. Make sure it's in Studio Ghibli art style and insert the prompt inside these tags <prompt></prompt>\n\nLyrics:\n{lyrics_str}"
+
+    def create(entry_dir):
+        client = get_openai_client()
+
+        response = http_client.call(http_client.OPENAI, lambda: client.responses.create(
+            model=PROMPT_MODEL,
+            input=[
                 {
-                "type": "input_text",
-                "text": "You are an prompt generation expert for image generation. "
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
+                "role": "system",
+                "content": [
+                    {
+                    "type": "input_text",
+                    "text": system_text
+                    }
+                ]
+                },
                 {
-                "type": "input_text",
-                "text": f"I'm going to make a lyric video for a song. For this i need a background image and I'm going to generate an image using an AI model. So I'll give you the lyrics of this songs and you need to make the perfect image generation prompt for this background image. Make sure it's in Studio Ghibli art style and insert the prompt inside these tags <prompt></prompt>\n\nLyrics:\n{lyrics_str}"
+                "role": "user",
+                "content": [
+                    {
+                    "type": "input_text",
+                    "text": user_text
+                    }
+                ]
                 }
-            ]
-            }
-        ],
-        text={
-            "format": {
-            "type": "text"
-            }
-        },
-        reasoning={},
-        tools=[],
-        temperature=1,
-        max_output_tokens=2048,
-        top_p=1,
-        store=True
-    )
-
-    output_text = response.output_text
-    prompt = find_between(output_text, "<prompt>", "</prompt>")
-
-    return prompt.strip()
-
-def make_ghibli_image(image_path, vid_id, source_type="raw_ghibli", lyrics_data=None):
-    save_path = f"temp/ghibli_{vid_id}.png"
+            ],
+            text={
+                "format": {
+                "type": "text"
+                }
+            },
+            reasoning={},
+            tools=[],
+            temperature=1,
+            max_output_tokens=2048,
+            top_p=1,
+            store=True
+        ))
+
+        output_text = response.output_text
+        prompt = find_between(output_text, "<prompt>", "</prompt>").strip()
+        if not prompt:
+            raise ValueError("The prompt generation response had no <prompt></prompt> block")
+        pathlib.Path(entry_dir, "prompt.txt").write_text(prompt, encoding="utf-8")
+        return {"model": PROMPT_MODEL}
+
+    key = cache.hash_key("prompt", PROMPT_MODEL, system_text, user_text)
+    meta, hit = PROMPT_CACHE.get_or_create(key, create)
+    print(f"Prompt cache {'hit' if hit else 'miss'}")
+    return pathlib.Path(meta["dir"], "prompt.txt").read_text(encoding="utf-8")
+
+def image_cache_key(source_type, prompt, image_path=None, lyrics_data=None, style=None):
+    # Content address of a generated background: what it was made from + how
+    if image_path is not None:
+        source_hash = cache.file_sha256(image_path)
+    else:
+        source_hash = cache.hash_key(lyrics_data or "")
+    return cache.hash_key("image", source_type, source_hash, prompt, style, IMAGE_MODEL, IMAGE_SIZE)
+
+def has_cached_image(key):
+    return IMAGE_CACHE.get(key, count=False) is not None
+
+def reuse_cached_image(key, vid_id, workdir="temp"):
+    # Copy a previously generated background into the job workspace
+    meta = IMAGE_CACHE.get(key)
+    if meta is None:
+        raise ValueError("The previous background is no longer available")
+    save_path = os.path.join(workdir, f"ghibli_{vid_id}.png")
+    cache.link_or_copy(os.path.join(meta["dir"], "image.png"), save_path)
+    return save_path
 
+def make_ghibli_image_cached(image_path, vid_id, source_type="raw_ghibli", lyrics_data=None, workdir="temp"):
+    # Returns (image path in the workspace, image cache key)
+    stlye = None
     if source_type == 'lyrics_based':
         prompt = generate_prompt_for_image(lyrics_data)
     elif source_type == 'raw_ghibli':
@@ -182,27 +471,45 @@ def make_ghibli_image(image_path, vid_id, source_type="raw_ghibli", lyrics_data=
     elif source_type == 'ghibli_char':
         prompt = "This person perform a song on a stage, Wide Shot, Studio Ghibli art"
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))  
+    def create(entry_dir):
+        client = get_openai_client()
+
+        if source_type == 'lyrics_based':
+            response = http_client.call(http_client.OPENAI, lambda: client.images.generate(
+                model=IMAGE_MODEL,
+                prompt=prompt,
+                size=IMAGE_SIZE,
+                quality="auto",
+                output_format="png"
+            ))
+            img_bytes = base64.b64decode(response.data[0].b64_json)
+        else:
+            def edit():
+                with open(image_path, "rb") as image_file:
+                    return client.images.edit(
+                        model=IMAGE_MODEL,
+                        image=image_file,
+                        prompt=prompt,
+                        size=IMAGE_SIZE
+                    )
+
+            edited = http_client.call(http_client.OPENAI, edit)
+            img_bytes = base64.b64decode(edited.data[0].b64_json)
+
+        pathlib.Path(entry_dir, "image.png").write_bytes(img_bytes)
+        return {"source_type": source_type, "prompt": prompt, "style": stlye, "model": IMAGE_MODEL, "size": IMAGE_SIZE}
 
     if source_type == 'lyrics_based':
-        response = client.images.generate(
-            model="gpt-image-1",
-            prompt=prompt,
-            size="1024x1536",
-            quality="auto",
-            output_format="png"
-        )
-        img_bytes = base64.b64decode(response.data[0].b64_json)
+        key = image_cache_key(source_type, prompt, lyrics_data=lyrics_data, style=stlye)
     else:
-        with open(image_path, "rb") as image_file:
-            edited = client.images.edit(
-                model="gpt-image-1",
-                image=image_file,
-                prompt=prompt,
-                size="1024x1536"
-            )
+        key = image_cache_key(source_type, prompt, image_path=image_path, style=stlye)
+    meta, hit = IMAGE_CACHE.get_or_create(key, create)
+    print(f"Image cache {'hit' if hit else 'miss'}")
 
-        img_bytes = base64.b64decode(edited.data[0].b64_json)
-    
-    pathlib.Path(save_path).write_bytes(img_bytes)
-    return save_path
\ No newline at end of file
+    save_path = os.path.join(workdir, f"ghibli_{vid_id}.png")
+    cache.link_or_copy(os.path.join(meta["dir"], "image.png"), save_path)
+    return save_path, key
+
+def make_ghibli_image(image_path, vid_id, source_type="raw_ghibli", lyrics_data=None, workdir="temp"):
+    save_path, key = make_ghibli_image_cached(image_path, vid_id, source_type=source_type, lyrics_data=lyrics_data, workdir=workdir)
+    return save_path
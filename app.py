@@ -1,9 +1,14 @@
 import api
-import json
 import gen
 import os
-import time
-import shutil
+import asyncio
+import functools
+import threading
+import metrics
+import pipeline
+import jobstore
+import workspace
+from concurrent.futures import ThreadPoolExecutor
 
 #CREATE DIRs IF NOT EXIST
 if not os.path.exists("temp"):
@@ -13,60 +18,94 @@ if not os.path.exists("outputs"):
 if not os.path.exists("data"):
     os.makedirs("data")
 
-def generate_video(spotify_url, start_time, end_time, raw_image_path, song_title=None, font=1):
-    #GET TIMESTAMP IN SEC
-    vid_id = int(time.time())
+RENDER_SEGMENT_WORKERS = int(os.getenv("RENDER_SEGMENT_WORKERS", "0")) or None # Per video cap, default: all cores
+OUTPUT_ASPECTS = [aspect.strip() for aspect in os.getenv("OUTPUT_ASPECTS", gen.DEFAULT_ASPECT).split(",") if aspect.strip()]
+KARAOKE_HIGHLIGHT = os.getenv("KARAOKE_HIGHLIGHT", "0") == "1" # Word-by-word highlight sweep over the lyrics
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE") # Optional .prom file the metrics are written to after every video
 
-    #COPY RAW IMAGE
-    image_ext = raw_image_path.split(".")[-1]
-    new_image_name = f"raw_{vid_id}.{image_ext}"
-    destination = os.path.join('temp', new_image_name)
-    shutil.copy(raw_image_path, destination)
-    raw_image_path = f"temp/{new_image_name}"
+ACTIVE_VIDEOS = 0 # generate_video_async calls rendering in this process, they share the cores
+_active_lock = threading.Lock()
 
-    #DOWNLOAD AUDIO
-    download_link, title = api.get_download_link(spotify_url)
-    audio_path = api.download_mp3(download_link, vid_id)
-    if song_title is None:
-        song_title = title
+def job_render_workers(max_workers=None):
+    # Like jobs.JobScheduler.job_render_workers: the whole machine for a video rendered alone,
+    # an even share of the cores when other calls are running
+    cores = os.cpu_count() or 1
+    with _active_lock:
+        busy = max(1, ACTIVE_VIDEOS)
+    return max(1, min(max_workers or cores, cores // busy))
 
-    #GET LYRICS
-    lyrics_path = api.get_full_lyrics(song_title, vid_id)
+def generate_video(spotify_url, start_time, end_time, raw_image_path, song_title=None, font=1, aspects=None, image_source_type="raw_ghibli"):
+    # aspects: output formats rendered together, e.g. ["9:16", "1:1", "16:9"] (default OUTPUT_ASPECTS);
+    # the paths are in the returned record's final_video_paths
+    # image_source_type: "raw_ghibli" / "ghibli_char" (raw_image_path is the photo) or "lyrics_based"
+    return asyncio.run(generate_video_async(
+        spotify_url, start_time, end_time, raw_image_path, song_title=song_title, font=font, aspects=aspects,
+        image_source_type=image_source_type,
+    ))
 
-    #GENERATE GHIBLI IMAGE
-    ghibli_image_path = api.make_ghibli_image(raw_image_path, vid_id)
+async def generate_video_async(spotify_url, start_time, end_time, raw_image_path, song_title=None, font=1, aspects=None, image_source_type="raw_ghibli", io_executor=None, cpu_executor=None, render_workers=None):
+    # generate_video on the caller's event loop. Callers running many videos (batch.py) pass
+    # shared executors: threads for the network stages, a process pool for rendering.
+    # Without them the stages run in a local thread pool, like Pipeline.run_sync.
+    # A request that was rendered before returns the earlier record, with "reused": True.
+    # render_workers: processes for time slices of this video, default an even share of the cores
+    # among the calls in flight (capped by RENDER_SEGMENT_WORKERS).
+    global ACTIVE_VIDEOS
+    local_executor = None
+    if io_executor is None or cpu_executor is None:
+        local_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stage")
+        io_executor = io_executor or local_executor
+        cpu_executor = cpu_executor or local_executor
+    loop = asyncio.get_running_loop()
 
-    #CALCULATE DURATION
-    duration = end_time - start_time
+    def run_io(fn, *args, **kwargs):
+        # Hashing the photo and the job store's SQLite calls block, keep them off the event loop
+        return loop.run_in_executor(io_executor, functools.partial(fn, *args, **kwargs))
 
-    #GENERATE RAW VIDEO     
-    raw_video_path = gen.generate_raw_video(ghibli_image_path, duration, vid_id)
-    cutted_audio_path = gen.cut_audio(audio_path, start_time, end_time, vid_id)
-    with open(lyrics_path, 'r', encoding='utf-8') as json_file:
-        lyrics = json.load(json_file)
+    try:
+        aspects = aspects or OUTPUT_ASPECTS
+        image_hash = await run_io(jobstore.image_hash, image_source_type, raw_image_path)
+        fingerprint = jobstore.request_fingerprint(
+            spotify_url, start_time, end_time, font, image_source_type, image_hash=image_hash,
+            song_title=song_title, aspects=aspects, karaoke=KARAOKE_HIGHLIGHT,
+        )
+        previous = await run_io(jobstore.JOB_STORE.lookup, fingerprint)
+        if previous is not None:
+            print(f"Already rendered as job {previous['id']}: {', '.join(previous['final_video_paths'].values())}")
+            return dict(previous, reused=True)
 
-    #GENERATE FINAL VIDEO
-    text_extries = gen.time_adjust_for_lyrics(start_time, end_time, lyrics, adjusted_time=0.10)
-    gen.add_timed_text_to_video(raw_video_path, "outputs.mp4", text_extries, text_position="mid", the_font=font)
-    final_video_path = gen.add_audio_to_video("outputs.mp4", cutted_audio_path, vid_id)
+        #UNIQUE JOB ID + PRIVATE WORKSPACE
+        vid_id = workspace.new_job_id()
+        workdir = workspace.create_workspace(vid_id)
+        with _active_lock:
+            ACTIVE_VIDEOS += 1
+        try:
+            render_workers = render_workers or job_render_workers(RENDER_SEGMENT_WORKERS)
+            await run_io(
+                jobstore.JOB_STORE.start, vid_id, spotify_url, start_time, end_time, font, image_source_type,
+                fingerprint=fingerprint, image_hash=image_hash, song_title=song_title,
+            )
+            #AUDIO, LYRICS AND GHIBLI IMAGE RUN CONCURRENTLY, THEN ONE ENCODE (PAN, LYRICS AND AUDIO)
+            context = pipeline.video_context(
+                vid_id, workdir, spotify_url, start_time, end_time, raw_image_path, image_source_type,
+                resolve_link=api.get_download_link, song_title=song_title, font=font,
+                render_workers=render_workers, karaoke=KARAOKE_HIGHLIGHT, aspects=aspects,
+            )
+            job = pipeline.build_video_pipeline(image_source_type, custom_title=song_title is not None)
+            context, timings = await job.run(context, io_executor=io_executor, cpu_executor=cpu_executor)
+        except Exception as e:
+            await run_io(jobstore.JOB_STORE.fail, vid_id, e)
+            raise
+        finally:
+            with _active_lock:
+                ACTIVE_VIDEOS -= 1
+            workspace.release_workspace(vid_id) # The janitor evicts it once it is past its budget
 
-    #SAVE DATA
-    json_save_path = f"data/{vid_id}.json"
-    vid_data = {
-        "id": vid_id,
-        "spotify_url": spotify_url,
-        "song_title": song_title,
-        "start_time": start_time,
-        "end_time": end_time,
-        "raw_image_path": raw_image_path,
-        "ghibli_image_path": ghibli_image_path,
-        "audio_path": audio_path,
-        "cutted_audio_path": cutted_audio_path,
-        "lyrics_path": lyrics_path,
-        "font": font,
-        "final_video_path": final_video_path
-    }
-    with open(json_save_path, 'w', encoding='utf-8') as json_file:
-        json.dump(vid_data, json_file, indent=4)
-
-    return vid_data
\ No newline at end of file
+        #SAVE DATA
+        vid_data = await run_io(jobstore.JOB_STORE.finish, pipeline.video_record(context, timings))
+        if METRICS_TEXTFILE:
+            await run_io(metrics.write_textfile, METRICS_TEXTFILE)
+        return vid_data
+    finally:
+        if local_executor is not None:
+            local_executor.shutdown(wait=False)
@@ -0,0 +1,240 @@
+import os
+import csv
+import sys
+import json
+import time
+import hashlib
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import gen
+import metrics
+
+# Batch generation from a manifest (CSV or JSON) of clips. Rows run concurrently in one process
+# on app.generate_video_async: their network stages share a thread pool and their renders a
+# process pool, and the audio, lyrics, prompt and image caches are shared (concurrent rows for
+# the same track download it once). Rows rendered before, by any run or by the bot, come straight
+# from the job store (jobstore.py). Every finished row is appended to a status file next to the
+# manifest, so a rerun after a crash or Ctrl-C only does the rows that are not done yet (rows
+# that failed are tried again unless --skip-failed is given).
+#
+#   python batch.py campaign.csv
+#   python batch.py campaign.json --jobs 6 --render-workers 4 --skip-failed
+#
+# Manifest columns / keys:
+#   spotify_url, start_time, end_time   required, times in seconds
+#   image                               photo path, or empty for a lyrics based background
+#   image_source                        raw_ghibli (default with an image), ghibli_char or lyrics_based
+#   font                                1-5, default 1
+#   song_title                          lyrics search title, default: the Spotify title
+#   aspects                             output formats, e.g. "9:16|1:1" (default OUTPUT_ASPECTS)
+#   id                                  row name in the status file, default: a hash of the row
+
+IMAGE_SOURCES = ("raw_ghibli", "ghibli_char", "lyrics_based")
+
+#MANIFEST
+
+def load_manifest(path):
+    if path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        raw_rows = data["rows"] if isinstance(data, dict) else data
+    else:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            raw_rows = list(csv.DictReader(f))
+    rows = [parse_row(raw, number) for number, raw in enumerate(raw_rows, start=1)]
+    keys = [row["key"] for row in rows]
+    duplicates = sorted({key for key in keys if keys.count(key) > 1})
+    if duplicates:
+        raise ValueError(f"Manifest rows repeat (same id or same inputs): {duplicates}")
+    return rows
+
+def parse_row(raw, number):
+    # Manifest row -> generate_video arguments plus its key, ValueError naming the row if it's bad
+    def value(name):
+        field = raw.get(name)
+        return field.strip() if isinstance(field, str) else field
+
+    try:
+        spotify_url = value("spotify_url")
+        if not spotify_url:
+            raise ValueError("spotify_url is missing")
+        start_time, end_time = float(value("start_time")), float(value("end_time"))
+        if start_time < 0 or end_time <= start_time:
+            raise ValueError(f"bad window {start_time}-{end_time}")
+        image = value("image") or None
+        image_source = value("image_source") or ("raw_ghibli" if image else "lyrics_based")
+        if image_source not in IMAGE_SOURCES:
+            raise ValueError(f"image_source must be one of {IMAGE_SOURCES}")
+        if image_source != "lyrics_based" and not (image and os.path.exists(image)):
+            raise ValueError(f"image '{image}' not found")
+        aspects = value("aspects") or None
+        if isinstance(aspects, str):
+            aspects = [aspect.strip() for aspect in aspects.replace(",", "|").split("|") if aspect.strip()]
+        unknown = [aspect for aspect in aspects or [] if aspect not in gen.ASPECT_SIZES]
+        if unknown:
+            raise ValueError(f"unknown aspects {unknown}, expected some of {list(gen.ASPECT_SIZES)}")
+        row = {
+            "spotify_url": spotify_url,
+            "start_time": int(start_time) if start_time.is_integer() else start_time,
+            "end_time": int(end_time) if end_time.is_integer() else end_time,
+            "raw_image_path": image if image_source != "lyrics_based" else "LYRICS_BASED",
+            "image_source_type": image_source,
+            "font": int(value("font") or 1),
+            "song_title": value("song_title") or None,
+            "aspects": aspects,
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Manifest row {number}: {e}") from e
+    row["key"] = str(value("id") or row_key(row))
+    return row
+
+def row_key(row):
+    # Rows without an id are known by their inputs, so reordering the manifest doesn't matter
+    payload = json.dumps(row, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()[:12]
+
+#STATUS FILE
+
+def load_status(path):
+    # key -> last record; a line cut off by a crash is ignored
+    status = {}
+    if not os.path.exists(path):
+        return status
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            status[record["key"]] = record
+    return status
+
+def append_status(path, record):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+#RUNNER
+
+async def run_batch(rows, args, status_path):
+    import app # Reads the environment (caches, output formats) at import
+
+    io_pool = ThreadPoolExecutor(max_workers=args.network_workers, thread_name_prefix="network")
+    # spawn: forking a process that already runs threads is unsafe
+    render_pool = ProcessPoolExecutor(max_workers=args.render_workers, mp_context=multiprocessing.get_context("spawn"))
+    slots = asyncio.Semaphore(args.jobs)
+    results = []
+
+    async def run_row(row):
+        async with slots:
+            started = time.monotonic()
+            record = {"key": row["key"], "spotify_url": row["spotify_url"], "start_time": row["start_time"], "end_time": row["end_time"]}
+            try:
+                vid_data = await app.generate_video_async(
+                    row["spotify_url"], row["start_time"], row["end_time"], row["raw_image_path"],
+                    song_title=row["song_title"], font=row["font"], aspects=row["aspects"],
+                    image_source_type=row["image_source_type"],
+                    io_executor=io_pool, cpu_executor=render_pool, render_workers=args.segment_workers or None,
+                )
+                record.update({
+                    "status": "done",
+                    "vid_id": vid_data["id"],
+                    "final_video_paths": vid_data["final_video_paths"],
+                    "reused": bool(vid_data.get("reused")), # Rendered by an earlier run, found in the job store
+                    "stage_seconds": {} if vid_data.get("reused") else {name: timing["seconds"] for name, timing in vid_data["timings"].items() if name != "total"},
+                })
+            except Exception as e:
+                record.update({"status": "failed", "error": str(e)})
+            record["seconds"] = round(time.monotonic() - started, 3)
+            append_status(status_path, record)
+            results.append(record)
+            print(f"[{len(results)}/{len(rows)}] {record['status']:6s} {row['key']} in {record['seconds']:.1f}s" + (f": {record['error']}" if "error" in record else ""))
+            return record
+
+    try:
+        started = time.monotonic()
+        await asyncio.gather(*(run_row(row) for row in rows))
+        return results, time.monotonic() - started
+    finally:
+        io_pool.shutdown(wait=False, cancel_futures=True)
+        render_pool.shutdown(wait=True, cancel_futures=True)
+
+#REPORT
+
+def summarize(results, skipped, wall_seconds):
+    # skipped: {"done": rows done before, "failed": rows that failed before and were left out}
+    import cache
+    done = [r for r in results if r["status"] == "done"]
+    clip_seconds = sum(r["end_time"] - r["start_time"] for r in done)
+    stage_seconds = {}
+    for record in done:
+        for name, seconds in record["stage_seconds"].items():
+            stage_seconds[name] = stage_seconds.get(name, 0) + seconds
+    caches = {}
+    for (name, result), count in sorted(cache.CACHE_REQUESTS.values.items()):
+        caches.setdefault(name, {})[result] = count
+    row_seconds = [r["seconds"] for r in done]
+    return {
+        "rows": len(results) + sum(skipped.values()),
+        "skipped": skipped,
+        "done": len(done),
+        "failed": len(results) - len(done),
+        "wall_seconds": round(wall_seconds, 1),
+        "clips_per_minute": round(len(done) / wall_seconds * 60, 2) if wall_seconds else None,
+        "video_seconds_per_minute": round(clip_seconds / wall_seconds * 60, 1) if wall_seconds else None,
+        "row_seconds": {f"p{q}": metrics.percentile(row_seconds, q) for q in (50, 95)},
+        "stage_seconds": {name: round(seconds, 1) for name, seconds in stage_seconds.items()},
+        "caches": caches,
+    }
+
+def print_summary(summary):
+    print("\n--------------------")
+    skipped = summary["skipped"]
+    print(f"Rows: {summary['rows']}  done {summary['done']}  failed {summary['failed']}  skipped (done before) {skipped['done']}"
+          + (f"  skipped (failed before) {skipped['failed']}" if skipped["failed"] else ""))
+    print(f"Wall time: {summary['wall_seconds']}s  throughput: {summary['clips_per_minute']} clips/min, {summary['video_seconds_per_minute']} s of video/min")
+    stats = {key: "-" if value is None else f"{value:.1f}s" for key, value in summary["row_seconds"].items()}
+    print(f"Row time: p50 {stats['p50']}  p95 {stats['p95']}")
+    if summary["stage_seconds"]:
+        print("Stage time summed over rows: " + "  ".join(f"{name} {seconds}s" for name, seconds in summary["stage_seconds"].items()))
+    for name, counts in summary["caches"].items():
+        print(f"  {name:8s} cache " + "  ".join(f"{result} {count}" for result, count in counts.items()))
+    print("--------------------")
+
+def main(argv=None):
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Generate many videos from a CSV/JSON manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("--jobs", type=int, default=cores + 2, help="rows in flight at once (network stages overlap other rows' renders)")
+    parser.add_argument("--render-workers", type=int, default=cores, help="render processes shared by all rows")
+    parser.add_argument("--segment-workers", type=int, default=1, help="processes per render (time slices), 0: a share of the cores among the rows in flight; rows already run in parallel")
+    parser.add_argument("--network-workers", type=int, default=8, help="threads for downloads and API calls")
+    parser.add_argument("--status", help="status file (default: <manifest>.status.jsonl)")
+    parser.add_argument("--skip-failed", action="store_true", help="leave out rows that failed last time (by default they are tried again)")
+    parser.add_argument("--output", help="write the summary as JSON")
+    args = parser.parse_args(argv)
+
+    rows = load_manifest(args.manifest)
+    status_path = args.status or f"{args.manifest}.status.jsonl"
+    status = load_status(status_path)
+    finished = {"done", "failed"} if args.skip_failed else {"done"}
+    todo = [row for row in rows if status.get(row["key"], {}).get("status") not in finished]
+    skipped = {name: sum(1 for row in rows if status.get(row["key"], {}).get("status") == name and name in finished) for name in ("done", "failed")}
+    print(f"{len(rows)} rows, {skipped['done']} done before" + (f", {skipped['failed']} failed before and skipped" if args.skip_failed else "")
+          + f" ({status_path}), {len(todo)} to run")
+
+    results, wall_seconds = asyncio.run(run_batch(todo, args, status_path))
+    summary = summarize(results, skipped, wall_seconds)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(dict(summary, settings=vars(args), results=results), f, indent=4)
+        print(f"Summary written to {args.output}")
+    return 0 if summary["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
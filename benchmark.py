@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import lyrics
+
+try:
+    import resource # Peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+# Offline micro-benchmarks for the gen.py render stages. Everything is synthetic (background,
+# Sinhala lyrics, tone audio), so no network or API keys are needed. Each case runs in a fresh
+# process; its peak RSS is sampled while it runs, above what the imports and inputs hold.
+#
+#   python benchmark.py                                   # run everything, write benchmark_results.json
+#   python benchmark.py --baseline baseline.json          # compare, exit 1 on regressions
+#   python benchmark.py --only timed_text --fonts 1 2     # subset
+
+DEFAULT_RESULTS = "benchmark_results.json"
+DEFAULT_TOLERANCE = 0.10 # Slower/bigger than baseline by more than this is a regression
+RSS_SLACK_MB = 5 # RSS growth within this much of the baseline is sampling noise, not a regression
+
+CLIP_START = 30.0 # Clip window inside the synthetic track
+TRACK_SECONDS = 120
+LYRIC_LINE_SECONDS = 2.5
+
+# Common words of song lyrics; only the ones the converter fully maps (data_list.json) are used
+SINHALA_WORDS = [
+    "ආදරය", "හදවත", "මල", "සඳ", "රෑ", "ඔබ", "මගේ", "හීනය", "ගීතය", "නුඹ", "කඳුළු", "සිහිනය",
+    "පිපුණු", "වැස්ස", "සුළඟ", "අහස", "තරු", "ලස්සන", "සෙනෙහස", "ජීවිතය", "මතකය", "ශ්‍රී",
+    "ප්‍රේමය", "ක්‍රමයෙන්", "දෑස", "හිරු", "කිරිල්ලී", "ඈත", "ගම", "නිදි", "සීතල", "මීදුම",
+]
+
+def sinhala_vocabulary(target="fm"):
+    from sinhala_converter import convertor
+    covered = []
+    for word in SINHALA_WORDS:
+        converted = convertor(word, target)
+        if not any("඀" <= char <= "෿" for char in converted):
+            covered.append(word)
+    return covered
+
+def synthetic_lyrics(duration, seed=7):
+    # LRC-style entries ({"time": "mm:ss.xx", "lyric": ...}, as api.lyrics_to_json writes them) for
+    # the whole track, with an empty line now and then like real files
+    rng = np.random.default_rng(seed)
+    words = sinhala_vocabulary()
+    lyrics = []
+    t = 0.5
+    while t < duration:
+        if lyrics and rng.random() < 0.1:
+            text = ""
+        else:
+            text = " ".join(rng.choice(words, size=int(rng.integers(3, 9))))
+        mins, secs = divmod(t, 60)
+        lyrics.append({"time": f"{int(mins):02d}:{secs:05.2f}", "lyric": text})
+        t += LYRIC_LINE_SECONDS * float(rng.uniform(0.6, 1.6))
+    return lyrics
+
+def synthetic_background(path, width=1200, height=1600, seed=7):
+    # Smooth gradients plus some noise, roughly as hard to encode as a generated painting
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([
+        np.sin(x / 57) * 80 + 128,
+        np.cos(y / 71) * 80 + 128,
+        (x + y) / (width + height) * 200 + 30,
+    ], axis=-1)
+    image += rng.normal(0, 6, image.shape)
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path)
+    return path
+
+def synthetic_audio(path, duration):
+    import imageio_ffmpeg
+    cmd = [
+        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+        "-c:a", "libmp3lame", "-b:a", "128k", path,
+    ]
+    subprocess.run(cmd, check=True)
+    return path
+
+def prepare_inputs(workdir, duration):
+    import gen
+    inputs = {
+        "workdir": workdir,
+        "duration": duration,
+        "image": synthetic_background(os.path.join(workdir, "background.png")),
+        "audio": synthetic_audio(os.path.join(workdir, "track.mp3"), TRACK_SECONDS),
+        "lyrics": synthetic_lyrics(TRACK_SECONDS),
+    }
+    inputs["song_lyrics"] = lyrics.Lyrics.from_records(inputs["lyrics"]) # Parsed once, as the pipeline does
+    # Inputs for the later stages, built once and not timed
+    inputs["raw_video"] = gen.generate_raw_video(inputs["image"], duration, "bench_input", workdir=workdir)
+    inputs["text_entries"] = gen.time_adjust_for_lyrics(
+        CLIP_START, CLIP_START + duration, inputs["lyrics"], adjusted_time=0.10, workdir=workdir
+    )
+    inputs["clip"], inputs["clip_offset"], inputs["audio_fades"] = gen.cut_audio(
+        inputs["audio"], CLIP_START, CLIP_START + duration, "bench_input", workdir=workdir
+    )
+    return inputs
+
+#CASES: each returns (frames produced or None, paths written)
+
+def case_generate_raw_video(inputs, **_):
+    import gen
+    path = gen.generate_raw_video(inputs["image"], inputs["duration"], "bench", workdir=inputs["workdir"])
+    return int(inputs["duration"] * gen.FPS), [path]
+
+def case_time_adjust_for_lyrics(inputs, calls=200, **_):
+    import gen
+    for _ in range(calls):
+        gen.time_adjust_for_lyrics(CLIP_START, CLIP_START + inputs["duration"], inputs["song_lyrics"], adjusted_time=0.10, workdir=inputs["workdir"])
+    return None, [os.path.join(inputs["workdir"], "adjusted_lyrics.json")]
+
+def case_add_timed_text_to_video(inputs, font=1, position="mid", karaoke=False, **_):
+    import gen
+    output_path = os.path.join(inputs["workdir"], f"timed_{font}_{position}.mp4")
+    gen.add_timed_text_to_video(inputs["raw_video"], output_path, inputs["text_entries"], the_font=font, text_position=position, karaoke=karaoke)
+    return int(inputs["duration"] * gen.FPS), [output_path]
+
+def case_cut_audio(inputs, **_):
+    import gen
+    path, _, _ = gen.cut_audio(inputs["audio"], CLIP_START, CLIP_START + inputs["duration"], "bench", workdir=inputs["workdir"])
+    return None, [path]
+
+def case_add_audio_to_video(inputs, **_):
+    import gen
+    path = gen.add_audio_to_video(
+        inputs["raw_video"], inputs["clip"], "bench_mux",
+        audio_start=CLIP_START - inputs["clip_offset"], audio_duration=inputs["duration"], audio_fades=inputs["audio_fades"],
+    )
+    return int(inputs["duration"] * gen.FPS), [path]
+
+def case_render_video(inputs, font=1, position="mid", workers=1, karaoke=False, quality="final", aspects=None, **_):
+    # The single-pass path the bot uses, for comparison with the staged functions above
+    import gen
+    paths = gen.render_videos(
+        inputs["image"], inputs["text_entries"], inputs["clip"], CLIP_START, CLIP_START + inputs["duration"],
+        f"bench_render_{workers}", aspects=aspects or [gen.DEFAULT_ASPECT], the_font=font, text_position=position, workdir=inputs["workdir"],
+        audio_offset=inputs["clip_offset"], audio_fades=inputs["audio_fades"], workers=workers, karaoke=karaoke, quality=quality,
+    )
+    return int(inputs["duration"] * gen.render_tier(quality)["fps"]), list(paths.values())
+
+CASES = {
+    "raw_video": case_generate_raw_video,
+    "time_adjust": case_time_adjust_for_lyrics,
+    "timed_text": case_add_timed_text_to_video,
+    "cut_audio": case_cut_audio,
+    "add_audio": case_add_audio_to_video,
+    "render": case_render_video,
+}
+
+def plan_cases(only=None, fonts=(1, 2, 3, 4, 5), positions=("mid", "bottom"), workers=1):
+    plan = []
+    for group in CASES:
+        if only and group not in only:
+            continue
+        if group == "timed_text":
+            for font in fonts:
+                for position in positions:
+                    plan.append((f"timed_text/font{font}/{position}", group, {"font": font, "position": position}))
+            # Same overlay with the highlight sweep, against the static text above
+            plan.append((f"timed_text/font{fonts[0]}/{positions[0]}/karaoke", group, {"font": fonts[0], "position": positions[0], "karaoke": True}))
+        elif group == "render":
+            plan.append(("render/workers1", group, {"workers": 1}))
+            plan.append(("render/workers1/karaoke", group, {"workers": 1, "karaoke": True}))
+            plan.append(("render/draft", group, {"workers": 1, "karaoke": True, "quality": "draft"}))
+            plan.append(("render/workers1/all_aspects", group, {"workers": 1, "karaoke": True, "aspects": ["4:5", "9:16", "1:1", "16:9"]}))
+            if workers > 1:
+                plan.append((f"render/workers{workers}", group, {"workers": workers}))
+        else:
+            plan.append((group, group, {}))
+    return plan
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss_mb():
+    # Resident set right now (Linux), None elsewhere
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+class RSSSampler:
+    # Peak of the resident set while a case runs, sampled every few milliseconds. ru_maxrss
+    # can't be used for this: spawning the worker and importing gen (numpy, PIL, ...) already
+    # set a high-water mark that most cases never pass, so every case reported the same value.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stop = threading.Event()
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            rss = current_rss_mb()
+            if rss is not None and rss > self.peak_mb:
+                self.peak_mb = rss
+
+    def __enter__(self):
+        if self.start_mb is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        if self.thread.is_alive():
+            self.thread.join()
+            self.peak_mb = max(self.peak_mb, current_rss_mb() or 0)
+
+    def growth_mb(self):
+        # How far the case pushed the process above what it held before it started
+        return None if self.start_mb is None else round(self.peak_mb - self.start_mb, 1)
+
+def run_case(group, inputs, params):
+    # Runs in a fresh worker process, after gen is imported and the inputs unpickled, so the
+    # RSS it reports is the case's own
+    import gen
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        frames, paths = CASES[group](inputs, **params)
+        seconds = time.perf_counter() - start
+    bytes_written = sum(os.path.getsize(path) for path in paths if path and os.path.exists(path))
+    for path in paths:
+        if path and os.path.abspath(path).startswith(os.path.abspath("outputs")):
+            os.remove(path) # render_video/add_audio_to_video always write to outputs/
+    return {
+        "seconds": round(seconds, 4),
+        "frames": frames,
+        "fps": round(frames / seconds, 2) if frames else None,
+        "peak_rss_mb": rss.growth_mb(),
+        "baseline_rss_mb": None if rss.start_mb is None else round(rss.start_mb, 1),
+        "peak_child_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None, # ffmpeg
+        "bytes_written": bytes_written,
+    }
+
+def run_benchmarks(plan, inputs, repeat=1):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, group, params in plan:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(run_case, group, inputs, params).result())
+        best = min(runs, key=lambda run: run["seconds"])
+        best["runs"] = [run["seconds"] for run in runs]
+        results[name] = best
+        fps = f"{best['fps']:8.1f} fps" if best["fps"] else " " * 12
+        rss = f"{best['peak_rss_mb']:7.1f} MB" if best["peak_rss_mb"] is not None else ""
+        print(f"{name:32s} {best['seconds']:9.3f} s {fps} {rss} {best['bytes_written']:>12,d} B")
+    return results
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Returns the list of regressions: (case, metric, baseline value, new value)
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            slack = RSS_SLACK_MB if metric == "peak_rss_mb" else 0
+            if old.get(metric) and result.get(metric) and result[metric] > old[metric] * (1 + tolerance) + slack:
+                regressions.append((name, metric, old[metric], result[metric]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the gen.py render stages")
+    parser.add_argument("--duration", type=float, default=10, help="clip length in seconds")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--only", nargs="+", choices=list(CASES), help="case groups to run")
+    parser.add_argument("--fonts", nargs="+", type=int, default=[1, 2, 3, 4, 5])
+    parser.add_argument("--positions", nargs="+", default=["mid", "bottom"], choices=["mid", "bottom"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="also time render_video with this many segment workers")
+    parser.add_argument("--output", default=DEFAULT_RESULTS, help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic inputs and outputs")
+    args = parser.parse_args(argv)
+
+    os.makedirs("outputs", exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="lyrics_bench_")
+    try:
+        print(f"Preparing synthetic inputs in {workdir}...")
+        inputs = prepare_inputs(workdir, args.duration)
+        plan = plan_cases(args.only, args.fonts, args.positions, args.workers)
+        results = run_benchmarks(plan, inputs, repeat=args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "settings": {"duration": args.duration, "repeat": args.repeat, "clip_start": CLIP_START},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new} ({(new / old - 1) * 100:+.1f}%)")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
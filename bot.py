@@ -1,11 +1,15 @@
 import api
-import json
 import gen
 import os
-import time
+import asyncio
 import re
-import shutil
+import math
 import logging
+import jobs
+import metrics
+import pipeline
+import jobstore
+import workspace
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -47,111 +51,152 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 USER_DATA = {} # Simple in-memory store for user inputs
+LAST_BACKGROUND = {} # user_id -> image cache key of their last generated background
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or None # Default: one per CPU core
+RENDER_SEGMENT_WORKERS = int(os.getenv("RENDER_SEGMENT_WORKERS", "0")) or None # Per job cap, default: all cores
+SCHEDULER = jobs.JobScheduler(render_workers=RENDER_WORKERS)
+KARAOKE_HIGHLIGHT = os.getenv("KARAOKE_HIGHLIGHT", "0") == "1" # Word-by-word highlight sweep over the lyrics
+OUTPUT_ASPECTS = [aspect.strip() for aspect in os.getenv("OUTPUT_ASPECTS", gen.DEFAULT_ASPECT).split(",") if aspect.strip()] # Formats sent for every video
+DRAFT_PREVIEW = os.getenv("DRAFT_PREVIEW", "0") == "1" # Send a quick low resolution draft before the final video
+FINAL_RENDERS = {} # vid_id -> (user_id, cancel file) of jobs whose final render can still be aborted
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464")) # Prometheus text format at http://127.0.0.1:<port>/metrics, 0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+def find_previous_video(data):
+    # (fingerprint, image hash, record of the job that already rendered this request or None)
+    image_hash = jobstore.image_hash(data['image_source_type'], data.get('raw_image_path'), data.get('background_key'))
+    fingerprint = jobstore.request_fingerprint(
+        data['spotify_url'], data['start_time'], data['end_time'], data.get('font', 1), data['image_source_type'],
+        image_hash=image_hash, song_title=data.get('song_title'), aspects=OUTPUT_ASPECTS, karaoke=KARAOKE_HIGHLIGHT,
+    )
+    return fingerprint, image_hash, jobstore.JOB_STORE.lookup(fingerprint)
 
 def generate_video(spotify_url, start_time, end_time, raw_image_path, image_source_type, song_title=None, font=1):
-
-    #GET TIMESTAMP IN SEC
-    vid_id = int(time.time())
-
-    #DOWNLOAD AUDIO
+    # Blocking version of the whole pipeline (used outside the bot's event loop)
+    data = {'spotify_url': spotify_url, 'start_time': start_time, 'end_time': end_time, 'raw_image_path': raw_image_path,
+            'image_source_type': image_source_type, 'song_title': song_title, 'font': font}
+    fingerprint, image_hash, previous = find_previous_video(data)
+    if previous is not None:
+        return previous
+    vid_id = workspace.new_job_id()
+    workdir = workspace.create_workspace(vid_id)
+    jobstore.JOB_STORE.start(vid_id, spotify_url, start_time, end_time, font, image_source_type, fingerprint=fingerprint, image_hash=image_hash, song_title=song_title)
     try:
-        download_link, title = api.get_download_link_temp(spotify_url)
-    except:
-        download_link, title = api.get_download_link_temp(spotify_url)
-
-    if download_link == "":
-        download_link, title = api.get_download_link_temp(spotify_url)
-
-    audio_path = api.download_mp3(download_link, vid_id)
-    if song_title is None:
-        song_title = title
-
-    #GET LYRICS AS STRING (moved up to be available for image generation if needed)
-    lyrics_path = api.get_full_lyrics(song_title, vid_id)
-    with open(lyrics_path, 'r', encoding='utf-8') as f_lyrics:
-        lyrics_for_ghibli = json.load(f_lyrics)
-    lyrics_as_str = gen.get_lyrics_as_str(start_time, end_time, lyrics_for_ghibli)
-
-    # GENERATE GHIBLI IMAGE
-    # raw_image_path is from USER_DATA (bot_temp path) or the "LYRICS_BASED" marker
-    # image_source_type is passed as an argument from USER_DATA
-
-    final_raw_image_path_for_json = None # Will be set based on image_source_type
-
-    if image_source_type == "lyrics_based":
-        final_raw_image_path_for_json = "lyrics_based"
-        logger.info(f"Ghibli source: Lyrics based for song: {song_title}")
-        ghibli_image_path = api.make_ghibli_image(
-            image_path=None, vid_id=vid_id, lyrics_data=lyrics_as_str, source_type=image_source_type
+        context = pipeline.video_context(
+            vid_id, workdir, spotify_url, start_time, end_time, raw_image_path, image_source_type,
+            resolve_link=api.get_download_link_temp, song_title=song_title, font=font,
+            render_workers=RENDER_SEGMENT_WORKERS or os.cpu_count() or 1, karaoke=KARAOKE_HIGHLIGHT, aspects=OUTPUT_ASPECTS,
         )
-    elif image_source_type in ["raw_ghibli", "ghibli_char"]: # User provided a raw image
-        if not (raw_image_path and os.path.exists(raw_image_path) and raw_image_path != "LYRICS_BASED"):
-            raise ValueError(f"Raw image path '{raw_image_path}' is not valid for source type '{image_source_type}'")
-        
-        image_ext = raw_image_path.split(".")[-1]
-        copied_raw_image_name = f"raw_{vid_id}.{image_ext}"
-        destination_copied_raw_image = os.path.join('temp', copied_raw_image_name)
-        shutil.copy(raw_image_path, destination_copied_raw_image)
-        final_raw_image_path_for_json = destination_copied_raw_image
-
-        logger.info(f"Ghibli source ({image_source_type}): Raw image {final_raw_image_path_for_json}")
-        ghibli_image_path = api.make_ghibli_image(
-            image_path=final_raw_image_path_for_json, vid_id=vid_id, source_type=image_source_type
+        job = pipeline.build_video_pipeline(image_source_type, custom_title=song_title is not None)
+        context, timings = job.run_sync(context)
+    except Exception as e:
+        jobstore.JOB_STORE.fail(vid_id, e)
+        raise
+    finally:
+        workspace.release_workspace(vid_id)
+    # audio_path (full downloaded audio), lyrics_path and ghibli_image_path are kept
+    return jobstore.JOB_STORE.finish(pipeline.video_record(context, timings))
+
+async def send_videos(bot, chat_id, final_video_paths):
+    for aspect, video_path in final_video_paths.items():
+        with open(video_path, 'rb') as video_file:
+            await bot.send_video(chat_id, video=video_file, caption=aspect if len(final_video_paths) > 1 else None)
+
+async def run_generation_job(bot, chat_id, user_id, data, vid_id):
+    # Runs on a scheduler worker: the stage graph runs network stages in threads, rendering in the process pool
+    workdir = workspace.create_workspace(vid_id)
+    try:
+        await SCHEDULER.run_network(
+            jobstore.JOB_STORE.start, vid_id, data['spotify_url'], data['start_time'], data['end_time'], data.get('font', 1),
+            data['image_source_type'], fingerprint=data.get('fingerprint'), image_hash=data.get('image_hash'),
+            user_id=user_id, song_title=data.get('song_title'),
         )
-    else:
-        raise ValueError(f"Invalid raw_image_path or image_source_type for Ghibli generation: {raw_image_path}")
-    #CALCULATE DURATION
-    duration = end_time - start_time
-
-    #GENERATE RAW VIDEO     
-    raw_video_path = gen.generate_raw_video(ghibli_image_path, duration, vid_id)
-    cutted_audio_path = gen.cut_audio(audio_path, start_time, end_time, vid_id)
-    with open(lyrics_path, 'r', encoding='utf-8') as json_file:
-        lyrics = json.load(json_file)
-
-    #GENERATE FINAL VIDEO
-    text_extries = gen.time_adjust_for_lyrics(start_time, end_time, lyrics, adjusted_time=0.10)
-    # Use a temporary path for the video with text
-    temp_video_with_text_path = f"temp/text_video_initial_{vid_id}.mp4"
-    gen.add_timed_text_to_video(raw_video_path, temp_video_with_text_path, text_extries, text_position="mid", the_font=font)
-    final_video_path = gen.add_audio_to_video(temp_video_with_text_path, cutted_audio_path, vid_id)
-
-    #SAVE DATA
-    json_save_path = f"data/{vid_id}.json"
-    # Ensure all paths in vid_data are absolute or consistently relative for later use
-    # For simplicity, we are using paths relative to the script's execution directory.
-    # Consider making them absolute if the script or data might move.
-
-
-    vid_data = {
-        "id": vid_id,
-        "spotify_url": spotify_url,
-        "song_title": song_title,
-        "start_time": start_time,
-        "end_time": end_time,
-        "raw_image_path": final_raw_image_path_for_json, # Path to temp/raw_{vid_id}.ext or "lyrics_based"
-        "ghibli_image_path": ghibli_image_path,
-        "audio_path": audio_path,
-        "cutted_audio_path": cutted_audio_path,
-        "lyrics_path": lyrics_path,
-        "image_source_type": image_source_type,
-        "font": font,
-        "final_video_path": final_video_path
-    }
-    with open(json_save_path, 'w', encoding='utf-8') as json_file:
-        json.dump(vid_data, json_file, indent=4)
-
-    # Clean up intermediate files from the initial generation
-    if os.path.exists(raw_video_path): # This is the ghibli animated video without text/audio
-        os.remove(raw_video_path)
-    if os.path.exists(temp_video_with_text_path): # This is the video with text but no final audio
-        os.remove(temp_video_with_text_path)
-    # audio_path (full downloaded audio) and cutted_audio_path are kept as per vid_data
-    # lyrics_path and ghibli_image_path are also kept
-
-    return vid_data
+        context = pipeline.video_context(
+            vid_id,
+            workdir,
+            spotify_url=data['spotify_url'],
+            start_time=data['start_time'],
+            end_time=data['end_time'],
+            raw_image_path=data['raw_image_path'], # This is bot_temp path or "LYRICS_BASED"
+            image_source_type=data['image_source_type'],
+            resolve_link=api.get_download_link_temp, # Retried with backoff in http_client
+            song_title=data.get('song_title'), # Use .get() for optional song_title
+            font=data.get('font', 1), # Default to font 1 if not selected for some reason
+            background_key=data.get('background_key'),
+            render_workers=SCHEDULER.job_render_workers(RENDER_SEGMENT_WORKERS),
+            karaoke=KARAOKE_HIGHLIGHT,
+            aspects=OUTPUT_ASPECTS,
+        )
+        job = pipeline.build_video_pipeline(data['image_source_type'], custom_title=data.get('song_title') is not None, draft=DRAFT_PREVIEW)
+        FINAL_RENDERS[vid_id] = (user_id, context["cancel_path"])
+        draft_sent = []
+
+        def on_stage_done(stage_name, stage_context):
+            # The upload runs alongside the final render
+            if stage_name == "draft":
+                draft_sent.append(asyncio.create_task(send_draft(bot, chat_id, vid_id, stage_context["draft_video_path"])))
+
+        try:
+            context, timings = await job.run(context, io_executor=SCHEDULER.network_pool, cpu_executor=SCHEDULER.render_pool, on_stage_done=on_stage_done)
+        finally:
+            FINAL_RENDERS.pop(vid_id, None)
+            await asyncio.gather(*draft_sent) # The draft always arrives before the final video or the error
+        vid_data = pipeline.video_record(context, timings)
+        LAST_BACKGROUND[user_id] = vid_data["background_key"]
+        logger.info(f"Job {vid_id} stage timings: {timings}")
+        await SCHEDULER.run_network(jobstore.JOB_STORE.finish, vid_data)
+        jobs.JOBS.inc(status="completed")
+
+        await bot.send_message(chat_id, "Video generated successfully!")
+        await send_videos(bot, chat_id, vid_data["final_video_paths"])
+
+    except Exception as e:
+        if isinstance(e, pipeline.StageFailed) and isinstance(e.error, gen.RenderCancelled):
+            jobs.JOBS.inc(status="cancelled")
+            await SCHEDULER.run_network(jobstore.JOB_STORE.fail, vid_id, e.error, status="cancelled")
+            logger.info(f"Final render of job {vid_id} cancelled by user {user_id}")
+            await bot.send_message(chat_id, "Final render cancelled. Send /generate to try again.")
+            return
+        jobs.JOBS.inc(status="failed")
+        logger.error(f"Error generating video for user {user_id}: {e}", exc_info=True)
+        try:
+            await SCHEDULER.run_network(jobstore.JOB_STORE.fail, vid_id, e)
+        except Exception as store_error:
+            logger.warning(f"Could not record the failure of job {vid_id}: {store_error}")
+        await bot.send_message(chat_id, f"Sorry, an error occurred while generating the video: {e}")
+    finally:
+        workspace.release_workspace(vid_id) # The janitor evicts it once it is past its budget
+        # Clean up the downloaded image from bot_temp if it exists and is a path
+        user_raw_image_path = data.get('raw_image_path')
+        if user_raw_image_path and user_raw_image_path != "LYRICS_BASED" and os.path.exists(user_raw_image_path):
+            os.remove(user_raw_image_path)
+
+
 
+async def send_draft(bot, chat_id, vid_id, draft_video_path):
+    try:
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Cancel Final Render", callback_data=f"abort_{vid_id}")]])
+        with open(draft_video_path, 'rb') as video_file:
+            await bot.send_video(
+                chat_id, video=video_file, reply_markup=keyboard,
+                caption="Draft preview (low quality). The full quality video is rendering now; if the time window or font is wrong, cancel it and start again.",
+            )
+    except Exception as e:
+        logger.warning(f"Could not send the draft of job {vid_id}: {e}")
 
+async def abort_final_render(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stops the final render of the job whose draft the button belongs to."""
+    query = update.callback_query
+    vid_id = query.data[len("abort_"):]
+    render = FINAL_RENDERS.get(vid_id)
+    if render is None or render[0] != query.from_user.id:
+        await query.answer("This video is already finished.")
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+    open(render[1], "w").close() # The render checks for this file every few frames
+    await query.answer("Cancelling the final render...")
+    await query.edit_message_reply_markup(reply_markup=None)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message when the /start command is issued."""
@@ -194,6 +239,9 @@ async def times_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             [InlineKeyboardButton("Raw To Ghibli", callback_data="img_src_raw_ghibli")],
             [InlineKeyboardButton("Ghibili Using Raw Character", callback_data="img_src_ghibli_char")],
         ]
+        previous_background = LAST_BACKGROUND.get(user_id)
+        if previous_background and api.has_cached_image(previous_background):
+            keyboard.append([InlineKeyboardButton("Reuse Previous Background", callback_data="img_src_reuse")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             "Got the times! Now, how do you want to generate the background image?",
@@ -222,6 +270,17 @@ async def image_source_option_chosen(update: Update, context: ContextTypes.DEFAU
             reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True),
         )
         return FONT_SELECTION
+    elif choice == "img_src_reuse" and LAST_BACKGROUND.get(user_id):
+        USER_DATA[user_id]['image_source_type'] = 'reuse'
+        USER_DATA[user_id]['raw_image_path'] = "REUSED" # Special marker
+        USER_DATA[user_id]['background_key'] = LAST_BACKGROUND[user_id]
+        await query.edit_message_text(text="Okay, will reuse your previous background.")
+        reply_keyboard = [["1", "2", "3", "4", "5"]]
+        await query.message.reply_text(
+            "Please select a font for the lyrics (1-5).",
+            reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True),
+        )
+        return FONT_SELECTION
     elif choice in ["img_src_raw_ghibli", "img_src_ghibli_char"]:
         USER_DATA[user_id]['image_source_type'] = 'raw_ghibli' if choice == "img_src_raw_ghibli" else 'ghibli_char'
         await query.edit_message_text(text="Great! Please send the raw image you want to use.")
@@ -238,9 +297,9 @@ async def image_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not os.path.exists(bot_temp_dir):
         os.makedirs(bot_temp_dir)
         
-    image_path = os.path.join(bot_temp_dir, f"{user_id}_{int(time.time())}.jpg")
+    image_path = os.path.join(bot_temp_dir, f"{user_id}_{workspace.new_job_id()}.jpg")
     await photo_file.download_to_drive(image_path)
-    # This raw_image_path is from bot_temp, will be copied to temp/raw_{vid_id} later if used
+    # This raw_image_path is from bot_temp, will be copied to the job workspace later if used
     USER_DATA[user_id]['raw_image_path'] = image_path
 
     reply_keyboard = [["1", "2", "3", "4", "5"]]
@@ -297,38 +356,40 @@ async def custom_song_title_received(update: Update, context: ContextTypes.DEFAU
     return await process_generation(update, context)
 
 async def process_generation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Processes the video generation and sends the result."""
+    """Queues the video generation; the result is sent when a render worker finishes it."""
     user_id = update.message.from_user.id
-    data = USER_DATA[user_id]
+    data = USER_DATA.pop(user_id) # The job owns the inputs now, the user can start a new conversation
+    vid_id = workspace.new_job_id()
+
+    # The same request rendered before (by anyone) is answered right away
+    data['fingerprint'], data['image_hash'], previous = await SCHEDULER.run_network(find_previous_video, data)
+    if previous is not None:
+        await update.message.reply_text("This video was made before, here it is!")
+        await send_videos(context.bot, update.effective_chat.id, previous["final_video_paths"])
+        if previous.get("background_key"):
+            LAST_BACKGROUND[user_id] = previous["background_key"]
+        await SCHEDULER.run_network(jobstore.JOB_STORE.reuse, vid_id, previous, user_id=user_id)
+        jobs.JOBS.inc(status="reused")
+        user_raw_image_path = data.get('raw_image_path')
+        if user_raw_image_path and user_raw_image_path != "LYRICS_BASED" and os.path.exists(user_raw_image_path):
+            os.remove(user_raw_image_path)
+        return ConversationHandler.END
 
     try:
-        vid_data = generate_video(
-            spotify_url=data['spotify_url'],
-            start_time=data['start_time'],
-            end_time=data['end_time'],
-            raw_image_path=data['raw_image_path'], # This is bot_temp path or "LYRICS_BASED"
-            image_source_type=data['image_source_type'],
-            song_title=data.get('song_title'), # Use .get() for optional song_title
-            font=data.get('font', 1) # Default to font 1 if not selected for some reason
-        )
-        final_video_path = vid_data["final_video_path"]
-        vid_id = vid_data["id"]
-
-        await update.message.reply_text("Video generated successfully!")
-        await update.message.reply_video(video=open(final_video_path, 'rb'))
-
-    except Exception as e:
-        logger.error(f"Error generating video for user {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(f"Sorry, an error occurred while generating the video: {e}")
-        return ConversationHandler.END # Ensure conversation ends on error
-    finally:
-        # Clean up the downloaded image from bot_temp if it exists and is a path
+        position, wait_seconds = SCHEDULER.submit(vid_id, run_generation_job, context.bot, update.effective_chat.id, user_id, data, vid_id)
+    except jobs.JobQueueFull:
         user_raw_image_path = data.get('raw_image_path')
         if user_raw_image_path and user_raw_image_path != "LYRICS_BASED" and os.path.exists(user_raw_image_path):
-            os.remove(data['raw_image_path'])
-        if user_id in USER_DATA:
-            del USER_DATA[user_id] # Clean up user data
+            os.remove(user_raw_image_path)
+        await update.message.reply_text("Sorry, too many videos are being generated right now. Please try again in a few minutes.")
+        return ConversationHandler.END
 
+    if wait_seconds == 0:
+        await update.message.reply_text("Your video is being generated now.")
+    else:
+        await update.message.reply_text(
+            f"Your video is #{position} in the queue. Estimated wait: about {math.ceil(wait_seconds / 60)} min."
+        )
     return ConversationHandler.END
 
 
@@ -346,13 +407,32 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return ConversationHandler.END
 
-def main() -> None:
-    """Run the bot."""
-    if TELEGRAM_BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
-        logger.error("Please set your TELEGRAM_BOT_TOKEN in the script.")
-        return
-
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+JANITOR = workspace.Janitor(on_evict=jobstore.JOB_STORE.expire) # Evicted videos are no longer offered for reuse
+METRICS_SERVER = None
+
+async def start_scheduler(application: Application) -> None:
+    global METRICS_SERVER
+    await SCHEDULER.start()
+    JANITOR.start()
+    if METRICS_PORT:
+        try:
+            METRICS_SERVER = metrics.start_exporter(METRICS_PORT, METRICS_HOST)
+        except OSError as e:
+            logger.warning(f"Metrics exporter not started on port {METRICS_PORT}: {e}")
+
+async def stop_scheduler(application: Application) -> None:
+    JANITOR.stop()
+    await SCHEDULER.stop()
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.shutdown()
+
+def build_application(token, request=None) -> Application:
+    """Builds the bot with all its handlers. request: a telegram.request.BaseRequest to talk to
+    something other than the Telegram Bot API (loadtest.py passes a local fake)."""
+    builder = Application.builder().token(token).post_init(start_scheduler).post_shutdown(stop_scheduler)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -373,7 +453,16 @@ def main() -> None:
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(abort_final_render, pattern="^abort_"))
+    return application
+
+def main() -> None:
+    """Run the bot."""
+    if TELEGRAM_BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
+        logger.error("Please set your TELEGRAM_BOT_TOKEN in the script.")
+        return
 
+    application = build_application(TELEGRAM_BOT_TOKEN)
     logger.info("Bot started. Press Ctrl-C to stop.")
     application.run_polling()
 
@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_ROOT = os.getenv("CACHE_DIR", "cache")
+MB = 1024 * 1024
+
+META_FILE = "meta.json"
+
+CACHE_REQUESTS = metrics.counter("lyrics_cache_requests_total", "Cache lookups by cache and result (hit, miss; lyrics also fuzzy_hit and negative_hit).", ["cache", "result"])
+
+def hash_key(*parts):
+    # Stable content address for any mix of strings/bytes/numbers
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_or_copy(src, dst):
+    # Hard link when possible (same filesystem), otherwise copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+class SingleFlight:
+    # Concurrent calls for the same key wait for the first one and share its result
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+
+class DiskLRUCache:
+    # One directory per entry under cache/<name>/, holding the entry's files and a meta.json.
+    # The meta.json mtime is the entry's last use; the least recently used entries are
+    # evicted when the cache grows past max_bytes.
+    def __init__(self, name, max_bytes, root=None):
+        self.name = name
+        self.root = os.path.join(root or CACHE_ROOT, name)
+        self.max_bytes = max_bytes
+        self.flight = SingleFlight()
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry_dir(self, key):
+        if not re.fullmatch(r"[A-Za-z0-9_.-]{1,80}", key) or key.startswith("."):
+            key = hash_key(key)
+        return os.path.join(self.root, key)
+
+    def path(self, key, name):
+        return os.path.join(self.entry_dir(key), name)
+
+    def get(self, key, count=True):
+        # Returns the entry's meta dict (with its directory under "dir") or None.
+        # count=False: an internal re-check, left out of the hit/miss counters
+        meta = self.read_entry(key)
+        if count:
+            CACHE_REQUESTS.inc(cache=self.name, result="miss" if meta is None else "hit")
+        return meta
+
+    def read_entry(self, key):
+        entry_dir = self.entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # An entry whose files went missing or were truncated is a miss
+        for name, size in meta.get("files", {}).items():
+            file_path = os.path.join(entry_dir, name)
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+                logger.warning(f"Cache entry {entry_dir} is damaged, dropping it")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+
+        try:
+            os.utime(meta_path) # Mark as recently used
+        except OSError:
+            pass
+        meta["dir"] = entry_dir
+        return meta
+
+    def put(self, key, create):
+        # create(tmp_dir) writes the entry's files into tmp_dir and returns a meta dict.
+        # The finished directory is renamed into place so readers never see half an entry.
+        entry_dir = self.entry_dir(key)
+        tmp_dir = os.path.join(self.root, f".tmp_{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            meta = create(tmp_dir) or {}
+            meta["key"] = key
+            meta["created"] = time.time()
+            meta["files"] = {
+                name: os.path.getsize(os.path.join(tmp_dir, name))
+                for name in os.listdir(tmp_dir)
+            }
+            with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=4)
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # Another process stored the same entry first, keep theirs
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+        return self.get(key, count=False)
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def get_or_create(self, key, create, count=True):
+        # Returns (meta, hit). Concurrent misses for the same key only run create once.
+        meta = self.get(key, count=count)
+        if meta is not None:
+            return meta, True
+
+        def fill():
+            existing = self.get(key, count=False)
+            if existing is not None:
+                return existing
+            return self.put(key, create)
+
+        return self.flight.do(key, fill), False
+
+    def entries(self):
+        result = []
+        for name in os.listdir(self.root):
+            if name.startswith("."):
+                continue
+            entry_dir = os.path.join(self.root, name)
+            meta_path = os.path.join(entry_dir, META_FILE)
+            try:
+                last_used = os.path.getmtime(meta_path)
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            except OSError:
+                continue
+            result.append((last_used, size, entry_dir))
+        return result
+
+    def evict(self):
+        if self.max_bytes is None:
+            return []
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            evicted = []
+            for last_used, size, entry_dir in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                evicted.append(entry_dir)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} entries from {self.root}")
+        return evicted
+
+#AUDIO: keyed by the normalized Spotify track ID
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MB", "2048")) * MB
+AUDIO_CACHE = DiskLRUCache("audio", AUDIO_CACHE_MAX_BYTES)
+
+#LINKS: resolved (download link, title) per Spotify track ID, so a new window of a known track
+# skips the resolver. Download links expire; titles don't.
+LINK_TTL = int(os.getenv("AUDIO_LINK_TTL", "3600")) # Seconds a resolved download link is reused
+LINK_CACHE = DiskLRUCache("links", 16 * MB)
+
+def spotify_track_id(spotify_url):
+    # https://open.spotify.com/(intl-xx/)track/<id>?si=..., spotify:track:<id>
+    match = re.search(r"track[/:]([A-Za-z0-9]{22})", spotify_url)
+    if match:
+        return match.group(1)
+    return hash_key(spotify_url.strip())
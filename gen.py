@@ -1,124 +1,234 @@
 import cv2
 import json
 import os
+import re
 import math
-from sinhala_converter import convertor
-import platform
+import time
+import mp3
+import metrics
+from lyrics import as_lyrics
+from sinhala_converter import convert_lines
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
-
-#CHECK THE OS
-system = platform.system()
-system = "Darwin"
-if system == "Windows":
-    from moviepy import ImageClip, CompositeVideoClip, VideoFileClip, AudioFileClip
-elif system == "Darwin":
-    from moviepy.editor import ImageClip, CompositeVideoClip, VideoFileClip, AudioFileClip
-
-def generate_raw_video(image_path, duration, vid_id):
-    save_path = f"temp/raw_{vid_id}.mp4"
-
-    # --- Configuration ---
-    frame_width = 720 # Video width
-    frame_height = 900 # Video height
-    fps = 60 # Frames per second
-
-    # Wave motion configuration
-    vertical_speed = 0.25  # Default: 0.25 Controls how fast the image moves vertically
-    horizontal_oscillations = 2.0  # Default 2.0 Number of horizontal oscillations per vertical cycle
-    wave_amplitude = 0.4  # Default: 0.4 Controls the width of the wave
-    wave_height = 0.5  # Default: 0.5 Controls the height of the wave 
-
-    # Check if input image exists
+import subprocess
+import queue
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import imageio_ffmpeg
+from fractions import Fraction
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# --- Output Configuration ---
+FRAME_WIDTH = 720 # Video width
+FRAME_HEIGHT = 900 # Video height
+FPS = 60 # Frames per second
+
+# Wave motion configuration
+VERTICAL_SPEED = 0.25  # Default: 0.25 Controls how fast the image moves vertically
+HORIZONTAL_OSCILLATIONS = 2.0  # Default 2.0 Number of horizontal oscillations per vertical cycle
+WAVE_AMPLITUDE = 0.4  # Default: 0.4 Controls the width of the wave
+WAVE_HEIGHT = 0.5  # Default: 0.5 Controls the height of the wave
+SCALE_FACTOR = 0.8 # Default: 0.8
+
+# Background cycle cache (one period of the wave motion)
+PAN_CACHE_MEMORY_BYTES = 256 * 1024 * 1024 # Above this the cycle is memory-mapped instead of held in RAM
+PAN_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Above this the cycle is not cached at all
+
+# Encoding
+GOP_FRAMES = 2 * FPS # Fixed keyframe interval, parallel segments are cut on these boundaries
+MIN_SEGMENT_SECONDS = 4 # Shorter segments aren't worth starting a worker process for
+
+# Render quality tiers: the draft is a quick low resolution check of the time window and
+# font, the final render is the full quality video
+QUALITY_TIERS = {
+    "final": {"scale": 1.0, "fps": FPS, "preset": "medium"},
+    "draft": {"scale": 0.5, "fps": 24, "preset": "ultrafast"},
+}
+CANCEL_CHECK_SECONDS = 0.25 # How often (in video time) a render looks for its cancel file
+
+# Output formats, (width, height) at the final quality. One render pass can produce several,
+# each with its own pan window and lyric placement over the shared background and lyrics.
+DEFAULT_ASPECT = "4:5"
+ASPECT_SIZES = {
+    "4:5": (FRAME_WIDTH, FRAME_HEIGHT),
+    "9:16": (720, 1280), # Reels / Shorts
+    "1:1": (720, 720), # Feeds
+    "16:9": (1280, 720), # YouTube
+}
+PAN_COVER_MARGIN = 1.1 # Other formats scale the background up until it is this much larger than the frame
+ENCODER_QUEUE_FRAMES = 4 # Frames buffered per encoder when several formats render together
+
+# Audio
+DECLICK_FADE = 0.015 # Seconds of fade on clip edges cut out of the middle of a track
+
+class RenderCancelled(Exception):
+    pass
+
+def render_tier(quality="final", aspect=DEFAULT_ASPECT):
+    # Frame size, frame rate, encoder preset and GOP of a quality tier in one output format;
+    # scale applies to the pan image and the lyric layout as well, so a draft looks like a
+    # small final render
+    tier = dict(QUALITY_TIERS[quality])
+    width, height = ASPECT_SIZES[aspect]
+    tier["width"] = 2 * round(width * tier["scale"] / 2) # yuv420p needs even sizes
+    tier["height"] = 2 * round(height * tier["scale"] / 2)
+    tier["gop"] = 2 * tier["fps"]
+    return tier
+
+def output_path(quality, vid_id, aspect=DEFAULT_ASPECT):
+    # outputs/final_{vid_id}.mp4 for the original format, outputs/final_{vid_id}_9x16.mp4 etc.
+    if aspect == DEFAULT_ASPECT:
+        return f"outputs/{quality}_{vid_id}.mp4"
+    return f"outputs/{quality}_{vid_id}_{aspect.replace(':', 'x')}.mp4"
+
+def check_cancelled(cancel_path):
+    # Long renders stop when their cancel file shows up (it can be created from any process)
+    if cancel_path and os.path.exists(cancel_path):
+        raise RenderCancelled(f"Render cancelled ({cancel_path} exists)")
+
+def load_pan_image(image_path, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT, scale_factor=SCALE_FACTOR):
+    # Decode and pre-scale the background once, every frame is a window into this array
+    return fit_pan_image(decode_image(image_path), frame_width, frame_height, scale_factor)
+
+def decode_image(image_path):
     if not os.path.exists(image_path):
         print(f"Error: Input image not found at '{image_path}'")
-        exit()
-    else:
-        # Load the image
-        print(f"Loading image: {image_path}")
-        clip = ImageClip(image_path)
-        img_w, img_h = clip.w, clip.h
-        print(f"Original image dimensions: {img_w}x{img_h}")
+        raise FileNotFoundError(image_path)
+
+    print(f"Loading image: {image_path}")
+    image = np.asarray(Image.open(image_path).convert("RGB"))
+    img_h, img_w = image.shape[:2]
+    print(f"Original image dimensions: {img_w}x{img_h}")
+    return image
+
+def pan_scale_factor(image, tier, aspect=DEFAULT_ASPECT):
+    # The original format keeps its fixed scale; the others are scaled up as far as needed to
+    # leave some room for the pan (a 16:9 frame is wider than the portrait backgrounds)
+    scale_factor = SCALE_FACTOR * tier["scale"]
+    if aspect == DEFAULT_ASPECT:
+        return scale_factor
+    img_h, img_w = image.shape[:2]
+    return max(scale_factor, PAN_COVER_MARGIN * max(tier["width"] / img_w, tier["height"] / img_h))
+
+def fit_pan_image(image, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT, scale_factor=SCALE_FACTOR):
+    img_h, img_w = image.shape[:2]
 
     # Resize the image
-    scale_factor = 0.8 # Default: 0.8
     new_w = int(img_w * scale_factor)
     new_h = int(img_h * scale_factor)
-
     print(f"Scaling image by {scale_factor:.2f}x -> new size: {new_w}x{new_h}")
-    if system == "Windows":
-        clip = clip.resized(width=new_w)
-    else:
-        clip = clip.resize(width=new_w) # Resize based on new width, maintains aspect ratio
-    # Update dimensions after resizing
-    current_img_w, current_img_h = clip.w, clip.h # Use clip.w, clip.h directly
-    print(f"Image dimensions for animation: {current_img_w}x{current_img_h}")
+    interpolation = cv2.INTER_AREA if scale_factor < 1 else cv2.INTER_LINEAR
+    image = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
 
     # Check if the scaled image is actually larger than the frame (important for radius calc)
-    if current_img_w <= frame_width or current_img_h <= frame_height:
+    if new_w <= frame_width or new_h <= frame_height:
         print("Warning: Scaled image is not larger than the frame. Panning effect might be limited or absent.")
+        # Centre it on a black canvas of at least frame size, like the old compositor did
+        pad_w = max(0, frame_width - new_w)
+        pad_h = max(0, frame_height - new_h)
+        image = cv2.copyMakeBorder(image, pad_h // 2, pad_h - pad_h // 2, pad_w // 2, pad_w - pad_w // 2, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+
+    return np.ascontiguousarray(image)
+
+def compute_pan_path(img_w, img_h, times, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT):
+    # Vectorized version of the old per-frame get_position_smooth(t).
+    # Returns the top-left corner of the frame window inside the image for every time.
+    times = np.asarray(times, dtype=np.float64)
+
+    max_x_movement = max(0, (img_w - frame_width) / 2)
+    max_y_movement = max(0, (img_h - frame_height) / 2)
+
+    base_range = min(max_x_movement, max_y_movement)
+    x_movement_range = max(0, base_range * WAVE_AMPLITUDE)
+    y_movement_range = max(0, base_range * WAVE_HEIGHT)
+
+    angle = 2 * math.pi * VERTICAL_SPEED * times
+    vertical_position = -y_movement_range * np.cos(angle)
+    horizontal_position = x_movement_range * np.sin(HORIZONTAL_OSCILLATIONS * angle)
+
+    # The image moves by +offset, so the window over it moves by -offset
+    left = (img_w - frame_width) / 2 - horizontal_position
+    top = (img_h - frame_height) / 2 - vertical_position
+    return left, top
+
+def pan_frame(image, left, top, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT, subpixel=False):
+    if subpixel:
+        # Bilinear sub-pixel window (a new array)
+        center = (left + (frame_width - 1) / 2, top + (frame_height - 1) / 2)
+        return cv2.getRectSubPix(image, (frame_width, frame_height), center)
+
+    # Zero-copy view into the pre-scaled image
+    img_h, img_w = image.shape[:2]
+    x = min(max(int(math.floor(left)), 0), img_w - frame_width)
+    y = min(max(int(math.floor(top)), 0), img_h - frame_height)
+    return image[y:y+frame_height, x:x+frame_width]
+
+def motion_period_frames(fps=FPS, vertical_speed=VERTICAL_SPEED, horizontal_oscillations=HORIZONTAL_OSCILLATIONS):
+    # The motion repeats when both vertical_speed*t and horizontal_oscillations*vertical_speed*t
+    # are whole numbers. Returns the number of frames after which frames repeat exactly.
+    if vertical_speed == 0:
+        return 1 # No motion at all
+    vs = abs(Fraction(vertical_speed).limit_denominator(1000))
+    ho = Fraction(horizontal_oscillations).limit_denominator(1000)
+    period_seconds = ho.denominator / vs
+    period = period_seconds * Fraction(fps).limit_denominator(1001)
+    # If one cycle is not a whole number of frames, several cycles are (period.denominator of them)
+    return period.numerator
+
+def allocate_frame_cache(n_frames, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT, workdir="temp"):
+    shape = (n_frames, frame_height, frame_width, 3)
+    size = n_frames * frame_height * frame_width * 3
+    if size > PAN_CACHE_MAX_BYTES:
+        return None
+    if size > PAN_CACHE_MEMORY_BYTES:
+        os.makedirs(workdir, exist_ok=True)
+        return np.memmap(tempfile.TemporaryFile(dir=workdir), dtype=np.uint8, mode="w+", shape=shape)
+    return np.empty(shape, dtype=np.uint8)
+
+def iter_pan_frames(image, n_frames, fps=FPS, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT, subpixel=False, reuse_period=True, workdir="temp", first_frame=0):
+    # Frames first_frame .. first_frame + n_frames - 1 of the pan.
+    # Only one motion cycle is computed; later frames reuse it (i % period)
+    img_h, img_w = image.shape[:2]
+    period = motion_period_frames(fps) if reuse_period else first_frame + n_frames
+    period = max(1, min(period, first_frame + n_frames))
+    lefts, tops = compute_pan_path(img_w, img_h, np.arange(period) / fps, frame_width, frame_height)
+
+    # Integer windows are already free views, only sub-pixel frames are worth caching
+    cache = None
+    if subpixel and period < n_frames:
+        cache = allocate_frame_cache(period, frame_width, frame_height, workdir=workdir)
+        cached = np.zeros(period, dtype=bool)
+
+    for i in range(first_frame, first_frame + n_frames):
+        k = i % period
+        if cache is not None and cached[k]:
+            yield cache[k]
+            continue
+        frame = pan_frame(image, lefts[k], tops[k], frame_width, frame_height, subpixel=subpixel)
+        if cache is not None:
+            cache[k] = frame
+            cached[k] = True
+        yield frame
 
-    def get_position_smooth(t):
-        center_x = frame_width / 2
-        center_y = frame_height / 2
-
-        max_x_movement = (current_img_w - frame_width) / 2
-        max_y_movement = (current_img_h - frame_height) / 2
-
-        max_x_movement = max(0, max_x_movement)
-        max_y_movement = max(0, max_y_movement)
-
-        base_range = min(max_x_movement, max_y_movement)
-        x_movement_range = base_range * wave_amplitude
-        y_movement_range = base_range * wave_height
-
-        x_movement_range = max(0, x_movement_range)
-        y_movement_range = max(0, y_movement_range)
-
-        angle = 2 * math.pi * vertical_speed * t
-
-        vertical_position = -y_movement_range * math.cos(angle)
-
-        horizontal_position = x_movement_range * math.sin(horizontal_oscillations * angle)
-
-        image_center_x = center_x + horizontal_position
-        image_center_y = center_y + vertical_position
-
-        final_x = image_center_x - current_img_w / 2
-        final_y = image_center_y - current_img_h / 2
-
-        return (final_x, final_y)
+def generate_raw_video(image_path, duration, vid_id, subpixel=False, workdir="temp"):
+    save_path = os.path.join(workdir, f"raw_{vid_id}.mp4")
+    fps = FPS
 
-    # Set the duration of the ImageClip
-    if system == "Windows":
-        clip = clip.with_duration(duration)
-    else:
-        clip = clip.set_duration(duration)
-
-    # Apply the time-varying position
-    if system == "Windows":
-        moving_image = clip.with_position(get_position_smooth)
-    else:                                     
-        moving_image = clip.set_position(get_position_smooth)
-
-    # Create a CompositeVideoClip to ensure the final video dimensions are correct
-    print(f"Creating final video canvas with size: {frame_width}x{frame_height}")
-    final_clip = CompositeVideoClip([moving_image], size=(frame_width, frame_height))
-    if system == "Windows":
-        final_clip = final_clip.with_duration(duration)
-    else:
-        final_clip = final_clip.set_duration(duration)
+    image = load_pan_image(image_path)
+    n_frames = int(duration * fps)
 
     # Write the video file to MP4
     print(f"Writing video to '{save_path}' (Duration: {duration}s, FPS: {fps})...")
     try:
-        final_clip.write_videofile(
-            save_path,
-            fps=fps,
-            codec='libx264',
-            audio=False # No audio in this case
-            )
+        proc = open_video_writer(save_path, FRAME_WIDTH, FRAME_HEIGHT, fps)
+        try:
+            for frame in timed_frames(iter_pan_frames(image, n_frames, fps, subpixel=subpixel, workdir=workdir), "pan"):
+                proc.stdin.write(np.ascontiguousarray(frame))
+        finally:
+            close_video_writer(proc)
         # Print success message
         print("\n--------------------")
         print(f"Raw video '{save_path}' created successfully!")
@@ -128,126 +238,301 @@ def generate_raw_video(image_path, duration, vid_id):
     except Exception as e:
         print("\n--------------------")
         print(f"An error occurred during raw video writing: {e}")
-        print("Please ensure FFMPEG is installed and accessible by MoviePy.")
-        print("You might need to install it separately or ensure it's in your system's PATH.")
+        print("Please ensure FFMPEG is installed and accessible.")
         print("--------------------")
- 
-def time_adjust_for_lyrics(start_time, end_time, lyrics, adjusted_time=0.30):
-    for i, lyric in enumerate(lyrics):
-        txt = lyric["lyric"]
-        if txt == "":
-            if i == len(lyrics) - 1:
-                continue # LAST ITEM SO DON'T REMOVE IT EVEN IT'S EMPTY
-            else:
-                lyrics.remove(lyric)
-                continue
-
-    finalized_lyrics = []
-    should_break = False
-    transition_time = 0
-
-    for i, lyric in enumerate(lyrics):
-        l_start_str = lyric["time"]
-        mins, secs = l_start_str.split(":")
-        l_start = int(mins) * 60 + float(secs)
-        if l_start < start_time:
-            continue
-        l_start = l_start - start_time
-        l_start = l_start + adjusted_time
-        
-        next_lyric = lyrics[i + 1]
-        next_l_start_str = next_lyric["time"]
-        next_mins, next_secs = next_l_start_str.split(":")
-        next_l_start = int(next_mins) * 60 + float(next_secs)
-        
-        if next_l_start >= end_time:
-            l_end = end_time - start_time
-            should_break = True
-        else:
-            l_end = (next_l_start - transition_time) - start_time
-
-        finalized_lyrics.append({
-            "start_time": l_start,
-            "end_time": l_end,
-            "text": lyric["lyric"]
-        })
-
-        if should_break:
-            break
 
-    with open('temp/adjusted_lyrics.json', 'w', encoding='utf-8') as json_file:
-        json.dump(finalized_lyrics, json_file, ensure_ascii=False, indent=4)
+def time_adjust_for_lyrics(start_time, end_time, lyrics, adjusted_time=0.30, workdir="temp"):
+    # lyrics: lyrics.Lyrics, LRC text or [{"time": "mm:ss.xx", "lyric": str}]
+    text_entries, _ = as_lyrics(lyrics).clip(start_time, end_time, adjusted_time)
 
-    return finalized_lyrics
+    with open(os.path.join(workdir, 'adjusted_lyrics.json'), 'w', encoding='utf-8') as json_file:
+        json.dump(text_entries, json_file, ensure_ascii=False, indent=4)
+
+    return text_entries
 
 def get_lyrics_as_str(start_time, end_time, lyrics):
-    for i, lyric in enumerate(lyrics):
-        txt = lyric["lyric"]
-        if txt == "":
-            if i == len(lyrics) - 1:
-                continue # LAST ITEM SO DON'T REMOVE IT EVEN IT'S EMPTY
-            else:
-                lyrics.remove(lyric)
-                continue
-
-    finalized_lyrics_str = ""
-    should_break = False
-    transition_time = 0
-
-    for i, lyric in enumerate(lyrics):
-        l_start_str = lyric["time"]
-        mins, secs = l_start_str.split(":")
-        l_start = int(mins) * 60 + float(secs)
-        if l_start < start_time:
-            continue
-        l_start = l_start - start_time
-        
-        next_lyric = lyrics[i + 1]
-        next_l_start_str = next_lyric["time"]
-        next_mins, next_secs = next_l_start_str.split(":")
-        next_l_start = int(next_mins) * 60 + float(next_secs)
-        
-        if next_l_start >= end_time:
-            l_end = end_time - start_time
-            should_break = True
-        else:
-            l_end = (next_l_start - transition_time) - start_time
-
-        finalized_lyrics_str += f"{lyric['lyric']}\n"
-
-        if should_break:
-            break
+    _, lyrics_str = as_lyrics(lyrics).clip(start_time, end_time)
+    return lyrics_str
 
-    return finalized_lyrics_str
+MAX_LINE_CHAR_LENGTH = 35 # Define the character limit for wrapping
+LINE_SPACING = 10
+SHADOW_OFFSET = 2
 
-def add_timed_text_to_video(input_path, output_path, text_entries, the_font=1, text_position="mid"):
-    # Video setup
-    cap = cv2.VideoCapture(input_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+# Karaoke highlighting
+TEXT_COLOR = (255, 255, 255)
+HIGHLIGHT_COLOR = (255, 214, 10) # RGB, sung words are recoloured left to right
+SWEEP_FILL = 0.9 # Without word timestamps the sweep reaches the end of the line at this fraction of its duration
+
+FONT_REGISTRY = {} # (font, size) -> loaded ImageFont, so every job reuses the same font objects
+
+def load_lyrics_font(the_font=1, font_size=30):
+    key = (the_font, font_size)
+    if key in FONT_REGISTRY:
+        return FONT_REGISTRY[key]
 
     # Text configuration
-    sinhala_font = the_font
-    if sinhala_font == 0:
+    if the_font == 0:
         font_path = "/System/Library/Fonts/Supplemental/Sinhala MN.ttc" # MAC OS UNICODE FONT
     else:
         font_path = f"fonts/{the_font}.ttf"
-    MAX_LINE_CHAR_LENGTH = 35 # Define the character limit for wrapping
 
     # Try to load a font
     try:
-        font_size = 30
         font = ImageFont.truetype(font_path, font_size)
     except IOError:
         # Fallback to default font if font not found
         font = ImageFont.load_default()
         print("Warning: Sinhala font not found, using default font")
-    
-    line_spacing = 10
+
+    FONT_REGISTRY[key] = font
+    return font
+
+def wrap_lyric_lines(text):
+    # Original lines based on explicit newline characters
+    initial_lines = text.split('\n')
+
+    # Processed lines with wrapping for long lines
+    processed_lines = []
+    for single_line in initial_lines:
+        # Wrap the line if it's too long, textwrap handles empty strings correctly (returns [''])
+        wrapped_sub_lines = textwrap.wrap(single_line, width=MAX_LINE_CHAR_LENGTH, break_long_words=True, replace_whitespace=False)
+        processed_lines.extend(wrapped_sub_lines)
+    return processed_lines
+
+def sweep_knots(entry):
+    # (times, character offsets into entry["text"]) the karaoke sweep passes through, linear
+    # in between. Enhanced LRC word timestamps are used as they are; otherwise each word gets
+    # a share of the line proportional to its length.
+    text = entry["text"]
+    start_time, end_time = entry["start_time"], entry["end_time"]
+    words = entry.get("words")
+    if words:
+        times, offsets, offset = [], [], 0
+        for word_time, chunk in words:
+            times.append(word_time)
+            offsets.append(offset)
+            offset += len(chunk)
+        if words[-1][1]:
+            # No closing timestamp, give the last word the rest of the line like an interpolated one
+            times.append(times[-1] + max(0, end_time - times[-1]) * SWEEP_FILL)
+            offsets.append(len(text))
+        return np.maximum.accumulate(times), offsets
+
+    sweep_end = start_time + (end_time - start_time) * SWEEP_FILL
+    offsets = [0] + [match.end() for match in re.finditer(r"\S+\s*", text)]
+    times = [start_time + (sweep_end - start_time) * offset / max(1, len(text)) for offset in offsets]
+    return times, offsets
+
+class LyricSweep:
+    # Karaoke overlay of one lyric sprite. The sprite is rasterized once; delta is what the
+    # premultiplied colour changes by where the text is highlighted instead of plain. Each
+    # wrapped line is a band of rows, and the sweep position (pixels along all lines one
+    # after another) decides how many columns of each band get the delta, so a frame costs
+    # one slice add per line on top of the static blend.
+    def __init__(self, delta, bands, times, distances):
+        self.delta = delta
+        self.bands = bands # (first row, last row + 1, left column, sweep offset, line width) per line
+        self.times = times
+        self.distances = distances
+
+    def highlight(self, blended, current_time):
+        swept = float(np.interp(current_time, self.times, self.distances))
+        for row0, row1, left, offset, line_width in self.bands:
+            cut = swept - offset
+            if cut <= 0:
+                break
+            # A finished line is highlighted edge to edge, glyph overhang included
+            columns = self.delta.shape[1] if cut >= line_width else left + int(cut)
+            blended[row0:row1, :columns] += self.delta[row0:row1, :columns]
+
+def build_lyric_sprite(text, font, width, height, sinhala_font=1, text_position="mid", knots=None, highlight_color=HIGHLIGHT_COLOR, scale=1.0):
+    # Rasterize the wrapped, converted and shadowed text once into an RGBA sprite.
+    # Returns (x, y, premultiplied_rgb, inverse_alpha) or None if nothing is drawn; with
+    # knots (from sweep_knots) a LyricSweep in highlight_color is appended.
+    # scale shrinks the spacing and shadow along with the font (quality tiers).
+    line_spacing = round(LINE_SPACING * scale)
+    shadow_offset = max(1, round(SHADOW_OFFSET * scale))
+    processed_lines = wrap_lyric_lines(text)
+    if not processed_lines:
+        return None
+
+    if sinhala_font != 0:
+        drawn_lines = convert_lines(processed_lines, 'fm')
+    else:
+        drawn_lines = processed_lines
+
+    # Note on font.getbbox(): It returns (left, top, right, bottom).
+    # Original code uses bbox[3] (bottom) as height and bbox[2] (right) as width.
+    # This assumes top and left are 0 or negligible.
+    # We stick to the original indexing to maintain existing rendering behavior.
+    # The block height uses the unconverted lines, like the original renderer did.
+    total_height = sum(
+        font.getbbox(line)[3] if line else 0 for line in processed_lines  # Use 0 height for empty lines
+    ) + (len(processed_lines) - 1) * line_spacing
+
+    # Vertical starting position
+    y_start = 0
+    if text_position == "mid":
+        y_start = (height - total_height) // 2
+    elif text_position == "bottom":
+        y_start = (height - total_height + round(250 * scale)) // 2 # Original offset
+
+    # Accumulate premultiplied colour and alpha on a frame-sized canvas, in the same
+    # order the text used to be drawn (shadow then text, line by line). text_weight is how
+    # much of the text colour ends up in each pixel, for the highlight delta.
+    premultiplied = np.zeros((height, width, 3), dtype=np.float32)
+    alpha = np.zeros((height, width, 1), dtype=np.float32)
+    text_weight = np.zeros((height, width, 1), dtype=np.float32) if knots is not None else None
+
+    def blend_text(position, line, color, is_text):
+        mask_img = Image.new("L", (width, height), 0)
+        ImageDraw.Draw(mask_img).text(position, line, font=font, fill=255)
+        mask = np.asarray(mask_img, dtype=np.float32)[:, :, None] / 255.0
+        premultiplied[:] = premultiplied * (1.0 - mask) + np.array(color, dtype=np.float32) * mask
+        alpha[:] = alpha * (1.0 - mask) + mask
+        if text_weight is not None:
+            text_weight[:] = text_weight * (1.0 - mask) + (mask if is_text else 0.0)
+
+    placed = [] # (x, y, right, bottom) of every drawn line
+    for line in drawn_lines:
+        left, top, right, bottom = font.getbbox(line)
+        x = (width - right) // 2  # Horizontal center
+
+        # Draw text with shadow for better visibility
+        blend_text((x+shadow_offset, y_start+shadow_offset), line, (0, 0, 0), False)
+        blend_text((x, y_start), line, TEXT_COLOR, True)
+        placed.append((x, y_start, right, bottom))
+
+        y_start += bottom + line_spacing
+
+    # Crop to the drawn bounding box so each frame only touches those pixels
+    ys, xs = np.nonzero(alpha[:, :, 0])
+    if len(ys) == 0:
+        return None
+    y0, y1 = int(ys.min()), int(ys.max()) + 1
+    x0, x1 = int(xs.min()), int(xs.max()) + 1
+    sprite = (x0, y0, premultiplied[y0:y1, x0:x1].copy(), 1.0 - alpha[y0:y1, x0:x1])
+    if knots is None:
+        return sprite
+
+    color_change = np.array(highlight_color, dtype=np.float32) - np.array(TEXT_COLOR, dtype=np.float32)
+    delta = text_weight[y0:y1, x0:x1] * color_change
+
+    def measure(line):
+        if not line:
+            return 0
+        return font.getlength(convert_lines([line], 'fm')[0] if sinhala_font != 0 else line)
+
+    # Wrapped lines -> where they start in the text, and the sweep distance they start at
+    bands, line_starts, sweep_offset, search_from = [], [], 0, 0
+    for i, (source_line, (x, y, right, bottom)) in enumerate(zip(processed_lines, placed)):
+        line_start = text.find(source_line, search_from)
+        line_start = search_from if line_start < 0 else line_start
+        search_from = line_start + len(source_line)
+        row1 = placed[i + 1][1] if i + 1 < len(placed) else y1
+        bands.append((max(0, y - y0), max(0, row1 - y0), x - x0, sweep_offset, right))
+        line_starts.append((line_start, source_line, sweep_offset))
+        sweep_offset += right
+
+    def distance(offset):
+        # Sweep distance of a character offset (knots sit on word boundaries)
+        for line_start, source_line, line_offset in reversed(line_starts):
+            if offset >= line_start:
+                return line_offset + measure(source_line[:offset - line_start])
+        return 0
+
+    times, offsets = knots
+    distances = np.array([distance(offset) for offset in offsets], dtype=np.float64)
+    return sprite + (LyricSweep(delta, bands, np.asarray(times, dtype=np.float64), np.maximum.accumulate(distances)),)
+
+def build_lyric_sprites(text_entries, font, width, height, sinhala_font=1, text_position="mid", karaoke=False, highlight_color=HIGHLIGHT_COLOR, scale=1.0):
+    return [
+        build_lyric_sprite(
+            entry["text"], font, width, height, sinhala_font=sinhala_font, text_position=text_position,
+            knots=sweep_knots(entry) if karaoke else None, highlight_color=highlight_color, scale=scale,
+        )
+        for entry in text_entries
+    ]
+
+def composite_sprite(frame, sprite, current_time=None):
+    # Alpha-blend a prebuilt sprite into an RGB uint8 frame in place, touching only its bounding box
+    x, y, premultiplied, inverse_alpha = sprite[:4]
+    h, w = inverse_alpha.shape[:2]
+    region = frame[y:y+h, x:x+w]
+    if len(sprite) == 4 or current_time is None:
+        region[:] = region * inverse_alpha + premultiplied
+        return frame
+    blended = region * inverse_alpha
+    blended += premultiplied
+    sprite[4].highlight(blended, current_time)
+    region[:] = blended
+    return frame
+
+class ActiveLyricIndex:
+    # Sweep-line index over text entries. Entries are sorted by start time once and a
+    # cursor moves forward as current_time grows, so each frame costs amortized O(1)
+    # instead of testing every entry.
+    def __init__(self, text_entries):
+        self.starts = [entry["start_time"] for entry in text_entries]
+        self.ends = [entry["end_time"] for entry in text_entries]
+        self.order = sorted(range(len(text_entries)), key=lambda i: (self.starts[i], i))
+        self.reset()
+
+    def reset(self):
+        self.cursor = 0
+        self.active = [] # entry indices, kept in original entry order (= draw order)
+        self.previous_active = []
+        self.last_time = None
+
+    def advance(self, current_time):
+        # Returns (active entry indices, changed since the previous call)
+        rewound = False
+        if self.last_time is not None and current_time < self.last_time:
+            self.reset() # Time went backwards, sweep again from the start
+            rewound = True
+        self.last_time = current_time
+
+        added = False
+        # Entries that have started
+        while self.cursor < len(self.order) and self.starts[self.order[self.cursor]] <= current_time:
+            self.active.append(self.order[self.cursor])
+            self.cursor += 1
+            added = True
+        # Entries that have ended (start <= t <= end is inclusive on both sides)
+        still_active = [i for i in self.active if self.ends[i] >= current_time]
+        if not added and len(still_active) == len(self.active):
+            return self.active, rewound
+
+        still_active.sort()
+        changed = rewound or still_active != self.previous_active
+        self.active = still_active
+        self.previous_active = list(still_active)
+        return self.active, changed
+
+def composite_sprites(frame, active_sprites, current_time=None):
+    for sprite in active_sprites:
+        composite_sprite(frame, sprite, current_time)
+    return frame
+
+def add_timed_text_to_video(input_path, output_path, text_entries, the_font=1, text_position="mid", karaoke=False):
+    # Video setup
+    cap = cv2.VideoCapture(input_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+
+    font = load_lyrics_font(the_font)
+    # OpenCV frames are BGR, the white/black sprites are identical in both orders but the highlight isn't
+    sprites = build_lyric_sprites(
+        text_entries, font, width, height, sinhala_font=the_font, text_position=text_position,
+        karaoke=karaoke, highlight_color=HIGHLIGHT_COLOR[::-1],
+    )
+    lyric_index = ActiveLyricIndex(text_entries)
+    active_sprites = []
     frame_count = 0
+    frame_started = time.perf_counter()
 
     while cap.isOpened():
         ret, frame = cap.read()
@@ -255,94 +540,336 @@ def add_timed_text_to_video(input_path, output_path, text_entries, the_font=1, t
             break
 
         current_time = frame_count / fps
-
-        # Convert OpenCV BGR to RGB for PIL
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(frame_rgb)
-        draw = ImageDraw.Draw(pil_img)
-
-        for entry in text_entries:
-            start = entry["start_time"]
-            end = entry["end_time"]
-
-            if start <= current_time <= end:
-                text = entry["text"]
-
-                # Original lines based on explicit newline characters
-                initial_lines = text.split('\n')
-
-                # Processed lines with wrapping for long lines
-                processed_lines = []
-                for single_line in initial_lines:
-                    # Wrap the line if it's too long, textwrap handles empty strings correctly (returns [''])
-                    wrapped_sub_lines = textwrap.wrap(single_line, width=MAX_LINE_CHAR_LENGTH, break_long_words=True, replace_whitespace=False)
-                    processed_lines.extend(wrapped_sub_lines)
-                
-                # Calculate total text block height using the original method but with processed_lines
-                # Note on font.getbbox(): It returns (left, top, right, bottom).
-                # Original code uses bbox[3] (bottom) as height and bbox[2] (right) as width.
-                # This assumes top and left are 0 or negligible.
-                # More robust: height = bbox[3]-bbox[1], width = bbox[2]-bbox[0].
-                # For this change, we'll stick to the original indexing to maintain existing rendering behavior.
-                total_height = sum(
-                    font.getbbox(line)[3] if line else 0 for line in processed_lines  # Use 0 height for empty lines
-                ) + (len(processed_lines) - 1) * line_spacing if processed_lines else 0
-                
-                # Vertical starting position
-                y_start = 0 # Default y_start
-                if processed_lines: # Only calculate if there are lines to draw
-                    if text_position == "mid":
-                        y_start = (height - total_height) // 2
-                    elif text_position == "bottom":
-                        y_start = (height - total_height + 250) // 2 # Original offset
-                
-                # Draw each line
-                for line in processed_lines:
-                    if sinhala_font != 0:
-                        line = convertor(line, 'fm')
-
-                    text_render_width = font.getbbox(line)[2] # Using original method for width
-                    current_line_render_height = font.getbbox(line)[3] # Using original method for height
-
-                    x = (width - text_render_width) // 2  # Horizontal center
-
-                    # Draw text with shadow for better visibility
-                    draw.text((x+2, y_start+2), line, font=font, fill=(0, 0, 0))
-                    draw.text((x, y_start), line, font=font, fill=(255, 255, 255))
-
-                    y_start += current_line_render_height + line_spacing
-
-        # Convert back to OpenCV format
-        frame = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+        active, changed = lyric_index.advance(current_time)
+        if changed:
+            active_sprites = [sprites[i] for i in active if sprites[i] is not None]
+        composite_sprites(frame, active_sprites, current_time)
         out.write(frame)
         frame_count += 1
+        frame_done = time.perf_counter()
+        metrics.FRAME_SECONDS.observe(frame_done - frame_started, loop="overlay")
+        frame_started = frame_done
 
     cap.release()
     out.release()
     cv2.destroyAllWindows()
 
-def cut_audio(input_path, start_time, end_time, vid_id):
-    if system == "Windows":
-        audio = AudioFileClip(input_path).subclipped(start_time, end_time)
+def open_video_writer(save_path, width, height, fps, audio_path=None, audio_start=0, audio_duration=None, preset="medium", audio_fades=None, gop=GOP_FRAMES):
+    # Raw RGB frames come in on stdin, the audio (if any) is cut and muxed in the same ffmpeg run
+    cmd = [
+        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-vcodec", "rawvideo",
+        "-s", f"{width}x{height}", "-pix_fmt", "rgb24", "-r", str(fps),
+        "-i", "-",
+    ]
+    if audio_path is not None:
+        cmd.extend(["-ss", f"{audio_start:.3f}"])
+        if audio_duration is not None:
+            cmd.extend(["-t", f"{audio_duration:.3f}"])
+        cmd.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "aac", "-shortest"])
+        filters = audio_filters(audio_duration, audio_fades)
+        if filters:
+            cmd.extend(["-af", filters])
+    cmd.extend(["-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p"])
+    if gop:
+        # Keyframes only every gop frames, so a segmented render has the same GOP layout as a single one
+        cmd.extend(["-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0"])
+    cmd.append(save_path)
+
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def close_video_writer(proc):
+    proc.stdin.close()
+    error_output = proc.stderr.read()
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed: {error_output.decode(errors='ignore')}")
+
+def kill_video_writer(proc):
+    # Cancelled renders don't wait for ffmpeg to encode the frames it still holds
+    proc.kill()
+    try:
+        proc.stdin.close()
+    except OSError:
+        pass
+    proc.wait()
+
+def iter_video_frames(images, sprite_sets, text_entries, first_frame, n_frames, fps=FPS, sizes=((FRAME_WIDTH, FRAME_HEIGHT),), subpixel=False, workdir="temp", cancel_path=None):
+    # Finished frames (pan + lyrics) first_frame .. first_frame + n_frames - 1, as one list per
+    # frame with a frame for every output format (images, sprite_sets and sizes line up)
+    lyric_index = ActiveLyricIndex(text_entries)
+    active_sets = [[] for _ in sprite_sets]
+    check_every = max(1, round(CANCEL_CHECK_SECONDS * fps))
+    pans = [
+        iter_pan_frames(image, n_frames, fps, width, height, subpixel=subpixel, workdir=workdir, first_frame=first_frame)
+        for image, (width, height) in zip(images, sizes)
+    ]
+    for frame_count, windows in enumerate(zip(*pans), start=first_frame):
+        if frame_count % check_every == 0:
+            check_cancelled(cancel_path)
+        current_time = frame_count / fps
+        active, changed = lyric_index.advance(current_time)
+        if changed:
+            active_sets = [[sprites[i] for i in active if sprites[i] is not None] for sprites in sprite_sets]
+        frames = []
+        for window, active_sprites in zip(windows, active_sets):
+            frame = np.array(window) # Own copy, the sprites are blended in place
+            composite_sprites(frame, active_sprites, current_time)
+            frames.append(frame)
+        yield frames
+
+def write_frame_sets(procs, frame_sets):
+    # Feeds each encoder from its own thread, so the ffmpeg processes encode side by side
+    # instead of waiting for each other's pipe writes
+    if len(procs) == 1:
+        for frames in frame_sets:
+            procs[0].stdin.write(frames[0])
+        return
+
+    queues = [queue.Queue(maxsize=ENCODER_QUEUE_FRAMES) for _ in procs]
+    errors = []
+
+    def feed(proc, frames):
+        try:
+            while (frame := frames.get()) is not None:
+                proc.stdin.write(frame)
+        except Exception as e:
+            errors.append(e)
+            while frames.get() is not None:
+                pass # Keep taking frames so the producer never blocks on a dead encoder
+
+    threads = [threading.Thread(target=feed, args=(proc, frames), daemon=True) for proc, frames in zip(procs, queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        for frames in frame_sets:
+            if errors:
+                break
+            for frame_queue, frame in zip(queues, frames):
+                frame_queue.put(frame)
+    finally:
+        for frame_queue in queues:
+            frame_queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def timed_frames(frames, loop):
+    # Passes frames through, recording each one's latency (making it + whatever the consumer
+    # does with it before asking for the next) in the frame histogram
+    started = time.perf_counter()
+    for frame in frames:
+        yield frame
+        done = time.perf_counter()
+        metrics.FRAME_SECONDS.observe(done - started, loop=loop)
+        started = done
+
+def segment_bounds(n_frames, workers, gop=GOP_FRAMES, fps=FPS):
+    # Split [0, n_frames) into at most `workers` runs of whole GOPs, each at least MIN_SEGMENT_SECONDS
+    gops = math.ceil(n_frames / gop)
+    min_gops = max(1, math.ceil(MIN_SEGMENT_SECONDS * fps / gop))
+    segments = max(1, min(workers, gops // min_gops))
+    per_segment = math.ceil(gops / segments)
+    bounds = []
+    for first_gop in range(0, gops, per_segment):
+        bounds.append((first_gop * gop, min(n_frames, (first_gop + per_segment) * gop)))
+    return bounds
+
+def place_sprite(sprite, dx, dy):
+    # The same rasterized sprite at another position (the arrays are shared)
+    if sprite is None:
+        return None
+    return (sprite[0] + dx, sprite[1] + dy) + tuple(sprite[2:])
+
+def load_render_inputs(image_path, text_entries, tiers, the_font=1, text_position="mid", karaoke=False):
+    # Pan images and lyric sprites for [(aspect, tier), ...]. The background is decoded once
+    # and the lyrics are rasterized once, on the smallest frame, then centred in each format.
+    source = decode_image(image_path)
+    images = [fit_pan_image(source, tier["width"], tier["height"], pan_scale_factor(source, tier, aspect)) for aspect, tier in tiers]
+    scale = tiers[0][1]["scale"]
+    width = min(tier["width"] for _, tier in tiers)
+    height = min(tier["height"] for _, tier in tiers)
+    font = load_lyrics_font(the_font, font_size=round(30 * scale))
+    sprites = build_lyric_sprites(
+        text_entries, font, width, height, sinhala_font=the_font, text_position=text_position,
+        karaoke=karaoke, scale=scale,
+    )
+    sprite_sets = [
+        [place_sprite(sprite, (tier["width"] - width) // 2, (tier["height"] - height) // 2) for sprite in sprites]
+        for _, tier in tiers
+    ]
+    return images, sprite_sets
+
+def render_frames(image_path, text_entries, first_frame, last_frame, save_paths, aspects=(DEFAULT_ASPECT,), the_font=1, text_position="mid", subpixel=False, workdir="temp", karaoke=False, quality="final", cancel_path=None, audio=None):
+    # Frames [first_frame, last_frame) of every format, one encoder per format fed from the
+    # same frame loop. audio: open_video_writer audio arguments, muxed into every output.
+    tiers = [(aspect, render_tier(quality, aspect)) for aspect in aspects]
+    images, sprite_sets = load_render_inputs(image_path, text_entries, tiers, the_font, text_position, karaoke)
+    fps = tiers[0][1]["fps"]
+    sizes = [(tier["width"], tier["height"]) for _, tier in tiers]
+    procs = []
+    try:
+        for save_path, (_, tier) in zip(save_paths, tiers):
+            procs.append(open_video_writer(save_path, tier["width"], tier["height"], fps, preset=tier["preset"], gop=tier["gop"], **(audio or {})))
+        frames = iter_video_frames(
+            images, sprite_sets, text_entries, first_frame, last_frame - first_frame, fps, sizes,
+            subpixel=subpixel, workdir=workdir, cancel_path=cancel_path,
+        )
+        write_frame_sets(procs, timed_frames(frames, "render"))
+    except BaseException:
+        for proc in procs:
+            kill_video_writer(proc)
+        raise
+    for proc in procs:
+        close_video_writer(proc)
+    return save_paths
+
+def render_segment(image_path, text_entries, first_frame, last_frame, save_paths, aspects=(DEFAULT_ASPECT,), the_font=1, text_position="mid", subpixel=False, workdir="temp", karaoke=False, quality="final", cancel_path=None):
+    # Video only, frames [first_frame, last_frame) of every format. Runs in a worker process,
+    # returns (save_paths, metrics recorded here for the parent to merge).
+    render_frames(
+        image_path, text_entries, first_frame, last_frame, save_paths, aspects, the_font=the_font, text_position=text_position,
+        subpixel=subpixel, workdir=workdir, karaoke=karaoke, quality=quality, cancel_path=cancel_path,
+    )
+    return save_paths, metrics.REGISTRY.drain()
+
+def concat_segments(segment_paths, save_path, workdir="temp", audio_path=None, audio_start=0, audio_duration=None, audio_fades=None):
+    # Lossless join (stream copy) of the segments, the audio is muxed and transcoded in the same run
+    list_path = os.path.join(workdir, os.path.basename(save_path) + ".segments.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+    if audio_path is not None:
+        cmd.extend(["-ss", f"{audio_start:.3f}"])
+        if audio_duration is not None:
+            cmd.extend(["-t", f"{audio_duration:.3f}"])
+        cmd.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "aac", "-shortest"])
+        filters = audio_filters(audio_duration, audio_fades)
+        if filters:
+            cmd.extend(["-af", filters])
+    cmd.extend(["-c:v", "copy", save_path])
+
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.remove(list_path)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore')}")
+    return save_path
+
+def render_video(image_path, text_entries, audio_path, start_time, end_time, vid_id, the_font=1, text_position="mid", subpixel=False, workdir="temp", audio_offset=0, audio_fades=None, workers=1, karaoke=False, quality="final", cancel_path=None):
+    # SINGLE PASS: PAN + LYRICS ARE BUILT PER FRAME AND ENCODED ONCE, AUDIO IS MUXED IN THE SAME RUN
+    # audio_offset: track time at which audio_path starts (ranged downloads and cut_audio clips)
+    # audio_fades: (fade in, fade out) seconds from cut_audio
+    # workers > 1: render GOP-aligned time slices in that many processes and join them losslessly
+    # karaoke: sweep a highlight colour over each lyric line as it is sung
+    # quality: a QUALITY_TIERS name, drafts are saved as outputs/draft_{vid_id}.mp4
+    # cancel_path: the render raises RenderCancelled soon after this file is created
+    return render_videos(
+        image_path, text_entries, audio_path, start_time, end_time, vid_id, the_font=the_font, text_position=text_position,
+        subpixel=subpixel, workdir=workdir, audio_offset=audio_offset, audio_fades=audio_fades, workers=workers,
+        karaoke=karaoke, quality=quality, cancel_path=cancel_path,
+    )[DEFAULT_ASPECT]
+
+def render_videos(image_path, text_entries, audio_path, start_time, end_time, vid_id, aspects=(DEFAULT_ASPECT,), the_font=1, text_position="mid", subpixel=False, workdir="temp", audio_offset=0, audio_fades=None, workers=1, karaoke=False, quality="final", cancel_path=None):
+    # render_video for several output formats (ASPECT_SIZES names) at once: one frame loop and
+    # one set of lyric sprites, an encoder per format. Returns {aspect: video path}.
+    aspects = list(dict.fromkeys(aspects))
+    save_paths = [output_path(quality, vid_id, aspect) for aspect in aspects]
+    described = ", ".join(f"'{path}'" for path in save_paths)
+    fps = render_tier(quality)["fps"]
+    gop = render_tier(quality)["gop"]
+    duration = end_time - start_time
+    n_frames = int(duration * fps)
+    audio_start = start_time - audio_offset
+
+    bounds = segment_bounds(n_frames, workers, gop, fps) if workers > 1 else [(0, n_frames)]
+    if len(bounds) > 1:
+        print(f"Rendering video to {described} in {len(bounds)} segments (Duration: {duration}s, FPS: {fps})...")
+        segment_dir = os.path.join(workdir, f"segments_{vid_id}")
+        os.makedirs(segment_dir, exist_ok=True)
+        try:
+            # spawn: this may already run inside a worker of the bot's render pool
+            with ProcessPoolExecutor(max_workers=len(bounds), mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [
+                    pool.submit(
+                        render_segment, image_path, text_entries, first, last,
+                        [os.path.join(segment_dir, f"segment_{i:03d}_{j}.mp4") for j in range(len(aspects))], aspects,
+                        the_font=the_font, text_position=text_position, subpixel=subpixel, workdir=segment_dir, karaoke=karaoke,
+                        quality=quality, cancel_path=cancel_path,
+                    )
+                    for i, (first, last) in enumerate(bounds)
+                ]
+                segment_paths = []
+                for future in futures:
+                    paths, segment_metrics = future.result()
+                    segment_paths.append(paths)
+                    metrics.REGISTRY.merge(segment_metrics)
+            # Stream copies, one per format, at the same time
+            with ThreadPoolExecutor(max_workers=len(aspects)) as pool:
+                joins = [
+                    pool.submit(
+                        concat_segments, [paths[j] for paths in segment_paths], save_path, workdir=workdir,
+                        audio_path=audio_path, audio_start=audio_start, audio_duration=duration, audio_fades=audio_fades,
+                    )
+                    for j, save_path in enumerate(save_paths)
+                ]
+                for join in joins:
+                    join.result()
+        finally:
+            shutil.rmtree(segment_dir, ignore_errors=True)
     else:
-        audio = AudioFileClip(input_path).subclip(start_time, end_time)
-    
-    output_path = f"temp/clip_{vid_id}.mp3"
-    audio.write_audiofile(output_path)
-    return output_path
-
-def add_audio_to_video(input_video_path, input_audio_path, vid_id):
+        print(f"Rendering video to {described} (Duration: {duration}s, FPS: {fps})...")
+        audio = {"audio_path": audio_path, "audio_start": audio_start, "audio_duration": duration, "audio_fades": audio_fades}
+        render_frames(
+            image_path, text_entries, 0, n_frames, save_paths, aspects, the_font=the_font, text_position=text_position,
+            subpixel=subpixel, workdir=workdir, karaoke=karaoke, quality=quality, cancel_path=cancel_path, audio=audio,
+        )
+
+    print(f"Final video {described} created successfully!")
+    return dict(zip(aspects, save_paths))
+
+def cut_audio(input_path, start_time, end_time, vid_id, workdir="temp", source_offset=0):
+    # Frame-accurate byte slice of the MP3, no decode/encode. source_offset is the track time
+    # input_path starts at (ranged downloads). Returns (clip path, track time of the clip's first
+    # decoded sample, (fade in, fade out) seconds for the edges that cut into the music).
+    with open(input_path, "rb") as f:
+        data = f.read()
+    clip, clip_start, file_duration = mp3.cut(data, start_time - source_offset, end_time - source_offset)
+
+    output_path = os.path.join(workdir, f"clip_{vid_id}.mp3")
+    with open(output_path, "wb") as f:
+        f.write(clip)
+
+    fade_in = DECLICK_FADE if start_time > 0 else 0
+    fade_out = DECLICK_FADE if end_time < source_offset + file_duration else 0
+    return output_path, source_offset + clip_start, (fade_in, fade_out)
+
+def audio_filters(duration, fades=None):
+    # ffmpeg -af value for the de-click fades, or None
+    if not fades:
+        return None
+    fade_in, fade_out = fades
+    filters = []
+    if fade_in:
+        filters.append(f"afade=t=in:st=0:d={fade_in:.3f}")
+    if fade_out and duration:
+        filters.append(f"afade=t=out:st={max(0, duration - fade_out):.3f}:d={fade_out:.3f}")
+    return ",".join(filters) or None
+
+def add_audio_to_video(input_video_path, input_audio_path, vid_id, audio_start=0, audio_duration=None, audio_fades=None):
+    # Mux without touching the video stream, the audio is transcoded to AAC once
     save_path = f"outputs/final_{vid_id}.mp4"
-
-    # Load the video and audio
-    video = VideoFileClip(input_video_path)
-    audio = AudioFileClip(input_audio_path)
-    # Set the audio to the video
-    if system == "Windows":
-        final_video = video.with_audio(audio)
-    else:
-        final_video = video.set_audio(audio)
-
-    # Export the final video
-    final_video.write_videofile(save_path, codec="libx264", audio_codec="aac")
-    return save_path
\ No newline at end of file
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", "-i", input_video_path, "-ss", f"{audio_start:.3f}"]
+    if audio_duration is not None:
+        cmd.extend(["-t", f"{audio_duration:.3f}"])
+    cmd.extend(["-i", input_audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac"])
+    filters = audio_filters(audio_duration, audio_fades)
+    if filters:
+        cmd.extend(["-af", filters])
+    cmd.extend(["-shortest", save_path])
+
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='ignore')}")
+    return save_path
@@ -0,0 +1,186 @@
+import time
+import random
+import logging
+import threading
+
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POOL_CONNECTIONS = 16 # Hosts kept in the pool
+POOL_MAXSIZE = 32 # Keep-alive connections per host (network workers share them)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TransientError(Exception):
+    # A failure worth retrying: overloaded/broken upstream or an empty answer from a flaky scraper
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and fails fast for reset_timeout seconds,
+    # then lets one trial call through (half open): success closes it, failure opens it again,
+    # anything else (a bad request, an interrupted call) leaves the trial to the next call.
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.trial_thread = None
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self.trial_running = False
+            if self.state == "half_open":
+                if self.trial_running:
+                    return False
+                self.trial_running = True
+                self.trial_thread = threading.get_ident()
+            return True
+
+    def end_trial(self):
+        # The calling thread's trial ended without a verdict
+        with self.lock:
+            if self.trial_running and self.trial_thread == threading.get_ident():
+                self.trial_running = False
+
+    def record_answered(self):
+        # The upstream answered but the request itself was bad (e.g. 401 from an expired key):
+        # that breaks a failure streak, but doesn't prove a half open upstream healthy
+        with self.lock:
+            if self.state == "closed":
+                self.failures = 0
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info(f"Circuit '{self.name}' closed")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"Circuit '{self.name}' opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+class Upstream:
+    # Timeouts, retry budget and circuit breaker for one external service
+    def __init__(self, name, connect_timeout=5, read_timeout=30, attempts=3, backoff_base=1.0, backoff_max=20.0,
+                 failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def backoff(self, attempt, retry_after=None):
+        # Full jitter: spreads retries from concurrent jobs instead of stampeding the upstream
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+UPSTREAM_CALLS = metrics.counter("lyrics_upstream_calls_total", "Upstream calls by final outcome (ok, error, failed after retries, circuit_open).", ["upstream", "outcome"])
+UPSTREAM_RETRIES = metrics.counter("lyrics_upstream_retries_total", "Retried upstream attempts.", ["upstream"])
+UPSTREAM_SECONDS = metrics.histogram("lyrics_upstream_attempt_seconds", "Duration of single upstream attempts.", ["upstream"])
+
+RAPIDAPI = Upstream("rapidapi", read_timeout=30)
+SCRAPE_DO = Upstream("scrape.do", read_timeout=90) # Renders spotmate in a browser, ~20s of scripted waits
+LRCLIB = Upstream("lrclib", read_timeout=15)
+AUDIO_HOST = Upstream("audio", read_timeout=30) # Read timeout applies per chunk of the download
+OPENAI = Upstream("openai", read_timeout=180, backoff_base=2.0, backoff_max=30.0) # Image edits take a while
+
+def is_transient(e):
+    return isinstance(e, (
+        TransientError,
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        openai.APIConnectionError, # Includes APITimeoutError
+        openai.RateLimitError,
+        openai.InternalServerError,
+    ))
+
+def new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = new_session() # Shared by every thread: connections and TLS sessions are reused per host
+
+def call(upstream, fn):
+    # Run fn() against the upstream with retries on transient errors and jittered backoff.
+    # Raises CircuitOpen without calling fn while the upstream's breaker is open.
+    for attempt in range(upstream.attempts):
+        if not upstream.breaker.allow():
+            UPSTREAM_CALLS.inc(upstream=upstream.name, outcome="circuit_open")
+            raise CircuitOpen(f"{upstream.name} is unavailable (circuit open), try again later")
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream.name)
+            if not is_transient(e):
+                upstream.breaker.record_answered()
+                UPSTREAM_CALLS.inc(upstream=upstream.name, outcome="error")
+                raise
+            upstream.breaker.record_failure()
+            if attempt + 1 == upstream.attempts:
+                UPSTREAM_CALLS.inc(upstream=upstream.name, outcome="failed")
+                raise
+            delay = upstream.backoff(attempt, getattr(e, "retry_after", None))
+            logger.warning(f"{upstream.name} attempt {attempt + 1}/{upstream.attempts} failed ({e}), retrying in {delay:.1f}s")
+            UPSTREAM_RETRIES.inc(upstream=upstream.name)
+            time.sleep(delay)
+        else:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream.name)
+            upstream.breaker.record_success()
+            UPSTREAM_CALLS.inc(upstream=upstream.name, outcome="ok")
+            return result
+        finally:
+            upstream.breaker.end_trial() # Cancelled or a bad request: no verdict, free the trial
+
+def check_response(response):
+    if response.status_code in RETRY_STATUSES:
+        retry_after = response.headers.get("Retry-After")
+        response.close()
+        raise TransientError(
+            f"HTTP {response.status_code} from {response.url}",
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+    response.raise_for_status()
+    return response
+
+def get(upstream, url, **kwargs):
+    # GET through the shared session with the upstream's timeouts; non-2xx answers raise
+    kwargs.setdefault("timeout", upstream.timeout)
+    return call(upstream, lambda: check_response(SESSION.get(url, **kwargs)))
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUE = 20 # Jobs waiting for a worker, /generate is refused above this
+DEFAULT_NETWORK_WORKERS = 8
+DEFAULT_JOB_SECONDS = 180 # First guess for the wait estimate, replaced by real timings
+
+JOBS = metrics.counter("lyrics_jobs_total", "Generation jobs by outcome (completed, failed, cancelled by the user, reused when rendered before, rejected when the queue is full).", ["status"])
+JOB_QUEUE_SECONDS = metrics.histogram("lyrics_job_queue_seconds", "Time jobs waited in the queue for a worker.")
+JOB_SECONDS = metrics.histogram("lyrics_job_seconds", "Time from a worker picking a job up to the job finishing.")
+QUEUE_LENGTH = metrics.gauge("lyrics_job_queue_length", "Jobs waiting for a worker.")
+RUNNING_JOBS = metrics.gauge("lyrics_jobs_running", "Jobs being worked on.")
+
+class JobQueueFull(Exception):
+    pass
+
+class JobScheduler:
+    # Bounded job queue for the bot. Each job is an async function that runs its network
+    # stages with run_network (threads) and its CPU heavy rendering with run_render
+    # (a process pool sized to the cores), so the event loop keeps serving updates.
+    def __init__(self, render_workers=None, max_queue=DEFAULT_MAX_QUEUE, network_workers=DEFAULT_NETWORK_WORKERS):
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.network_workers = network_workers
+        self.queue = None
+        self.workers = []
+        self.waiting = [] # job ids in queue order, for positions
+        self.running = 0
+        self.avg_job_seconds = DEFAULT_JOB_SECONDS
+        self.render_pool = None
+        self.network_pool = None
+
+    async def start(self):
+        # Called from inside the running loop (Application.post_init)
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        # spawn: forking a process that already runs threads and an event loop is unsafe
+        self.render_pool = ProcessPoolExecutor(max_workers=self.render_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.network_pool = ThreadPoolExecutor(max_workers=self.network_workers, thread_name_prefix="network")
+        self.workers = [asyncio.create_task(self._worker(i)) for i in range(self.render_workers)]
+        QUEUE_LENGTH.set_function(lambda: len(self.waiting))
+        RUNNING_JOBS.set_function(lambda: self.running)
+        logger.info(f"Job scheduler started with {self.render_workers} render workers, queue size {self.max_queue}")
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.render_pool is not None:
+            self.render_pool.shutdown(wait=False, cancel_futures=True)
+        if self.network_pool is not None:
+            self.network_pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, job_id, job_fn, *args, **kwargs):
+        # Queue job_fn(*args, **kwargs) and return (position, estimated wait in seconds)
+        try:
+            self.queue.put_nowait((job_id, job_fn, args, kwargs, time.monotonic()))
+        except asyncio.QueueFull:
+            JOBS.inc(status="rejected")
+            raise JobQueueFull(f"Job queue is full ({self.max_queue} jobs waiting)")
+        self.waiting.append(job_id)
+        position = len(self.waiting)
+        return position, self.estimate_wait(position)
+
+    def position(self, job_id):
+        # 1-based place in the queue, 0 once the job has started
+        if job_id in self.waiting:
+            return self.waiting.index(job_id) + 1
+        return 0
+
+    def estimate_wait(self, position):
+        # Jobs ahead of this one (plus the ones already running) share the workers
+        free_workers = max(0, self.render_workers - self.running)
+        if position <= free_workers:
+            return 0
+        rounds = math.ceil((position - free_workers) / self.render_workers)
+        return rounds * self.avg_job_seconds
+
+    def job_render_workers(self, max_workers=None):
+        # Processes a starting job may render with: the whole machine when it's the only job,
+        # an even share of the cores when others are running or waiting
+        cores = os.cpu_count() or 1
+        busy = max(1, self.running + len(self.waiting))
+        return max(1, min(max_workers or cores, cores // busy))
+
+    async def run_network(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.network_pool, lambda: fn(*args, **kwargs))
+
+    async def run_render(self, fn, *args, **kwargs):
+        # fn and its arguments must be picklable (module level functions, plain data)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.render_pool, _call, fn, args, kwargs)
+
+    async def _worker(self, worker_id):
+        while True:
+            job_id, job_fn, args, kwargs, submitted = await self.queue.get()
+            if job_id in self.waiting:
+                self.waiting.remove(job_id)
+            self.running += 1
+            started = time.monotonic()
+            JOB_QUEUE_SECONDS.observe(started - submitted)
+            try:
+                await job_fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} failed on worker {worker_id}: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+                elapsed = time.monotonic() - started
+                JOB_SECONDS.observe(elapsed)
+                # Exponential moving average of job durations for the wait estimate
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+                self.queue.task_done()
+
+def _call(fn, args, kwargs):
+    return fn(*args, **kwargs)
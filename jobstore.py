@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join("data", "jobs.db"))
+JOB_DEDUP = os.getenv("JOB_DEDUP", "1") != "0" # Answer a repeated request with the video already rendered for it
+FINGERPRINT_VERSION = 1 # Bump when a renderer change makes old videos unfit for reuse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    fingerprint TEXT,
+    user_id TEXT,
+    spotify_url TEXT,
+    track_id TEXT,
+    song_title TEXT,
+    start_time REAL,
+    end_time REAL,
+    font INTEGER,
+    image_source_type TEXT,
+    image_hash TEXT,
+    final_video_path TEXT,
+    record TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, finished_at) WHERE status = 'done';
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_track ON jobs (track_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_song ON jobs (song_title COLLATE NOCASE, created_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL
+);
+"""
+
+def image_hash(image_source_type, image_path=None, background_key=None):
+    # What the background is made from: the photo's SHA-256, the reused background's cache key,
+    # or nothing for lyrics based backgrounds (those are cached by lyric segment anyway)
+    if image_source_type == "reuse":
+        return background_key
+    if image_source_type in ("raw_ghibli", "ghibli_char") and image_path:
+        return cache.file_sha256(image_path)
+    return None
+
+def request_fingerprint(spotify_url, start_time, end_time, font, image_source_type, image_hash=None, song_title=None, aspects=None, karaoke=False):
+    # Everything that changes the rendered video; equal fingerprints give the same video
+    return cache.hash_key(
+        "job", FINGERPRINT_VERSION, cache.spotify_track_id(spotify_url), float(start_time), float(end_time),
+        int(font), image_source_type, image_hash, song_title, ",".join(aspects or []), bool(karaoke),
+    )
+
+class JobStore:
+    # Job records in SQLite (WAL, so readers don't block the writer): request parameters,
+    # status, the pipeline.video_record with artifact paths and timings, indexed by request
+    # fingerprint, user, song and status. One connection per thread.
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None) # Autocommit, one statement per change
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self.lock:
+                if not self.ready:
+                    conn.executescript(SCHEMA)
+                    self.ready = True
+            self.local.conn = conn
+        return conn
+
+    def start(self, job_id, spotify_url, start_time, end_time, font, image_source_type, fingerprint=None, image_hash=None, user_id=None, song_title=None):
+        # A job was accepted; song_title is the custom one, if any (finish() fills in the real one)
+        self.connection().execute(
+            "INSERT OR REPLACE INTO jobs (id, status, fingerprint, user_id, spotify_url, track_id, song_title, start_time, end_time, font, image_source_type, image_hash, created_at) "
+            "VALUES (?, 'running', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, fingerprint, None if user_id is None else str(user_id), spotify_url, cache.spotify_track_id(spotify_url), song_title,
+             start_time, end_time, font, image_source_type, image_hash, time.time()),
+        )
+
+    def finish(self, vid_data):
+        # vid_data: pipeline.video_record(), stored whole; its videos are indexed for expire()
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "UPDATE jobs SET status = 'done', song_title = ?, final_video_path = ?, record = ?, finished_at = ? WHERE id = ?",
+                (vid_data["song_title"], vid_data["final_video_path"], json.dumps(vid_data), time.time(), vid_data["id"]),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO outputs (path, job_id) VALUES (?, ?)",
+                [(os.path.normpath(path), vid_data["id"]) for path in vid_data["final_video_paths"].values()],
+            )
+        return vid_data
+
+    def expire(self, paths):
+        # Videos that were deleted (the janitor's evictions): their jobs can't be reused any more
+        # and show up as 'expired' in the history
+        paths = [os.path.normpath(path) for path in paths]
+        conn = self.connection()
+        expired = 0
+        for i in range(0, len(paths), 500): # SQLite's limit on bound parameters
+            chunk = paths[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            with conn:
+                conn.execute("BEGIN")
+                expired += conn.execute(
+                    f"UPDATE jobs SET status = 'expired' WHERE status = 'done' AND id IN (SELECT job_id FROM outputs WHERE path IN ({marks}))",
+                    chunk,
+                ).rowcount
+                conn.execute(f"DELETE FROM outputs WHERE path IN ({marks})", chunk)
+        if expired:
+            logger.info(f"{expired} jobs expired, their videos were deleted")
+        return expired
+
+    def fail(self, job_id, error, status="failed"):
+        self.connection().execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, str(error), time.time(), job_id),
+        )
+
+    def reuse(self, job_id, vid_data, user_id=None):
+        # A request answered with an earlier job's video, kept for the user's history
+        conn = self.connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (id, status, user_id, spotify_url, track_id, song_title, start_time, end_time, font, image_source_type, final_video_path, record, created_at, finished_at) "
+            "VALUES (?, 'reused', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, None if user_id is None else str(user_id), vid_data["spotify_url"], cache.spotify_track_id(vid_data["spotify_url"]),
+             vid_data["song_title"], vid_data["start_time"], vid_data["end_time"], vid_data["font"], vid_data["image_source_type"],
+             vid_data["final_video_path"], json.dumps(vid_data), now, now),
+        )
+
+    def lookup(self, fingerprint):
+        # Latest finished job for this request whose videos are all still on disk (the janitor
+        # evicts old outputs), or None
+        if not JOB_DEDUP or fingerprint is None:
+            return None
+        rows = self.connection().execute(
+            "SELECT record FROM jobs WHERE fingerprint = ? AND status = 'done' ORDER BY finished_at DESC LIMIT 5",
+            (fingerprint,),
+        ).fetchall()
+        for row in rows:
+            vid_data = json.loads(row["record"])
+            missing = [path for path in vid_data["final_video_paths"].values() if not os.path.exists(path)]
+            if not missing:
+                cache.CACHE_REQUESTS.inc(cache="results", result="hit")
+                return vid_data
+            self.expire(missing) # Deleted outside the janitor
+        cache.CACHE_REQUESTS.inc(cache="results", result="miss")
+        return None
+
+    def get(self, job_id):
+        row = self.connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.as_dict(row)
+
+    def history(self, user_id=None, song=None, status=None, limit=20):
+        # Newest first. song: a Spotify URL / track ID or a song title (case-insensitive)
+        where, params = [], []
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(str(user_id))
+        if song:
+            where.append("(track_id = ? OR song_title = ? COLLATE NOCASE)")
+            params += [cache.spotify_track_id(song) if "spotify" in song else song, song]
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        rows = self.connection().execute(
+            "SELECT * FROM jobs" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY created_at DESC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+        return [self.as_dict(row) for row in rows]
+
+    def as_dict(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["record"] = json.loads(job["record"]) if job["record"] else None
+        return job
+
+    def import_records(self, directory="data"):
+        # Loads the data/{vid_id}.json files older versions wrote. They have no fingerprint (the
+        # photo they were made from is gone), so they only show up in the history.
+        imported = 0
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                    vid_data = json.load(f)
+                job_id = vid_data["id"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if self.get(job_id) is not None:
+                continue
+            created_at = os.path.getmtime(os.path.join(directory, name))
+            self.connection().execute(
+                "INSERT INTO jobs (id, status, spotify_url, track_id, song_title, start_time, end_time, font, image_source_type, final_video_path, record, created_at, finished_at) "
+                "VALUES (?, 'done', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, vid_data.get("spotify_url"), cache.spotify_track_id(vid_data.get("spotify_url") or ""), vid_data.get("song_title"),
+                 vid_data.get("start_time"), vid_data.get("end_time"), vid_data.get("font"), vid_data.get("image_source_type"),
+                 vid_data.get("final_video_path"), json.dumps(vid_data), created_at, created_at),
+            )
+            paths = (vid_data.get("final_video_paths") or {}).values() or [vid_data.get("final_video_path")]
+            self.connection().executemany(
+                "INSERT OR REPLACE INTO outputs (path, job_id) VALUES (?, ?)",
+                [(os.path.normpath(path), job_id) for path in paths if path],
+            )
+            imported += 1
+        return imported
+
+JOB_STORE = JobStore()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the job store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    history = commands.add_parser("history", help="list jobs, newest first")
+    history.add_argument("--user", help="Telegram user ID")
+    history.add_argument("--song", help="Spotify URL or song title")
+    history.add_argument("--status", choices=["running", "done", "failed", "cancelled", "reused", "expired"])
+    history.add_argument("--limit", type=int, default=20)
+    legacy = commands.add_parser("import", help="import data/{vid_id}.json files from older versions")
+    legacy.add_argument("directory", nargs="?", default="data")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        print(f"Imported {JOB_STORE.import_records(args.directory)} jobs into {JOB_STORE.path}")
+        return 0
+    for job in JOB_STORE.history(user_id=args.user, song=args.song, status=args.status, limit=args.limit):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(job["created_at"]))
+        window = f"{job['start_time']:g}-{job['end_time']:g}s" if job["start_time"] is not None else "-"
+        print(f"{created}  {job['id']}  {job['status']:9s}  user {job['user_id'] or '-':12s}  {job['song_title'] or job['spotify_url']}  {window}  {job['final_video_path'] or job['error'] or ''}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
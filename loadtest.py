@@ -0,0 +1,494 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import threading
+import collections
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import benchmark
+import metrics
+
+# End-to-end load test of the bot: N simulated users go through the /generate conversation
+# (fake Telegram updates into the real handlers), and every upstream (RapidAPI, scrape.do, the
+# MP3 host, lrclib, OpenAI) is a local stand-in with configurable latency and failures.
+# Jobs run through the real scheduler, pipeline and renderer.
+#
+#   python loadtest.py --users 4
+#   python loadtest.py --users 8 --rounds 2 --latency scrape.do=20:5 --latency openai=15 --fail scrape.do=0.2
+
+SERVICES = ("rapidapi", "scrape.do", "audio", "lrclib", "openai")
+TRACK_SECONDS = 180
+IMAGE_SIZE = (1024, 1536)
+
+#LOCAL STAND-INS FOR THE UPSTREAMS
+
+class Fault:
+    # Latency (seconds, +- uniform jitter) and the share of requests answered with an error status
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+class FakeUpstreams:
+    # One local HTTP server for all services, each under its own path prefix
+    def __init__(self, workdir, faults=None):
+        self.faults = {name: Fault() for name in SERVICES}
+        self.faults.update(faults or {})
+        self.stats = {name: {"requests": 0, "errors": 0} for name in SERVICES}
+        self.lock = threading.Lock()
+
+        print("Preparing fake upstream data...")
+        audio_path = benchmark.synthetic_audio(os.path.join(workdir, "track.mp3"), TRACK_SECONDS)
+        with open(audio_path, "rb") as f:
+            self.audio = f.read()
+        image_path = benchmark.synthetic_background(os.path.join(workdir, "image.png"), *IMAGE_SIZE)
+        with open(image_path, "rb") as f:
+            self.image_b64 = base64.b64encode(f.read()).decode("ascii")
+        self.lyrics = {}
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-upstreams", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def environment(self):
+        # What api.py and the OpenAI SDK read to talk to us instead of the real services
+        return {
+            "RAPIDAPI_URL": f"{self.base_url}/rapidapi/download",
+            "SCRAPE_DO_URL": f"{self.base_url}/scrape.do/",
+            "LRCLIB_SEARCH_URL": f"{self.base_url}/lrclib/api/search",
+            "OPENAI_BASE_URL": f"{self.base_url}/openai/v1",
+            "OPENAI_API_KEY": "load-test",
+            "RAPID_API_KEY": "load-test",
+            "SCRAPE_DO_API_KEY": "load-test",
+        }
+
+    def audio_url(self, track_id):
+        return f"{self.base_url}/audio/{track_id}.mp3"
+
+    def title(self, track_id):
+        # Unlike each other, so the lyrics store can't fuzzy match one song to another
+        return f"Song {hashlib.sha1(track_id.encode('ascii')).hexdigest()[:12]}"
+
+    def synced_lyrics(self, title):
+        # Different lines per song, so prompts and backgrounds aren't shared between songs
+        with self.lock:
+            if title not in self.lyrics:
+                lines = benchmark.synthetic_lyrics(TRACK_SECONDS, seed=sum(title.encode("utf-8")))
+                self.lyrics[title] = "\n".join(f"[{line['time']}] {line['lyric']}" for line in lines)
+            return self.lyrics[title]
+
+    def handler_class(self):
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real services
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.route("GET")
+
+            def do_POST(self):
+                self.route("POST")
+
+            def route(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if method == "POST":
+                    self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+                service = url.path.strip("/").split("/")[0]
+                if service not in fakes.faults:
+                    return self.send_json({"error": "not found"}, 404)
+                fault = fakes.faults[service]
+                time.sleep(fault.delay())
+                failed = random.random() < fault.error_rate
+                with fakes.lock:
+                    fakes.stats[service]["requests"] += 1
+                    fakes.stats[service]["errors"] += failed
+                if failed:
+                    return self.send_json({"error": {"message": "injected failure", "type": "server_error"}}, fault.error_status)
+
+                if service == "rapidapi":
+                    track_id = track_id_of(query.get("link", [""])[0])
+                    return self.send_json({"data": {"title": fakes.title(track_id), "medias": [{"url": fakes.audio_url(track_id)}]}})
+                if service == "scrape.do":
+                    track_id = track_id_of(query.get("playWithBrowser", [""])[0])
+                    return self.send_json({"networkRequests": [
+                        {"url": "https://spotmate.online/getTrackData", "response_body": json.dumps({"name": fakes.title(track_id)})},
+                        {"url": "https://spotmate.online/convert", "response_body": json.dumps({"url": fakes.audio_url(track_id)})},
+                    ]})
+                if service == "audio":
+                    return self.send_ranged(fakes.audio)
+                if service == "lrclib":
+                    title = query.get("q", [""])[0]
+                    return self.send_json([{"id": 1, "trackName": title, "artistName": "Load Test", "syncedLyrics": fakes.synced_lyrics(title)}])
+                if url.path.endswith("/responses"):
+                    return self.send_json(openai_response("<prompt>A quiet village at dusk, Studio Ghibli style</prompt>"))
+                if url.path.endswith(("/images/generations", "/images/edits")):
+                    return self.send_json({"created": int(time.time()), "data": [{"b64_json": fakes.image_b64}]})
+                self.send_json({"error": "not found"}, 404)
+
+            def send_json(self, payload, status=200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_ranged(self, data):
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if match:
+                    first = int(match.group(1))
+                    last = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+                    data = data[first:last + 1]
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "audio/mpeg")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+def track_id_of(text):
+    match = re.search(r"track[/:]([A-Za-z0-9]{22})", text)
+    return match.group(1) if match else "0" * 22
+
+def openai_response(text):
+    # Minimal Responses API answer, enough for response.output_text
+    return {
+        "id": "resp_loadtest",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": "gpt-4.1",
+        "status": "completed",
+        "output": [{
+            "type": "message",
+            "id": "msg_loadtest",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+    }
+
+#FAKE TELEGRAM
+
+class FakeTelegram(BaseRequest):
+    # Stands in for the Bot API: answers the bot's calls locally and hands every message
+    # sent to a chat to that chat's queue, where the simulated user reads it
+    def __init__(self, photo_bytes):
+        self.photo_bytes = photo_bytes
+        self.message_ids = itertools.count(1)
+        self.chats = collections.defaultdict(asyncio.Queue)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if "/file/bot" in url:
+            return 200, self.photo_bytes + url.encode("utf-8") # A different photo per user, PNG readers ignore the tail
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Lyrics Bot", "username": "lyrics_load_bot"}
+        elif api_method in ("sendMessage", "sendVideo", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            result = bot_message(next(self.message_ids), chat_id, params.get("text") or params.get("caption"))
+            self.chats[chat_id].put_nowait((api_method, params.get("text") or params.get("caption"), time.monotonic()))
+        elif api_method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.photo_bytes), "file_path": f"photos/{file_id}.jpg"}
+        elif api_method == "getUpdates":
+            result = []
+        else:
+            result = True # answerCallbackQuery, deleteWebhook, ...
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+def bot_message(message_id, chat_id, text=None):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "Lyrics Bot"},
+    }
+    if text:
+        message["text"] = text
+    return message
+
+#SIMULATED USERS
+
+class SimulatedUser:
+    # Goes through /generate like a person would and records when the video arrives
+    def __init__(self, application, telegram, user_id, track_id, source, clip, think):
+        self.application = application
+        self.telegram = telegram
+        self.user_id = user_id
+        self.track_id = track_id
+        self.source = source
+        self.clip = clip
+        self.think = think
+        self.update_ids = itertools.count(user_id * 1000)
+        self.message_ids = itertools.count(1)
+
+    def user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"User {self.user_id}"}
+
+    def message(self, **fields):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": self.user_id, "type": "private"}, "from": self.user()}
+        message.update(fields)
+        return message
+
+    async def send(self, payload):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.think)
+        payload["update_id"] = next(self.update_ids)
+        await self.application.process_update(Update.de_json(payload, self.application.bot))
+
+    async def text(self, text):
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.send({"message": self.message(**fields)})
+
+    async def press(self, data):
+        query = {"id": str(next(self.update_ids)), "from": self.user(), "chat_instance": str(self.user_id), "data": data,
+                 "message": bot_message(next(self.message_ids), self.user_id, "Choose")}
+        await self.send({"callback_query": query})
+
+    async def photo(self):
+        file_id = f"photo{self.user_id}"
+        size = len(self.telegram.photo_bytes)
+        await self.send({"message": self.message(photo=[{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": IMAGE_SIZE[0], "height": IMAGE_SIZE[1], "file_size": size}])})
+
+    async def generate(self, timeout):
+        # One /generate conversation; returns a result dict for the report
+        inbox = self.telegram.chats[self.user_id]
+        while not inbox.empty():
+            inbox.get_nowait()
+        started = time.monotonic()
+        await self.text("/generate")
+        await self.text(f"https://open.spotify.com/track/{self.track_id}")
+        await self.text(f"{self.clip[0]} {self.clip[1]}")
+        if self.source == "lyrics":
+            await self.press("img_src_lyrics")
+        else:
+            await self.press("img_src_raw_ghibli")
+            await self.photo()
+        await self.text("1")
+        await self.text("Use title from Spotify")
+        submitted = time.monotonic()
+        JOB_STARTS.pop(self.user_id, None)
+
+        result = {"user": self.user_id, "conversation_seconds": round(submitted - started, 3), "status": "timeout"}
+        deadline = submitted + timeout
+        while True:
+            try:
+                method, text, at = await asyncio.wait_for(inbox.get(), max(0.1, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            if text and text.startswith("Sorry, too many videos"):
+                result["status"] = "rejected"
+                break
+            if text and text.startswith("Sorry, an error occurred"):
+                result["status"] = "failed"
+                result["error"] = text
+                break
+            if method == "sendVideo" and text and text.startswith("Draft"):
+                result["draft_seconds"] = round(at - submitted, 3)
+                continue
+            if method == "sendVideo":
+                result["status"] = "completed"
+                break
+        finished = time.monotonic()
+        result["job_seconds"] = round(finished - submitted, 3)
+        if self.user_id in JOB_STARTS:
+            result["queue_seconds"] = round(JOB_STARTS[self.user_id] - submitted, 3)
+        return result
+
+JOB_STARTS = {} # user_id -> when a scheduler worker picked their job up
+
+def summarize(results, wall_seconds, upstreams, retries):
+    completed = [r for r in results if r["status"] == "completed"]
+    summary = {
+        "jobs": len(results),
+        "completed": len(completed),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "rejected": sum(r["status"] == "rejected" for r in results),
+        "timeout": sum(r["status"] == "timeout" for r in results),
+        "wall_seconds": round(wall_seconds, 1),
+        "jobs_per_minute": round(len(completed) / wall_seconds * 60, 2) if wall_seconds else None,
+        "upstreams": upstreams,
+        "retries": retries,
+    }
+    for name, key, pool in (("job", "job_seconds", completed), ("draft", "draft_seconds", results), ("queue", "queue_seconds", results)):
+        values = [r[key] for r in pool if key in r]
+        summary[name] = {f"p{q}": metrics.percentile(values, q) for q in (50, 95, 99)}
+        summary[name]["max"] = max(values) if values else None
+    return summary
+
+def print_summary(summary):
+    print("\n--------------------")
+    print(f"Jobs: {summary['jobs']}  completed {summary['completed']}  failed {summary['failed']}  rejected {summary['rejected']}  timed out {summary['timeout']}")
+    print(f"Wall time: {summary['wall_seconds']}s  throughput: {summary['jobs_per_minute']} jobs/min")
+    for name, label in (("job", "Job latency (submit -> video)"), ("draft", "Draft latency (submit -> draft)"), ("queue", "Queue delay")):
+        stats = {key: "-" if value is None else f"{value:.1f}s" for key, value in summary[name].items()}
+        print(f"{label}: p50 {stats['p50']}  p95 {stats['p95']}  p99 {stats['p99']}  max {stats['max']}")
+    for service, stats in summary["upstreams"].items():
+        print(f"  {service:10s} requests {stats['requests']:5d}  injected errors {stats['errors']:4d}  retries {summary['retries'].get(service, 0)}")
+    print("--------------------")
+
+def parse_fault_options(latencies, failures):
+    # --latency service=seconds[:jitter], --fail service=rate[:status]
+    faults = {name: Fault() for name in SERVICES}
+    for option, kind in [(o, "latency") for o in latencies or []] + [(o, "fail") for o in failures or []]:
+        service, _, value = option.partition("=")
+        if service not in faults or not value:
+            raise SystemExit(f"Bad --{kind} '{option}', expected one of {SERVICES}=value")
+        first, _, second = value.partition(":")
+        if kind == "latency":
+            faults[service].latency, faults[service].jitter = float(first), float(second or 0)
+        else:
+            faults[service].error_rate = float(first)
+            if second:
+                faults[service].error_status = int(second)
+    return faults
+
+async def run_load(bot, telegram, args):
+    application = bot.build_application("123456:LOADTEST", request=telegram)
+    original_job = bot.run_generation_job
+
+    async def timed_job(tg_bot, chat_id, user_id, data, vid_id):
+        JOB_STARTS[user_id] = time.monotonic()
+        return await original_job(tg_bot, chat_id, user_id, data, vid_id)
+    bot.run_generation_job = timed_job # process_generation looks the job function up at call time
+
+    await application.initialize()
+    await bot.start_scheduler(application)
+    try:
+        songs = [f"{i:022d}" for i in range(args.songs or args.users)]
+        users = [
+            SimulatedUser(application, telegram, 1000 + i, songs[i % len(songs)],
+                          "photo" if random.random() < args.photo_share else "lyrics", args.clip, args.think)
+            for i in range(args.users)
+        ]
+
+        async def run_user(index, user):
+            await asyncio.sleep(args.ramp * index / max(1, args.users))
+            results = []
+            for _ in range(args.rounds):
+                results.append(await user.generate(args.timeout))
+            return results
+
+        started = time.monotonic()
+        per_user = await asyncio.gather(*(run_user(i, user) for i, user in enumerate(users)))
+        return [r for results in per_user for r in results], time.monotonic() - started
+    finally:
+        bot.run_generation_job = original_job
+        await bot.stop_scheduler(application)
+        await application.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the bot against local fake upstreams")
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=1, help="videos each user asks for, one after another")
+    parser.add_argument("--ramp", type=float, default=0, help="seconds over which the users arrive")
+    parser.add_argument("--think", type=float, default=0.2, help="average seconds a user takes per message")
+    parser.add_argument("--clip", type=int, nargs=2, default=[30, 40], metavar=("START", "END"))
+    parser.add_argument("--songs", type=int, default=0, help="distinct tracks (default: one per user, so caches are cold)")
+    parser.add_argument("--photo-share", type=float, default=0.5, help="share of users uploading a photo instead of lyrics based backgrounds")
+    parser.add_argument("--latency", action="append", help="service=seconds[:jitter], services: " + ", ".join(SERVICES))
+    parser.add_argument("--fail", action="append", help="service=rate[:status], e.g. scrape.do=0.2")
+    parser.add_argument("--render-workers", type=int, help="RENDER_WORKERS for the bot")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds to wait for each video")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="lyrics_load_")
+    upstreams = FakeUpstreams(workdir, parse_fault_options(args.latency, args.fail)).start()
+    # Fresh caches so every job really talks to the (fake) upstreams
+    os.environ.update(upstreams.environment())
+    os.environ["CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["JOB_STORE_PATH"] = os.path.join(workdir, "jobs.db")
+    os.environ["JOB_DEDUP"] = "0" # Users repeating a request still render it
+    os.environ["METRICS_PORT"] = os.environ.get("METRICS_PORT", "0")
+    if args.render_workers:
+        os.environ["RENDER_WORKERS"] = str(args.render_workers)
+
+    before = {folder: set(os.listdir(folder)) if os.path.isdir(folder) else set() for folder in ("outputs", "data", "temp")}
+    import bot # After the environment is set up, api/cache/bot read it at import
+    import http_client
+
+    with open(os.path.join(workdir, "image.png"), "rb") as f:
+        telegram = FakeTelegram(f.read())
+    try:
+        results, wall_seconds = asyncio.run(run_load(bot, telegram, args))
+    finally:
+        upstreams.stop()
+        # Leave outputs/, data/ and temp/ as they were
+        for folder, names in before.items():
+            if not os.path.isdir(folder):
+                continue
+            for name in set(os.listdir(folder)) - names:
+                path = os.path.join(folder, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    retries = {service: http_client.UPSTREAM_RETRIES.value(upstream=service) for service in SERVICES} # Upstream names match the services
+    summary = summarize(results, wall_seconds, upstreams.stats, retries)
+    summary["settings"] = vars(args)
+    summary["results"] = results
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
+        print(f"Results written to {args.output}")
+    return 0 if summary["completed"] == summary["jobs"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import re
+import json
+from bisect import bisect_left
+
+LRC_LINE = re.compile(r"\[(\d{2}):(\d{2}\.\d{2,3})\] ?(.*)")
+LRC_WORD = re.compile(r"<(\d{2}):(\d{2}\.\d{2,3})>") # Enhanced LRC: "<mm:ss.xx>word" inside a line
+
+def format_time(seconds):
+    # 75.5 -> "01:15.50", the LRC / lyrics JSON timestamp format
+    mins, secs = divmod(round(seconds, 2), 60)
+    return f"{int(mins):02d}:{secs:05.2f}"
+
+def parse_time(text):
+    mins, secs = text.split(":")
+    return int(mins) * 60 + float(secs)
+
+def parse_words(line_time, text):
+    # Enhanced LRC line -> (plain text, [(start seconds, chunk), ...]) or (text, None) without
+    # word tags. Chunks keep their spacing, so they join back into the text; a tag with
+    # nothing after it marks when the last word ends.
+    parts = LRC_WORD.split(text)
+    if len(parts) == 1:
+        return text.strip(), None
+    words = []
+    if parts[0].strip():
+        words.append((line_time, parts[0]))
+    for i in range(1, len(parts), 3):
+        words.append((int(parts[i]) * 60 + float(parts[i + 1]), parts[i + 2]))
+    # Strip the line's outer whitespace from the first/last chunks only
+    if words:
+        words[0] = (words[0][0], words[0][1].lstrip())
+        words[-1] = (words[-1][0], words[-1][1].rstrip())
+    return "".join(chunk for _, chunk in words), words
+
+class Lyrics:
+    # Synced lyrics parsed once: start times in seconds (sorted), the line texts and, for
+    # enhanced LRC, each line's word timings, as parallel lists. Empty lines are instrumental
+    # gaps; they only matter as the end of the line before them when they come last, so the
+    # others are dropped on parsing.
+    __slots__ = ("times", "texts", "words")
+
+    def __init__(self, times, texts, words=None):
+        words = words or [None] * len(times)
+        order = sorted(range(len(times)), key=lambda i: times[i]) # Stable, LRC files are almost always sorted already
+        keep = [i for n, i in enumerate(order) if texts[i] or n == len(order) - 1]
+        self.times = [times[i] for i in keep]
+        self.texts = [texts[i] for i in keep]
+        self.words = [words[i] for i in keep]
+
+    @classmethod
+    def from_lrc(cls, lrc):
+        times, texts, words = [], [], []
+        for mins, secs, text in LRC_LINE.findall(lrc):
+            line_time = int(mins) * 60 + float(secs)
+            text, line_words = parse_words(line_time, text)
+            times.append(line_time)
+            texts.append(text)
+            words.append(line_words)
+        return cls(times, texts, words)
+
+    @classmethod
+    def from_records(cls, records):
+        # [{"time": "mm:ss.xx", "lyric": str, "words": [["mm:ss.xx", chunk], ...] (optional)}],
+        # the lyrics_*.json format
+        return cls(
+            [parse_time(record["time"]) for record in records],
+            [record["lyric"] for record in records],
+            [[(parse_time(t), chunk) for t, chunk in record["words"]] if record.get("words") else None for record in records],
+        )
+
+    def to_records(self):
+        records = []
+        for t, text, line_words in zip(self.times, self.texts, self.words):
+            record = {"time": format_time(t), "lyric": text}
+            if line_words:
+                record["words"] = [[format_time(word_time), chunk] for word_time, chunk in line_words]
+            records.append(record)
+        return records
+
+    def __len__(self):
+        return len(self.times)
+
+    def window(self, start_time, end_time):
+        # Index range of the lines that start inside [start_time, end_time)
+        return bisect_left(self.times, start_time), bisect_left(self.times, end_time)
+
+    def clip(self, start_time, end_time, adjusted_time=0.30):
+        # Returns (text entries for the renderer, the clip's lines as prompt text). Times in the
+        # entries are relative to start_time; a line lasts until the next one starts or the
+        # clip ends. adjusted_time delays every line's appearance a little.
+        first, last = self.window(start_time, end_time)
+        entries, lines = [], []
+        for i in range(first, last):
+            if not self.texts[i]:
+                continue # Trailing empty line
+            line_end = min(self.times[i + 1], end_time) if i + 1 < len(self.times) else end_time
+            entry = {
+                "start_time": self.times[i] - start_time + adjusted_time,
+                "end_time": line_end - start_time,
+                "text": self.texts[i],
+            }
+            if self.words[i]:
+                # Word timings follow the audio, without the display delay
+                entry["words"] = [(word_time - start_time, chunk) for word_time, chunk in self.words[i]]
+            entries.append(entry)
+            lines.append(f"{self.texts[i]}\n")
+        return entries, "".join(lines)
+
+def as_lyrics(lyrics):
+    # Accepts a Lyrics object, LRC text or lyrics JSON records
+    if isinstance(lyrics, Lyrics):
+        return lyrics
+    if isinstance(lyrics, str):
+        return Lyrics.from_lrc(lyrics)
+    return Lyrics.from_records(lyrics)
+
+def save(lyrics, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(lyrics.to_records(), f, ensure_ascii=False, indent=2)
+    return path
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import unicodedata
+from difflib import SequenceMatcher
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+LYRICS_CACHE_MAX_BYTES = int(os.getenv("LYRICS_CACHE_MB", "256")) * cache.MB
+LYRICS_OFFLINE = os.getenv("LYRICS_OFFLINE", "0") == "1" # Serve only from the local index, never call lrclib
+MISS_TTL = 24 * 60 * 60 # Seconds a "not found" answer is remembered
+FUZZY_THRESHOLD = 0.85 # Minimum similarity of phonetic keys for a fuzzy hit
+
+class LyricsNotFound(ValueError):
+    pass
+
+#SINHALA -> LATIN, only precise enough to line up with how people romanize song titles
+SINHALA_VOWELS = {
+    "අ": "a", "ආ": "aa", "ඇ": "ae", "ඈ": "aae", "ඉ": "i", "ඊ": "ii", "උ": "u", "ඌ": "uu",
+    "ඍ": "ru", "ඎ": "ruu", "එ": "e", "ඒ": "ee", "ඓ": "ai", "ඔ": "o", "ඕ": "oo", "ඖ": "au",
+}
+SINHALA_CONSONANTS = {
+    "ක": "k", "ඛ": "kh", "ග": "g", "ඝ": "gh", "ඞ": "ng", "ඟ": "ng", "ච": "ch", "ඡ": "chh",
+    "ජ": "j", "ඣ": "jh", "ඤ": "ny", "ඥ": "gn", "ඦ": "nj", "ට": "t", "ඨ": "th", "ඩ": "d",
+    "ඪ": "dh", "ණ": "n", "ඬ": "nd", "ත": "th", "ථ": "th", "ද": "d", "ධ": "dh", "න": "n",
+    "ඳ": "nd", "ප": "p", "ඵ": "ph", "බ": "b", "භ": "bh", "ම": "m", "ඹ": "mb", "ය": "y",
+    "ර": "r", "ල": "l", "ව": "v", "ශ": "sh", "ෂ": "sh", "ස": "s", "හ": "h", "ළ": "l", "ෆ": "f",
+}
+SINHALA_SIGNS = {
+    "ා": "aa", "ැ": "ae", "ෑ": "aae", "ි": "i", "ී": "ii", "ු": "u", "ූ": "uu", "ෘ": "ru",
+    "ෲ": "ruu", "ෙ": "e", "ේ": "ee", "ෛ": "ai", "ො": "o", "ෝ": "oo", "ෞ": "au",
+}
+SINHALA_MODIFIERS = {"ං": "ng", "ඃ": "h"}
+HAL = "\u0dca"
+ZWJ = "\u200d"
+
+def transliterate_sinhala(text):
+    out = []
+    for i, char in enumerate(text):
+        if char in SINHALA_CONSONANTS:
+            out.append(SINHALA_CONSONANTS[char])
+            following = text[i + 1] if i + 1 < len(text) else ""
+            if following not in SINHALA_SIGNS and following != HAL:
+                out.append("a") # Inherent vowel
+        elif char in SINHALA_VOWELS:
+            out.append(SINHALA_VOWELS[char])
+        elif char in SINHALA_SIGNS:
+            out.append(SINHALA_SIGNS[char])
+        elif char in SINHALA_MODIFIERS:
+            out.append(SINHALA_MODIFIERS[char])
+        elif char in (HAL, ZWJ):
+            continue
+        else:
+            out.append(char)
+    return "".join(out)
+
+def normalize_title(title):
+    # Lowercase, no accents, no "(feat. ...)"/"[Remastered]"/" - Live" decorations, single spaces
+    title = unicodedata.normalize("NFKC", title or "").lower()
+    title = re.sub(r"[\(\[].*?[\)\]]", " ", title)
+    title = re.sub(r"\s+-\s+.*$", " ", title)
+    title = "".join(c for c in unicodedata.normalize("NFKD", title) if not unicodedata.combining(c) or "\u0d80" <= c <= "\u0dff")
+    title = re.sub(r"[^\w\s\u0d80-\u0dff\u200d]", " ", title) # Sinhala signs and ZWJ are not \w
+    return re.sub(r"\s+", " ", title).strip()
+
+def phonetic_key(title):
+    # Spelling-insensitive key, so "Sanda Kinnarie", "sandakinnari" and "සඳ කින්නරී" meet
+    key = transliterate_sinhala(normalize_title(title))
+    key = re.sub(r"[^a-z0-9]", "", key)
+    for pattern, replacement in (("th", "t"), ("dh", "d"), ("kh", "k"), ("gh", "g"), ("bh", "b"),
+                                 ("ph", "p"), ("sh", "s"), ("ch", "c"), ("jh", "j"), ("w", "v"),
+                                 ("ae", "a"), ("ee", "i"), ("ie", "i"), ("y", "i"), ("oo", "u")):
+        key = key.replace(pattern, replacement)
+    return re.sub(r"(.)\1+", r"\1", key) # Long vowels / doubled letters
+
+def title_key(title):
+    return "title_" + cache.hash_key(normalize_title(title))[:32]
+
+def track_key(track_id):
+    return "track_" + cache.hash_key(track_id)[:32]
+
+class LyricsStore:
+    # Synced lyrics (raw LRC) cached per normalized title and per Spotify track ID, plus an
+    # in-memory index of every cached title for fuzzy lookups. Misses are cached for MISS_TTL.
+    def __init__(self, max_bytes=LYRICS_CACHE_MAX_BYTES, offline=LYRICS_OFFLINE):
+        self.store = cache.DiskLRUCache("lyrics", max_bytes)
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.index = None # phonetic key -> entry key
+
+    def load_index(self):
+        index = {}
+        for _, _, entry_dir in self.store.entries():
+            try:
+                with open(os.path.join(entry_dir, cache.META_FILE), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not meta.get("miss") and meta.get("phonetic"):
+                index[meta["phonetic"]] = meta["key"]
+        return index
+
+    def fuzzy_lookup(self, title):
+        with self.lock:
+            if self.index is None:
+                self.index = self.load_index()
+            index = dict(self.index)
+        wanted = phonetic_key(title)
+        if not wanted:
+            return None
+        if wanted in index:
+            return self.store.get(index[wanted], count=False)
+        best_key, best_score = None, 0
+        for candidate, key in index.items():
+            score = SequenceMatcher(None, wanted, candidate).ratio()
+            if score > best_score:
+                best_key, best_score = key, score
+        if best_score >= FUZZY_THRESHOLD:
+            logger.info(f"Fuzzy lyrics hit for '{title}' (score {best_score:.2f})")
+            return self.store.get(best_key, count=False)
+        return None
+
+    def read(self, meta):
+        with open(os.path.join(meta["dir"], "lyrics.lrc"), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def creator(self, title, synced_lyrics, track_id=None, source=None):
+        # The create(entry_dir) callback DiskLRUCache.put runs to write a lyrics entry
+        meta_fields = {
+            "title": title,
+            "normalized": normalize_title(title),
+            "phonetic": phonetic_key(title),
+            "track_id": track_id,
+            "source": source,
+        }
+
+        def create(entry_dir):
+            with open(os.path.join(entry_dir, "lyrics.lrc"), "w", encoding="utf-8") as f:
+                f.write(synced_lyrics)
+            return dict(meta_fields)
+
+        return create
+
+    def save(self, title, synced_lyrics, track_id=None, source=None):
+        create = self.creator(title, synced_lyrics, track_id=track_id, source=source)
+        keys = [title_key(title)] + ([track_key(track_id)] if track_id else [])
+        for key in keys:
+            self.store.remove(key) # Replaces an expired "not found" entry
+            self.store.put(key, create)
+        with self.lock:
+            if self.index is not None:
+                self.index[phonetic_key(title)] = keys[0]
+
+    def bind_track(self, track_id, meta, synced_lyrics):
+        # Points the track at lyrics found by title. Only the track entry is written, and only
+        # when it is missing or holds other lyrics, so repeated hits don't rewrite anything.
+        key = track_key(track_id)
+        bound = self.store.get(key, count=False)
+        if bound is not None and not bound.get("miss"):
+            try:
+                if self.read(bound) == synced_lyrics:
+                    return
+            except OSError: # Evicted meanwhile
+                pass
+        create = self.creator(meta["title"], synced_lyrics, track_id=track_id, source=meta.get("source"))
+        self.store.remove(key)
+        self.store.put(key, create)
+
+    def save_miss(self, title):
+        self.store.remove(title_key(title))
+        self.store.put(title_key(title), lambda entry_dir: {"title": title, "miss": True, "expires": time.time() + MISS_TTL})
+
+    def lookup(self, title, fetch, track_id=None, custom_title=False):
+        # fetch(title) -> (synced lyrics or None, source info) is only called when nothing local matches.
+        # custom_title: the user typed the title to override what the track finds, so the track's
+        # entry is skipped and the lyrics the title finds replace it. Only exact title hits and
+        # fetched lyrics are bound to the track; a wrong fuzzy match would stick to it for good.
+        keys = ([track_key(track_id)] if track_id and not custom_title else []) + [title_key(title)]
+        for key in keys:
+            meta = self.store.get(key, count=False)
+            if meta is None:
+                continue
+            if meta.get("miss"):
+                if meta.get("expires", 0) > time.time():
+                    cache.CACHE_REQUESTS.inc(cache="lyrics", result="negative_hit")
+                    raise LyricsNotFound(f"No synced lyrics found for '{title}' (cached)")
+                continue
+            cache.CACHE_REQUESTS.inc(cache="lyrics", result="hit")
+            synced_lyrics = self.read(meta)
+            if track_id and key != track_key(track_id):
+                self.bind_track(track_id, meta, synced_lyrics)
+            return synced_lyrics
+
+        meta = self.fuzzy_lookup(title)
+        if meta is not None:
+            cache.CACHE_REQUESTS.inc(cache="lyrics", result="fuzzy_hit")
+            return self.read(meta)
+
+        cache.CACHE_REQUESTS.inc(cache="lyrics", result="miss")
+        if self.offline:
+            raise LyricsNotFound(f"No cached synced lyrics for '{title}' (offline mode)")
+
+        synced_lyrics, source = fetch(title)
+        if not synced_lyrics:
+            self.save_miss(title)
+            raise LyricsNotFound(f"No synced lyrics found for '{title}'")
+        self.save(title, synced_lyrics, track_id=track_id, source=source)
+        return synced_lyrics
+
+LYRICS_STORE = LyricsStore()
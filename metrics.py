@@ -0,0 +1,329 @@
+import os
+import math
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource # Child process CPU time, not available on Windows
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# In-process counters, gauges and histograms, exported in the Prometheus text format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/) at /metrics.
+# Worker processes record into their own copy of the registry; the parent merges what
+# they drain() after each task.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FRAME_BUCKETS = (0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.125, 0.25, 0.5, 1)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {} # label values tuple -> value
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def merge(self, values):
+        with self.lock:
+            for key, amount in values.items():
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in items]
+
+class Gauge(Metric):
+    # A value that goes up and down, or a function read at scrape time (set_function)
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, fn):
+        self.function = fn
+
+    def merge(self, values):
+        with self.lock:
+            self.values.update(values)
+
+    def render(self):
+        if self.function is not None:
+            return self.header() + [f"{self.name} {format_value(self.function())}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in items]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def merge(self, values):
+        with self.lock:
+            for key, other in values.items():
+                series = self.values.get(key)
+                if series is None:
+                    self.values[key] = {"counts": list(other["counts"]), "sum": other["sum"], "count": other["count"]}
+                    continue
+                series["counts"] = [a + b for a, b in zip(series["counts"], other["counts"])]
+                series["sum"] += other["sum"]
+                series["count"] += other["count"]
+
+    def quantile(self, q, **labels):
+        # Upper bucket bound holding the q-th observation (what histogram_quantile() would estimate
+        # from above), None when nothing was observed
+        series = self.values.get(self.key(labels))
+        if not series or not series["count"]:
+            return None
+        rank, seen = q * series["count"], 0
+        for bound, count in zip(self.buckets, series["counts"]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((key, dict(series, counts=list(series["counts"]))) for key, series in self.values.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                labels = format_labels(self.labels, key, 'le="%s"' % format_value(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+class Timer:
+    # with histogram.time(label=...): ...
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def drain(self):
+        # Everything recorded since the last drain, as plain data that can cross a process boundary
+        return {name: values for name, metric in self.metrics.items() if (values := metric.drain())}
+
+    def merge(self, drained):
+        for name, values in (drained or {}).items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                logger.warning(f"Dropping values of unknown metric {name}")
+                continue
+            metric.merge(values)
+
+REGISTRY = Registry()
+
+def counter(name, help_text, labels=()):
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+def gauge(name, help_text, labels=()):
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+#METRICS SHARED BY SEVERAL MODULES
+STAGE_SECONDS = histogram("lyrics_job_stage_seconds", "Wall time of job stages, from start to finish.", ["stage"])
+STAGE_CPU_SECONDS = counter("lyrics_job_stage_cpu_seconds_total", "CPU time spent in job stages (including ffmpeg for CPU stages).", ["stage"])
+STAGE_IO_BYTES = counter("lyrics_job_stage_io_bytes_total", "Bytes read and written by job stages (files and sockets).", ["stage", "direction"])
+FRAME_SECONDS = histogram("lyrics_render_frame_seconds", "Time to compose and write one video frame.", ["loop"], buckets=FRAME_BUCKETS)
+
+#STAGE RESOURCE USAGE
+
+def io_counters():
+    # (bytes read, bytes written) by the calling thread, including sockets and pipes, or None
+    # where the kernel doesn't tell (only Linux does)
+    try:
+        with open("/proc/thread-self/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class StageUsage:
+    # Wall, CPU and I/O of one stage call, measured on the thread that runs it.
+    # Child CPU (ffmpeg, segment workers) is counted per process, so it's only
+    # attributed to stages that have their worker process to themselves.
+    def __init__(self, include_children=False):
+        self.include_children = include_children
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.children = children_cpu() if self.include_children else 0.0
+        self.io = io_counters()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.thread_time() - self.cpu
+        if self.include_children:
+            self.children = children_cpu() - self.children
+        io = io_counters()
+        self.io = (io[0] - self.io[0], io[1] - self.io[1]) if io and self.io else None
+
+    def record(self):
+        record = {
+            "run_seconds": round(self.wall, 3),
+            "cpu_seconds": round(self.cpu, 3),
+        }
+        if self.include_children:
+            record["child_cpu_seconds"] = round(self.children, 3)
+        if self.io is not None:
+            record["read_bytes"], record["write_bytes"] = self.io
+        return record
+
+#SUMMARIES
+
+def percentile(values, q):
+    # Nearest rank: the smallest value with at least q% of the values at or below it
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered) / 100) - 1)]
+
+#EXPORTER
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the log
+
+def start_exporter(port, host="127.0.0.1"):
+    # Serve /metrics from a daemon thread; returns the server (server.shutdown() stops it)
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def write_textfile(path, registry=REGISTRY):
+    # For scripts: node_exporter's textfile collector (or anything else) can pick this up
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,273 @@
+import math
+import struct
+
+#MPEG AUDIO LAYER III FRAME HEADERS
+MPEG1, MPEG2, MPEG25 = 1, 2, 25
+BITRATES = { # kbit/s by bitrate index
+    MPEG1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    MPEG2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+BITRATES[MPEG25] = BITRATES[MPEG2]
+SAMPLE_RATES = {
+    MPEG1: (44100, 48000, 32000),
+    MPEG2: (22050, 24000, 16000),
+    MPEG25: (11025, 12000, 8000),
+}
+VERSIONS = {0b00: MPEG25, 0b10: MPEG2, 0b11: MPEG1}
+
+ID3V1_SIZE = 128
+DECODER_DELAY = 529 # Samples, trimmed along with the encoder delay when a LAME tag says so
+
+class FrameHeader:
+    def __init__(self, version, bitrate, sample_rate, padding, channel_mode):
+        self.version = version
+        self.bitrate = bitrate # kbit/s
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channel_mode = channel_mode # 3 = mono
+        self.samples = 1152 if version == MPEG1 else 576
+        self.length = (144 if version == MPEG1 else 72) * bitrate * 1000 // sample_rate + padding
+
+    @property
+    def duration(self):
+        return self.samples / self.sample_rate
+
+    @property
+    def side_info_size(self):
+        if self.version == MPEG1:
+            return 17 if self.channel_mode == 3 else 32
+        return 9 if self.channel_mode == 3 else 17
+
+def parse_frame_header(data, pos=0):
+    # Layer III header at data[pos:pos+4], or None (free-format and reserved values included)
+    if pos + 4 > len(data):
+        return None
+    b1, b2, b3, b4 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+    if b1 != 0xFF or (b2 & 0xE0) != 0xE0:
+        return None
+    version = VERSIONS.get((b2 >> 3) & 0b11)
+    if version is None or (b2 >> 1) & 0b11 != 0b01: # Layer III only
+        return None
+    bitrate_index = b3 >> 4
+    sample_rate_index = (b3 >> 2) & 0b11
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    return FrameHeader(
+        version,
+        BITRATES[version][bitrate_index],
+        SAMPLE_RATES[version][sample_rate_index],
+        (b3 >> 1) & 1,
+        b4 >> 6,
+    )
+
+def id3v2_size(data):
+    # Bytes taken by a leading ID3v2 tag (0 if there is none)
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9] # Syncsafe integer
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def find_frame(data, start=0, confirm=2):
+    # Offset of the first frame header at or after start that is followed by `confirm`
+    # more valid headers (a lone 0xFFE sync pattern inside tag or audio data is common)
+    pos = start
+    while True:
+        pos = data.find(b"\xff", pos)
+        if pos < 0 or pos + 4 > len(data):
+            return None
+        header = parse_frame_header(data, pos)
+        if header is not None:
+            following, ok = pos + header.length, True
+            for _ in range(confirm):
+                if following + 4 > len(data):
+                    break # Not enough data to check, trust what we have
+                next_header = parse_frame_header(data, following)
+                if next_header is None or next_header.sample_rate != header.sample_rate:
+                    ok = False
+                    break
+                following += next_header.length
+            if ok:
+                return pos
+        pos += 1
+
+class StreamInfo:
+    # What the head of an MP3 file tells us: where the audio starts, how it's encoded and,
+    # from a Xing/Info or VBRI header, its length and seek table
+    def __init__(self, audio_start, header, file_size=None):
+        self.audio_start = audio_start # First audio frame (after ID3v2 and any Xing/VBRI frame)
+        self.header = header
+        self.file_size = file_size
+        self.frames = None
+        self.audio_bytes = None
+        self.toc = None # Xing: 100 entries, byte position (0-255 of audio_bytes) at each percent
+        self.vbri_table = None # VBRI: cumulative byte offsets, one per vbri_frames_per_entry frames
+        self.vbri_frames_per_entry = None
+        self.vbr = False
+        self.encoder_delay = None # Samples of encoder padding at the start, from a LAME tag
+
+    @property
+    def start_skip(self):
+        # Seconds decoders drop from the start of this file (only files with a LAME tag get this)
+        if self.encoder_delay is None:
+            return 0.0
+        return (self.encoder_delay + DECODER_DELAY) / self.header.sample_rate
+
+    @property
+    def duration(self):
+        if self.frames:
+            return self.frames * self.header.duration
+        if self.audio_bytes:
+            return self.audio_bytes * 8 / (self.header.bitrate * 1000)
+        return None
+
+    def byte_offset(self, seconds):
+        # Estimated file offset of the frame playing at `seconds`, or None when we can't tell
+        seconds = max(0.0, seconds)
+        if not self.vbr:
+            return self.audio_start + int(seconds * self.header.bitrate * 1000 / 8)
+
+        duration = self.duration
+        if not duration or not self.audio_bytes:
+            return None
+        seconds = min(seconds, duration)
+        if self.toc is not None:
+            percent = seconds / duration * 100
+            index = min(int(percent), 99)
+            low = self.toc[index]
+            high = self.toc[index + 1] if index < 99 else 256
+            position = low + (high - low) * (percent - index)
+            return self.audio_start + int(position / 256 * self.audio_bytes)
+        if self.vbri_table is not None:
+            entry_seconds = self.vbri_frames_per_entry * self.header.duration
+            index = min(int(seconds / entry_seconds), len(self.vbri_table) - 1)
+            low = self.vbri_table[index - 1] if index > 0 else 0
+            high = self.vbri_table[index]
+            fraction = min(1.0, seconds / entry_seconds - index)
+            return self.audio_start + int(low + (high - low) * fraction)
+        return None
+
+def parse_xing(data, pos, header, info):
+    xing_pos = pos + 4 + header.side_info_size
+    tag = data[xing_pos:xing_pos + 4]
+    if tag not in (b"Xing", b"Info"):
+        return False
+    flags = struct.unpack(">I", data[xing_pos + 4:xing_pos + 8])[0]
+    cursor = xing_pos + 8
+    if flags & 1:
+        info.frames = struct.unpack(">I", data[cursor:cursor + 4])[0]
+        cursor += 4
+    if flags & 2:
+        info.audio_bytes = struct.unpack(">I", data[cursor:cursor + 4])[0]
+        cursor += 4
+    if flags & 4:
+        info.toc = list(data[cursor:cursor + 100])
+        cursor += 100
+    if flags & 8:
+        cursor += 4 # Quality
+    if data[cursor:cursor + 4] in (b"LAME", b"Lavf", b"Lavc") and len(data) >= cursor + 24:
+        info.encoder_delay = (data[cursor + 21] << 4) | (data[cursor + 22] >> 4)
+    info.vbr = tag == b"Xing" # LAME writes "Info" for CBR files
+    return True
+
+def parse_vbri(data, pos, header, info):
+    vbri_pos = pos + 4 + 32
+    if data[vbri_pos:vbri_pos + 4] != b"VBRI":
+        return False
+    audio_bytes, frames, entries, scale, entry_size, frames_per_entry = struct.unpack(
+        ">IIHHHH", data[vbri_pos + 10:vbri_pos + 26]
+    )
+    info.audio_bytes = audio_bytes
+    info.frames = frames
+    table, cursor, total = [], vbri_pos + 26, 0
+    for _ in range(entries):
+        total += int.from_bytes(data[cursor:cursor + entry_size], "big") * scale
+        table.append(total)
+        cursor += entry_size
+    info.vbri_table = table
+    info.vbri_frames_per_entry = frames_per_entry
+    info.vbr = True
+    return True
+
+def parse_stream_info(data, file_size=None, base_offset=0):
+    # data: bytes of the file starting at base_offset (past any ID3v2 tag is fine).
+    # Returns StreamInfo or None when no MPEG Layer III frames are found.
+    pos = find_frame(data)
+    if pos is None:
+        return None
+    header = parse_frame_header(data, pos)
+    info = StreamInfo(base_offset + pos, header, file_size)
+    if parse_xing(data, pos, header, info) or parse_vbri(data, pos, header, info):
+        info.audio_start += header.length # That frame holds no audio
+        if info.audio_bytes:
+            info.audio_bytes -= header.length # Xing counts its own frame
+    else:
+        # No header: CBR unless the frames we can see disagree about the bitrate
+        cursor = pos
+        while True:
+            frame = parse_frame_header(data, cursor)
+            if frame is None:
+                break
+            if frame.bitrate != header.bitrate:
+                info.vbr = True
+                break
+            cursor += frame.length
+        if file_size is not None:
+            info.audio_bytes = file_size - info.audio_start - ID3V1_SIZE
+    return info
+
+#FRAME INDEX AND LOSSLESS CUTS
+
+def main_data_begin(data, pos, header):
+    # Bytes of this frame's audio data that live in earlier frames (the bit reservoir)
+    side_info = pos + 4 + (0 if data[pos + 1] & 1 else 2) # Protection bit 0: a CRC follows the header
+    if header.version == MPEG1:
+        return (data[side_info] << 1) | (data[side_info + 1] >> 7)
+    return data[side_info]
+
+def main_data_size(data, pos, header):
+    # Room for audio data in the frame, which later frames may borrow from
+    return header.length - 4 - (0 if data[pos + 1] & 1 else 2) - header.side_info_size
+
+def index_frames(data, start=0):
+    # Offsets of every whole audio frame from start on, skipping junk between frames
+    # and dropping a truncated last frame (ranged downloads end mid-frame)
+    offsets = []
+    pos = find_frame(data, start)
+    while pos is not None:
+        header = parse_frame_header(data, pos)
+        if header is None:
+            pos = find_frame(data, pos + 1)
+            continue
+        if pos + header.length > len(data):
+            break
+        offsets.append(pos)
+        pos += header.length
+    return offsets
+
+def cut(data, start_time, end_time, overlap_frames=1):
+    # Cut the frames covering start_time-end_time (seconds of this file's decoded audio) without
+    # decoding. Frames before the start are kept as pre-roll: one for the MDCT overlap and as many
+    # as the bit reservoir of that frame reaches back. Returns (clip bytes, time of the clip's
+    # first decoded sample, duration of the whole file); the clip has no Xing/LAME header, so
+    # decoders play its pre-roll, which the caller skips using that time.
+    info = parse_stream_info(data)
+    if info is None:
+        raise ValueError("No MPEG Layer III frames found")
+    offsets = index_frames(data, info.audio_start)
+    if not offsets:
+        raise ValueError("No whole MPEG Layer III frames found")
+    frame_time = info.header.duration
+    file_duration = len(offsets) * frame_time - info.start_skip
+
+    first = min(len(offsets) - 1, max(0, int((start_time + info.start_skip) / frame_time)))
+    last = min(len(offsets), max(first + 1, math.ceil((end_time + info.start_skip) / frame_time)))
+
+    k = max(0, first - overlap_frames)
+    needed = main_data_begin(data, offsets[k], parse_frame_header(data, offsets[k]))
+    while needed > 0 and k > 0:
+        k -= 1
+        needed -= main_data_size(data, offsets[k], parse_frame_header(data, offsets[k]))
+
+    end = offsets[last - 1] + parse_frame_header(data, offsets[last - 1]).length
+    return data[offsets[k]:end], k * frame_time - info.start_skip, file_duration
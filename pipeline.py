@@ -0,0 +1,282 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import api
+import cache
+import gen
+import lyrics
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class Stage:
+    # A named step of a job. fn(**inputs) returns a dict holding every name in outputs.
+    # kind "io" stages run in the I/O thread pool, "cpu" stages in the CPU pool
+    # (their fn must be a picklable module-level function).
+    def __init__(self, name, fn, inputs, outputs, kind="io"):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.kind = kind
+
+class StageFailed(Exception):
+    def __init__(self, stage_name, error):
+        super().__init__(f"Stage '{stage_name}' failed: {error}")
+        self.stage_name = stage_name
+        self.error = error
+
+class Pipeline:
+    # Runs stages as a dependency graph: every stage starts as soon as all of its inputs
+    # exist, so independent stages overlap and the job takes about as long as its
+    # longest dependency chain.
+    def __init__(self, stages):
+        self.stages = list(stages)
+        producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"'{output}' is produced by both '{producers[output]}' and '{stage.name}'")
+                producers[output] = stage.name
+        self.producers = producers
+
+    def check(self, context):
+        # Every input must come from the initial context or from some stage, and there must be no cycles
+        overwritten = [name for name in self.producers if name in context]
+        if overwritten:
+            raise ValueError(f"Stage outputs {overwritten} are already in the context")
+        available = set(context)
+        remaining = list(self.stages)
+        while remaining:
+            runnable = [stage for stage in remaining if all(name in available for name in stage.inputs)]
+            if not runnable:
+                missing = {stage.name: [name for name in stage.inputs if name not in available] for stage in remaining}
+                raise ValueError(f"Stages can never run (missing inputs or a cycle): {missing}")
+            for stage in runnable:
+                available.update(stage.outputs)
+                remaining.remove(stage)
+
+    async def run(self, context, io_executor=None, cpu_executor=None, on_stage_done=None):
+        # Returns (context with every stage output, timings per stage). on_stage_done(stage name,
+        # context) is called on the event loop as each stage finishes, it must not block.
+        self.check(context)
+        loop = asyncio.get_running_loop()
+        context = dict(context)
+        timings = {}
+        pending = list(self.stages)
+        running = {}
+        stage_started = {}
+        started = time.monotonic()
+
+        def launch(stage):
+            kwargs = {name: context[name] for name in stage.inputs}
+            executor = cpu_executor if stage.kind == "cpu" else io_executor
+            stage_started[stage.name] = time.monotonic()
+            timings[stage.name] = {"start": round(stage_started[stage.name] - started, 3)}
+            logger.info(f"Stage '{stage.name}' started")
+            future = loop.run_in_executor(executor, _call_stage, stage.fn, kwargs, stage.kind == "cpu", os.getpid())
+            running[future] = stage
+
+        try:
+            while pending or running:
+                for stage in [s for s in pending if all(name in context for name in s.inputs)]:
+                    pending.remove(stage)
+                    launch(stage)
+
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        result, usage, worker_metrics = future.result()
+                    except Exception as e:
+                        raise StageFailed(stage.name, e) from e
+                    metrics.REGISTRY.merge(worker_metrics)
+                    record_stage_metrics(stage.name, usage)
+                    timings[stage.name]["seconds"] = round(time.monotonic() - stage_started[stage.name], 3)
+                    timings[stage.name].update(usage)
+                    timings[stage.name]["queued_seconds"] = round(max(0.0, timings[stage.name]["seconds"] - usage["run_seconds"]), 3) # Waiting for a free worker
+                    logger.info(f"Stage '{stage.name}' finished in {timings[stage.name]['seconds']}s (CPU {usage['cpu_seconds']}s)")
+                    for output in stage.outputs:
+                        context[output] = result[output]
+                    if on_stage_done is not None:
+                        on_stage_done(stage.name, context)
+        finally:
+            for future in running:
+                future.cancel() # Not started yet ones are dropped, running threads finish on their own
+
+        timings["total"] = {"start": 0, "seconds": round(time.monotonic() - started, 3)}
+        return context, timings
+
+    def run_sync(self, context, io_workers=8):
+        # Blocking helper for scripts: I/O and CPU stages both run in a local thread pool
+        # (the render itself spends its time in numpy and ffmpeg)
+        async def main():
+            with ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="stage") as executor:
+                return await self.run(context, io_executor=executor, cpu_executor=executor)
+        return asyncio.run(main())
+
+def _call_stage(fn, kwargs, cpu_stage=False, parent_pid=None):
+    # Returns (outputs, resource usage, metrics recorded in this worker process or None)
+    with metrics.StageUsage(include_children=cpu_stage) as usage:
+        result = fn(**kwargs)
+    worker_metrics = metrics.REGISTRY.drain() if parent_pid is not None and os.getpid() != parent_pid else None
+    return result, usage.record(), worker_metrics
+
+def record_stage_metrics(stage_name, usage):
+    metrics.STAGE_SECONDS.observe(usage["run_seconds"], stage=stage_name)
+    metrics.STAGE_CPU_SECONDS.inc(usage["cpu_seconds"] + usage.get("child_cpu_seconds", 0), stage=stage_name)
+    if "read_bytes" in usage:
+        metrics.STAGE_IO_BYTES.inc(usage["read_bytes"], stage=stage_name, direction="read")
+        metrics.STAGE_IO_BYTES.inc(usage["write_bytes"], stage=stage_name, direction="write")
+
+#VIDEO JOB STAGES
+
+def fetch_audio_stage(spotify_url, vid_id, workdir, resolve_link, start_time, end_time):
+    audio_path, title, audio_offset = api.fetch_track_audio(
+        spotify_url, vid_id, resolve_link=resolve_link, workdir=workdir, window=(start_time, end_time)
+    )
+    return {"audio_path": audio_path, "title": title, "audio_offset": audio_offset}
+
+def audio_clip_stage(audio_path, audio_offset, start_time, end_time, vid_id, workdir):
+    # Lossless frame slice of the clip window, a byte copy instead of a decode/encode
+    clip_path, clip_offset, audio_fades = gen.cut_audio(audio_path, start_time, end_time, vid_id, workdir=workdir, source_offset=audio_offset)
+    return {"clip_path": clip_path, "clip_offset": clip_offset, "audio_fades": audio_fades}
+
+def spotify_title_stage(title):
+    return {"song_title": title}
+
+def lyrics_stage(song_title, custom_title, spotify_url, vid_id, workdir, start_time, end_time):
+    # Parsed once; the timed entries and the prompt text come out of one pass over the clip window.
+    # The JSON copy in the workspace is only for the job record.
+    song_lyrics = api.get_lyrics(song_title, track_id=cache.spotify_track_id(spotify_url), custom_title=custom_title)
+    lyrics_path = lyrics.save(song_lyrics, os.path.join(workdir, f"lyrics_{vid_id}.json"))
+    text_entries, lyrics_as_str = song_lyrics.clip(start_time, end_time, adjusted_time=0.10)
+    return {"lyrics_path": lyrics_path, "lyrics_as_str": lyrics_as_str, "text_entries": text_entries}
+
+def photo_background_stage(raw_image_path, image_source_type, vid_id, workdir):
+    # Raw photo -> styled background, needs neither audio nor lyrics
+    if not (raw_image_path and os.path.exists(raw_image_path)):
+        raise ValueError(f"Raw image path '{raw_image_path}' is not valid for source type '{image_source_type}'")
+    image_ext = raw_image_path.split(".")[-1]
+    copied_raw_image = os.path.join(workdir, f"raw_{vid_id}.{image_ext}")
+    shutil.copy(raw_image_path, copied_raw_image)
+    logger.info(f"Ghibli source ({image_source_type}): Raw image {copied_raw_image}")
+    ghibli_image_path, background_key = api.make_ghibli_image_cached(
+        image_path=copied_raw_image, vid_id=vid_id, source_type=image_source_type, workdir=workdir
+    )
+    return {"raw_image_copy": copied_raw_image, "ghibli_image_path": ghibli_image_path, "background_key": background_key}
+
+def lyrics_background_stage(lyrics_as_str, vid_id, workdir):
+    ghibli_image_path, background_key = api.make_ghibli_image_cached(
+        image_path=None, vid_id=vid_id, lyrics_data=lyrics_as_str, source_type="lyrics_based", workdir=workdir
+    )
+    return {"raw_image_copy": "lyrics_based", "ghibli_image_path": ghibli_image_path, "background_key": background_key}
+
+def reuse_background_stage(background_key, vid_id, workdir):
+    ghibli_image_path = api.reuse_cached_image(background_key, vid_id, workdir=workdir)
+    return {"raw_image_copy": "reused", "ghibli_image_path": ghibli_image_path}
+
+def render_stage(ghibli_image_path, text_entries, clip_path, clip_offset, audio_fades, start_time, end_time, vid_id, font, workdir, aspects, karaoke, render_workers, cancel_path, draft_video_path=None):
+    #PAN, LYRICS AND AUDIO IN ONE ENCODE, EVERY OUTPUT FORMAT FROM THE SAME FRAME LOOP
+    # draft_video_path only orders the final render after the draft
+    final_video_paths = gen.render_videos(
+        ghibli_image_path, text_entries, clip_path, start_time, end_time, vid_id, aspects=aspects,
+        the_font=font, text_position="mid", workdir=workdir, audio_offset=clip_offset, audio_fades=audio_fades,
+        workers=render_workers, karaoke=karaoke, cancel_path=cancel_path,
+    )
+    return {"final_video_path": final_video_paths[aspects[0]], "final_video_paths": final_video_paths}
+
+def draft_stage(ghibli_image_path, text_entries, clip_path, clip_offset, audio_fades, start_time, end_time, vid_id, font, workdir, aspects, karaoke):
+    #QUICK LOW RESOLUTION PREVIEW OF THE FIRST FORMAT, ONE PROCESS
+    draft_video_paths = gen.render_videos(
+        ghibli_image_path, text_entries, clip_path, start_time, end_time, vid_id, aspects=aspects[:1],
+        the_font=font, text_position="mid", workdir=workdir, audio_offset=clip_offset, audio_fades=audio_fades,
+        karaoke=karaoke, quality="draft",
+    )
+    return {"draft_video_path": draft_video_paths[aspects[0]]}
+
+def video_context(vid_id, workdir, spotify_url, start_time, end_time, raw_image_path, image_source_type, resolve_link, song_title=None, font=1, background_key=None, render_workers=1, karaoke=False, aspects=None):
+    # Initial values the video stages read; resolve_link(spotify_url) -> (download link, title).
+    # render_workers > 1 renders time slices of the video in parallel processes, karaoke
+    # highlights the lyrics word by word. Creating the file at cancel_path stops the final render.
+    # aspects: output formats (gen.ASPECT_SIZES names), final_video_path is the first one.
+    aspects = list(aspects or [gen.DEFAULT_ASPECT])
+    unknown = [aspect for aspect in aspects if aspect not in gen.ASPECT_SIZES]
+    if unknown:
+        raise ValueError(f"Unknown output formats {unknown}, expected some of {list(gen.ASPECT_SIZES)}")
+    context = {
+        "vid_id": vid_id,
+        "workdir": workdir,
+        "spotify_url": spotify_url,
+        "start_time": start_time,
+        "end_time": end_time,
+        "raw_image_path": raw_image_path,
+        "image_source_type": image_source_type,
+        "resolve_link": resolve_link,
+        "font": font,
+        "render_workers": render_workers,
+        "karaoke": karaoke,
+        "aspects": aspects,
+        "cancel_path": os.path.join(workdir, "cancel"),
+        "custom_title": song_title is not None, # Typed by the user, overrides the track's cached lyrics
+    }
+    if song_title is not None:
+        context["song_title"] = song_title
+    if background_key is not None:
+        context["background_key"] = background_key
+    return context
+
+RENDER_INPUTS = ["ghibli_image_path", "text_entries", "clip_path", "clip_offset", "audio_fades", "start_time", "end_time", "vid_id", "font", "workdir", "aspects", "karaoke"]
+
+def build_video_pipeline(image_source_type, custom_title=False, draft=False):
+    # custom_title: the song title for the lyrics search is already in the context
+    # draft: render a low resolution preview (draft_video_path) before the final video
+    final_inputs = RENDER_INPUTS + ["render_workers", "cancel_path"] + (["draft_video_path"] if draft else [])
+    stages = [
+        Stage("audio", fetch_audio_stage, ["spotify_url", "vid_id", "workdir", "resolve_link", "start_time", "end_time"], ["audio_path", "title", "audio_offset"]),
+        Stage("audio_clip", audio_clip_stage, ["audio_path", "audio_offset", "start_time", "end_time", "vid_id", "workdir"], ["clip_path", "clip_offset", "audio_fades"]),
+        Stage("lyrics", lyrics_stage, ["song_title", "custom_title", "spotify_url", "vid_id", "workdir", "start_time", "end_time"], ["lyrics_path", "lyrics_as_str", "text_entries"]),
+        Stage("render", render_stage, final_inputs, ["final_video_path", "final_video_paths"], kind="cpu"),
+    ]
+    if draft:
+        stages.append(Stage("draft", draft_stage, RENDER_INPUTS, ["draft_video_path"], kind="cpu"))
+    if not custom_title:
+        stages.append(Stage("song_title", spotify_title_stage, ["title"], ["song_title"]))
+
+    if image_source_type == "lyrics_based":
+        stages.append(Stage("background", lyrics_background_stage, ["lyrics_as_str", "vid_id", "workdir"], ["raw_image_copy", "ghibli_image_path", "background_key"]))
+    elif image_source_type in ("raw_ghibli", "ghibli_char"):
+        stages.append(Stage("background", photo_background_stage, ["raw_image_path", "image_source_type", "vid_id", "workdir"], ["raw_image_copy", "ghibli_image_path", "background_key"]))
+    elif image_source_type == "reuse":
+        stages.append(Stage("background", reuse_background_stage, ["background_key", "vid_id", "workdir"], ["raw_image_copy", "ghibli_image_path"]))
+    else:
+        raise ValueError(f"Invalid image_source_type for Ghibli generation: {image_source_type}")
+    return Pipeline(stages)
+
+def video_record(context, timings):
+    # The job record kept in the job store (jobstore.py)
+    return {
+        "id": context["vid_id"],
+        "spotify_url": context["spotify_url"],
+        "song_title": context["song_title"],
+        "start_time": context["start_time"],
+        "end_time": context["end_time"],
+        "workdir": context["workdir"],
+        "raw_image_path": context["raw_image_copy"], # Path to {workdir}/raw_{vid_id}.ext, "lyrics_based" or "reused"
+        "ghibli_image_path": context["ghibli_image_path"],
+        "background_key": context.get("background_key"), # Image cache key, lets the user reuse this background
+        "audio_path": context["audio_path"],
+        "audio_offset": context["audio_offset"], # Track time the (possibly partial) audio file starts at
+        "clip_path": context["clip_path"], # Frame slice of the clip window that was muxed
+        "lyrics_path": context["lyrics_path"],
+        "image_source_type": context["image_source_type"],
+        "font": context["font"],
+        "draft_video_path": context.get("draft_video_path"), # Low resolution preview, when one was rendered
+        "final_video_path": context["final_video_path"],
+        "final_video_paths": context["final_video_paths"], # Every output format, by aspect ratio
+        "timings": timings,
+    }
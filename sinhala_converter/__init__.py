@@ -0,0 +1 @@
+from .converter import convertor, convert_lines, TARGET_ENCODINGS
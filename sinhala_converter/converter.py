@@ -0,0 +1,71 @@
+import json
+import os
+from functools import lru_cache
+
+DATA_LIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_list.json")
+TARGET_ENCODINGS = ("fm", "isi")
+CACHE_SIZE = 4096 # Converted lines kept in the LRU
+
+_END = "" # Trie key marking "a mapping ends here", never a real character
+
+def build_trie(data_list, target):
+    # One nested-dict trie per target encoding. Unicode keys are inserted in file order
+    # and the first mapping for a key wins, like the data list is meant to be read.
+    trie = {}
+    for item in data_list:
+        uni = item["uni"]
+        if not uni:
+            continue
+        node = trie
+        for char in uni:
+            node = node.setdefault(char, {})
+        node.setdefault(_END, item[target])
+    return trie
+
+def load_tries(path=DATA_LIST_PATH):
+    with open(path, "r", encoding="utf-8") as json_file:
+        data_list = json.load(json_file)
+    return {target: build_trie(data_list, target) for target in TARGET_ENCODINGS}
+
+#BUILT ONCE AT IMPORT
+TRIES = load_tries()
+
+def convert_text(text, target):
+    # Single left-to-right pass, taking the longest mapping that starts at each position.
+    # Characters with no mapping are copied through unchanged.
+    trie = TRIES[target]
+    out = []
+    i = 0
+    length = len(text)
+    while i < length:
+        node = trie
+        match = None
+        match_end = i
+        j = i
+        while j < length:
+            node = node.get(text[j])
+            if node is None:
+                break
+            j += 1
+            if _END in node:
+                match = node[_END]
+                match_end = j
+        if match is None:
+            out.append(text[i])
+            i += 1
+        else:
+            out.append(match)
+            i = match_end
+    return "".join(out)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def convertor(text, target="fm"):
+    if target == "uni":
+        return text
+    if target not in TRIES:
+        raise ValueError(f"Unknown target encoding '{target}', expected one of {TARGET_ENCODINGS}")
+    return convert_text(text, target)
+
+def convert_lines(lines, target="fm"):
+    # Batch API: convert a whole lyric set in one call
+    return [convertor(line, target) for line in lines]
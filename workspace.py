@@ -0,0 +1,149 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_ROOT = "temp" # One private directory per job lives under here
+TMPFS_ROOT = os.getenv("WORKSPACE_TMPFS") # e.g. /dev/shm/lyrics-bot, keeps job intermediates in RAM when set
+
+HOUR = 60 * 60
+GB = 1024 * 1024 * 1024
+
+# Directory -> (max age in seconds, max total bytes). None disables that budget.
+# Entries are job workspaces (directories) or single files, evicted least recently used first.
+DEFAULT_BUDGETS = {
+    WORKSPACE_ROOT: (24 * HOUR, 5 * GB),
+    "outputs": (7 * 24 * HOUR, 20 * GB),
+    "bot_temp": (1 * HOUR, 1 * GB),
+}
+if TMPFS_ROOT:
+    DEFAULT_BUDGETS[TMPFS_ROOT] = (6 * HOUR, 1 * GB)
+
+JANITOR_INTERVAL = 10 * 60 # Seconds between sweeps
+
+ACTIVE_JOBS = set() # Workspaces of running jobs are never evicted
+_active_lock = threading.Lock()
+
+def new_job_id():
+    # Sortable by time, unique even for requests in the same second
+    return f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+def workspace_path(job_id):
+    return os.path.join(TMPFS_ROOT or WORKSPACE_ROOT, job_id)
+
+def create_workspace(job_id):
+    path = workspace_path(job_id)
+    os.makedirs(path, exist_ok=True)
+    with _active_lock:
+        ACTIVE_JOBS.add(job_id)
+    return path
+
+def release_workspace(job_id, remove=False):
+    # The job is done: its workspace becomes evictable (or is removed right away)
+    with _active_lock:
+        ACTIVE_JOBS.discard(job_id)
+    if remove:
+        shutil.rmtree(workspace_path(job_id), ignore_errors=True)
+
+def entry_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def entry_last_used(path):
+    # Most recent access/modification of the entry (or anything inside a workspace).
+    # Directory atimes are ignored: listing them (including our own sweeps) bumps them.
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return max(stat.st_atime, stat.st_mtime)
+    last_used = stat.st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            last_used = max(last_used, stat.st_atime, stat.st_mtime)
+    return last_used
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def sweep_directory(directory, max_age=None, max_bytes=None, now=None):
+    # Enforce the age budget, then evict least recently used entries until under the size budget
+    if not os.path.isdir(directory):
+        return []
+    now = now or time.time()
+    with _active_lock:
+        protected = set(ACTIVE_JOBS)
+
+    entries = []
+    for name in os.listdir(directory):
+        if name in protected or name.startswith("."):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            entries.append((entry_last_used(path), entry_size(path), path))
+        except OSError:
+            continue # Removed while we were looking
+    entries.sort() # Oldest first
+
+    evicted = []
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, path in entries:
+        too_old = max_age is not None and now - last_used > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if not (too_old or too_big):
+            continue
+        remove_entry(path)
+        total -= size
+        evicted.append(path)
+    return evicted
+
+def sweep(budgets=None, now=None, on_evict=None):
+    # on_evict(paths) is told what was removed, e.g. to stop the job store offering those videos
+    evicted = []
+    for directory, (max_age, max_bytes) in (budgets or DEFAULT_BUDGETS).items():
+        evicted.extend(sweep_directory(directory, max_age, max_bytes, now=now))
+    if evicted:
+        logger.info(f"Janitor evicted {len(evicted)} entries")
+        if on_evict is not None:
+            on_evict(evicted)
+    return evicted
+
+class Janitor(threading.Thread):
+    # Background thread that keeps temp/, outputs/ and bot_temp/ within their budgets
+    def __init__(self, budgets=None, interval=JANITOR_INTERVAL, on_evict=None):
+        super().__init__(name="janitor", daemon=True)
+        self.budgets = budgets
+        self.interval = interval
+        self.on_evict = on_evict
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                sweep(self.budgets, on_evict=self.on_evict)
+            except Exception as e:
+                logger.error(f"Janitor sweep failed: {e}", exc_info=True)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()